@@ -0,0 +1,219 @@
+"""
+Single file archive of a whole project, written by encrypt_project -a and read by
+decrypt_project.
+
+    header  : MAGIC, format version, HKDF salt, chunk size and the AES-256 master
+              key wrapped with the recipient's RSA key (OAEP)
+    files   : the files one after the other, in chunks sealed like in container.py
+    index   : JSON list of the files (path, id, offset, stored length, size), sealed
+              the same way
+    trailer : offset and length of the index, MAGIC
+
+The RSA key wrap is done once for the archive: every file is sealed with its own
+key, derived from the master key and the file id with HKDF, and the header is
+authenticated with every chunk. Paths only appear in the sealed index. With the
+index, a single file can be read without decrypting the others.
+"""
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Random import get_random_bytes
+from container import CHUNK_SIZE, KEY_SIZE, Sealer, sealChunks, openChunks, readFull
+from keysession import wipe
+import io
+import json
+import os
+import posixpath
+import struct
+import time
+
+MAGIC = b"FARC"
+VERSION = 1
+SALT_SIZE = 16
+
+# magic, version, salt, chunk size, wrapped key length
+HEADER = struct.Struct(">4sB16sIH")
+# index offset, index length, magic
+TRAILER = struct.Struct(">QQ4s")
+# the key of every file is unique, so is the nonce of every chunk without a random prefix
+PREFIX = bytes(7)
+INDEX_ID = 0
+
+
+def isArchive(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class UnsafePath(ValueError):
+    # an entry whose path would be written outside of the output directory, the archive itself
+    # may be fine
+    pass
+
+
+def safePath(name):
+    # archive paths come from the archive, they must stay inside the output directory
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or '\\' in name:
+        raise UnsafePath("Invalid path in archive '{}'".format(name))
+    return os.path.join(*parts)
+
+
+class ArchiveSession:
+    # master key of an archive and the sealers derived from it
+    def __init__(self, master_key, salt, header, chunk_size):
+        self.master_key = master_key
+        self.salt = salt
+        self.header = header
+        self.chunk_size = chunk_size
+
+    def sealer(self, file_id):
+        key = bytearray(HKDF(self.master_key, KEY_SIZE, self.salt, SHA256, context=struct.pack(">Q", file_id)))
+        return Sealer(key, PREFIX, self.header + struct.pack(">Q", file_id))
+
+    def close(self):
+        wipe(self.master_key)
+
+
+class ArchiveWriter:
+    # writes to path + ".part", renamed over path by close() once the index is written
+    def __init__(self, path, keys, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.keys = keys
+        self.entries = []
+        self.out_file = open(path + ".part", 'wb')
+
+        master_key = bytearray(get_random_bytes(KEY_SIZE))
+        salt = get_random_bytes(SALT_SIZE)
+        wrapped_key = keys.wrapKey(master_key)
+        header = HEADER.pack(MAGIC, VERSION, salt, chunk_size, len(wrapped_key)) + wrapped_key
+        self.out_file.write(header)
+        self.session = ArchiveSession(master_key, salt, header, chunk_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, filepath, name):
+        # name : path of the file inside the archive, with '/' separators
+        start = time.perf_counter()
+        offset = self.out_file.tell()
+        sealer = self.session.sealer(len(self.entries) + 1)
+        try:
+            with open(filepath, 'rb') as in_file:
+                size, length = sealChunks(sealer, in_file, self.out_file, self.session.chunk_size)
+        except OSError:
+            # nothing points to what was written of it
+            self.out_file.seek(offset)
+            self.out_file.truncate()
+            raise
+        finally:
+            sealer.close()
+        self.entries.append({'path': name, 'id': len(self.entries) + 1, 'offset': offset, 'length': length,
+                             'size': size})
+        self.keys.fileDone(time.perf_counter() - start)
+
+    def close(self):
+        offset = self.out_file.tell()
+        sealer = self.session.sealer(INDEX_ID)
+        try:
+            index = io.BytesIO(json.dumps(self.entries).encode())
+            length = sealChunks(sealer, index, self.out_file, self.session.chunk_size)[1]
+        finally:
+            sealer.close()
+            self.session.close()
+        self.out_file.write(TRAILER.pack(offset, length, MAGIC))
+        self.out_file.close()
+        os.replace(self.path + ".part", self.path)
+
+    def abort(self):
+        self.session.close()
+        self.out_file.close()
+        os.remove(self.path + ".part")
+
+
+class ArchiveReader:
+    def __init__(self, path, keys):
+        self.in_file = open(path, 'rb')
+        try:
+            fixed = readFull(self.in_file, HEADER.size)
+            if len(fixed) < HEADER.size:
+                raise ValueError("Truncated header")
+            magic, version, salt, chunk_size, key_length = HEADER.unpack(fixed)
+            if magic != MAGIC:
+                raise ValueError("Not an encrypted archive")
+            if version != VERSION:
+                raise ValueError("Unsupported archive version {}".format(version))
+            wrapped_key = readFull(self.in_file, key_length)
+            self.session = ArchiveSession(keys.unwrapKey(wrapped_key), salt, fixed + wrapped_key, chunk_size)
+
+            self.in_file.seek(0, os.SEEK_END)
+            end = self.in_file.tell()
+            if end < HEADER.size + key_length + TRAILER.size:
+                raise ValueError("Truncated archive")
+            self.in_file.seek(end - TRAILER.size)
+            offset, length, magic = TRAILER.unpack(self.in_file.read(TRAILER.size))
+            if magic != MAGIC or offset + length > end - TRAILER.size:
+                raise ValueError("Corrupted archive index")
+            self.entries = dict((entry['path'], entry) for entry in json.loads(self._read(INDEX_ID, offset, length)))
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _chunks(self, file_id, offset, length):
+        sealer = self.session.sealer(file_id)
+        try:
+            self.in_file.seek(offset)
+            for chunk in openChunks(sealer, self.in_file, self.session.chunk_size, length):
+                yield chunk
+        finally:
+            sealer.close()
+
+    def _read(self, file_id, offset, length):
+        return b"".join(self._chunks(file_id, offset, length))
+
+    def names(self):
+        return list(self.entries)
+
+    def chunks(self, name):
+        # the chunks of a single file, without reading the others
+        entry = self.entries[name]
+        return self._chunks(entry['id'], entry['offset'], entry['length'])
+
+    def extract(self, name, outputpath):
+        # written next to its final path and renamed once every chunk is verified, returns the path
+        filepath = os.path.join(outputpath, safePath(name))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        part = os.path.join(os.path.dirname(filepath), ".{}.part".format(os.path.basename(filepath)))
+        try:
+            with open(part, 'wb') as f:
+                for chunk in self.chunks(name):
+                    f.write(chunk)
+            os.replace(part, filepath)
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        return filepath
+
+    def close(self):
+        if getattr(self, 'session', None) is not None:
+            self.session.close()
+        self.in_file.close()
+
+
+def archiveName(root, filepath):
+    return posixpath.join(*os.path.relpath(filepath, root).split(os.sep))
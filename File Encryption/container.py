@@ -0,0 +1,169 @@
+"""
+Streaming container written by fileencrypt and read by filedecrypt.
+
+    header   : MAGIC, format version, nonce prefix, chunk size and the AES-256
+               session key wrapped with the recipient's RSA key (OAEP)
+    metadata : its length, then the first sealed chunk, JSON with the original
+               file name
+    data     : the file cut in chunks of chunk size bytes, each one sealed with
+               AES-GCM and followed by its 16 bytes tag
+
+Every chunk has its own nonce (nonce prefix, chunk counter, last chunk flag) and
+the header is authenticated with every chunk, so chunks can't be reordered,
+dropped, truncated or moved to another file without failing verification. Only
+one chunk is held in memory at a time, whatever the size of the file.
+"""
+from Crypto.Random import get_random_bytes
+from Crypto.Cipher import AES
+from keysession import wipe
+import json
+import struct
+
+MAGIC = b"FENC"
+VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+KEY_SIZE = 32
+TAG_SIZE = 16
+
+# magic, version, nonce prefix, chunk size, wrapped key length
+HEADER = struct.Struct(">4sB7sIH")
+# chunk counter, last chunk flag
+NONCE_SUFFIX = struct.Struct(">IB")
+# length of the sealed metadata
+LENGTH = struct.Struct(">I")
+
+
+def isContainer(in_file):
+    start = in_file.tell()
+    magic = in_file.read(len(MAGIC))
+    in_file.seek(start)
+    return magic == MAGIC
+
+
+def readFull(in_file, size):
+    # read() may return less than asked on pipes
+    data = in_file.read(size)
+    while 0 < len(data) < size:
+        more = in_file.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+class Sealer:
+    def __init__(self, session_key, prefix, header):
+        self.session_key = session_key
+        self.prefix = prefix
+        self.header = header
+
+    def _cipher(self, counter, last):
+        cipher = AES.new(self.session_key, AES.MODE_GCM, nonce=self.prefix + NONCE_SUFFIX.pack(counter, last))
+        cipher.update(self.header)
+        return cipher
+
+    def seal(self, counter, data, last=False):
+        ciphertext, tag = self._cipher(counter, last).encrypt_and_digest(data)
+        return ciphertext + tag
+
+    def open(self, counter, record, last=False):
+        if len(record) < TAG_SIZE:
+            raise ValueError("Truncated chunk")
+        return self._cipher(counter, last).decrypt_and_verify(record[:-TAG_SIZE], record[-TAG_SIZE:])
+
+    def close(self):
+        wipe(self.session_key)
+
+
+def encryptStream(in_file, out_file, keys, metadata, chunk_size=CHUNK_SIZE):
+    # keys : KeySession wrapping the session key for the recipient
+    session_key = bytearray(get_random_bytes(KEY_SIZE))
+    prefix = get_random_bytes(7)
+    wrapped_key = keys.wrapKey(session_key)
+    header = HEADER.pack(MAGIC, VERSION, prefix, chunk_size, len(wrapped_key)) + wrapped_key
+    out_file.write(header)
+
+    sealer = Sealer(session_key, prefix, header)
+    try:
+        record = sealer.seal(0, json.dumps(metadata).encode())
+        out_file.write(LENGTH.pack(len(record)) + record)
+        return sealChunks(sealer, in_file, out_file, chunk_size)[0]
+    finally:
+        sealer.close()
+
+
+def sealChunks(sealer, in_file, out_file, chunk_size, counter=1):
+    # seals in_file up to its end, returns the size read and the size written
+    size = written = 0
+    # one chunk read ahead, to know which one is the last
+    data = readFull(in_file, chunk_size)
+    while True:
+        following = readFull(in_file, chunk_size) if len(data) == chunk_size else b""
+        record = sealer.seal(counter, data, last=not following)
+        out_file.write(record)
+        size += len(data)
+        written += len(record)
+        if not following:
+            return size, written
+        data = following
+        counter += 1
+
+
+def openChunks(sealer, in_file, chunk_size, length=None, counter=1):
+    # yields the chunks sealed by sealChunks, read up to the end of in_file or over length bytes
+    record_size = chunk_size + TAG_SIZE
+
+    def nextRecord():
+        nonlocal length
+        if length is None:
+            return readFull(in_file, record_size)
+        record = readFull(in_file, min(record_size, length))
+        length -= len(record)
+        return record
+
+    record = nextRecord()
+    while True:
+        following = nextRecord() if len(record) == record_size else b""
+        yield sealer.open(counter, record, last=not following)
+        if not following:
+            return
+        record = following
+        counter += 1
+
+
+class ContainerReader:
+    # keys : KeySession holding the private key, the session key is wiped by close()
+    def __init__(self, in_file, keys):
+        self.in_file = in_file
+        fixed = readFull(in_file, HEADER.size)
+        if len(fixed) < HEADER.size:
+            raise ValueError("Truncated header")
+        magic, version, prefix, self.chunk_size, key_length = HEADER.unpack(fixed)
+        if magic != MAGIC:
+            raise ValueError("Not an encrypted container")
+        if version != VERSION:
+            raise ValueError("Unsupported container version {}".format(version))
+        wrapped_key = readFull(in_file, key_length)
+        self.sealer = Sealer(keys.unwrapKey(wrapped_key), prefix, fixed + wrapped_key)
+
+        try:
+            length = readFull(in_file, LENGTH.size)
+            if len(length) < LENGTH.size or LENGTH.unpack(length)[0] > self.chunk_size + TAG_SIZE:
+                raise ValueError("Corrupted metadata")
+            record = readFull(in_file, LENGTH.unpack(length)[0])
+            self.metadata = json.loads(self.sealer.open(0, record).decode())
+        except ValueError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.sealer.close()
+
+    def chunks(self):
+        return openChunks(self.sealer, self.in_file, self.chunk_size)
@@ -1,23 +1,51 @@
+from archive import ArchiveReader, UnsafePath, isArchive
 from filedecrypt import decryptFile
+from keysession import KeySession, addTimings, formatTimings
+from manifest import MANIFEST_NAME
+from parallel import runTasks, parseJobs
 import os
 import shutil
 import getpass
+import time
 
 keypath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "private_key.bin")
-ERRORS = False
+keys = None
 
 def copyFile(src, dest):
     print("Copying file '{}' to '{}'".format(src, dest))
     shutil.copy(src, dest)
 
 
-def decryptProject(path, outputpath=None):
-    global ERRORS
+def openSession(passphrase):
+    # worker initializer, the private key is unlocked once per process (forked workers inherit it)
+    global keys
+    if keys is None:
+        keys = KeySession(private_key_path=keypath, passphrase=passphrase)
 
+
+def decryptTask(task):
+    # runs in a worker, returns None or the reason of the failure, and the timings of the task
+    filepath, newpath = task
+    try:
+        decryptFile(filepath, keypath, None, newpath, keys)
+    except ValueError:
+        return "is corrupted and can't be decoded", keys.takeTimings()
+    except Exception as e:
+        return "failed ({}: {})".format(type(e).__name__, e), keys.takeTimings()
+    return None, keys.takeTimings()
+
+
+def decryptProject(path, outputpath=None, jobs=1):
+    # returns the output path, the list of (filepath, reason) of the files that failed and the timings
+    global keys
     assert os.path.exists(path), "Path doesn't exist"
     assert os.path.isdir(path), "Path is not a directory"
 
     passphrase = getpass.getpass()
+    try:
+        openSession(passphrase)
+    except ValueError:
+        raise ValueError("Can't unlock the private key, wrong passphrase?")
 
     if not outputpath:
         suffix = "_decrypted"
@@ -26,6 +54,8 @@ def decryptProject(path, outputpath=None):
     if not os.path.exists(outputpath):
         os.mkdir(outputpath)
 
+    # directories are created and plain files copied up front, decryption goes to the workers
+    tasks = []
     for root, folders, files in os.walk(path):
         newpath = os.path.join(outputpath, os.path.relpath(root, path))
         if not os.path.exists(newpath):
@@ -33,29 +63,100 @@ def decryptProject(path, outputpath=None):
 
         for file in files:
             filepath = os.path.join(root, file)
+            if root == path and file == MANIFEST_NAME:
+                continue
             try:
                 if file.split('.')[1] == 'bin':
-                    try:
-                        print("Decrypting file '{}' to '{}'".format(filepath, newpath))
-                        decryptFile(filepath, keypath, passphrase, newpath)
-                    except ValueError:
-                        ERRORS = True
-                        print("[Warning] File '{}' is corrupted and can't be decoded".format(filepath))
+                    tasks.append((filepath, newpath))
                 else:
                     copyFile(filepath, newpath)
             except IndexError:
                 copyFile(filepath, newpath)
 
-    return outputpath
+    failures = []
+    # taken before the workers fork, they would count the unlocking of the key again
+    timings = keys.takeTimings()
+    try:
+        for (filepath, newpath), (error, task_timings) in runTasks(decryptTask, tasks, jobs, openSession, (passphrase,)):
+            print("Decrypting file '{}' to '{}'".format(filepath, newpath))
+            addTimings(timings, task_timings)
+            if error:
+                print("[Warning] File '{}' {}".format(filepath, error))
+                failures.append((filepath, error))
+    finally:
+        addTimings(timings, keys.takeTimings())
+        keys.close()
+        keys = None
+
+    return outputpath, failures, timings
+
+
+def decryptArchive(path, outputpath=None, names=None):
+    # extracts the files of an archive written by encrypt_project -a, or only 'names' (paths in
+    # the archive) which are read without decrypting the rest
+    # returns the output path, the list of (name, reason) of the files that failed and the timings
+    assert isArchive(path), "Path is not an encrypted archive"
+
+    passphrase = getpass.getpass()
+    try:
+        keys = KeySession(private_key_path=keypath, passphrase=passphrase)
+    except ValueError:
+        raise ValueError("Can't unlock the private key, wrong passphrase?")
+
+    if not outputpath:
+        outputpath = path.rsplit('.', 1)[0] if path.endswith('.bin') else path
+        outputpath = outputpath[:-len("_encrypted")] if outputpath.endswith("_encrypted") else outputpath
+        outputpath += "_decrypted"
+
+    if not os.path.exists(outputpath):
+        os.mkdir(outputpath)
+
+    failures = []
+    with keys, ArchiveReader(path, keys) as archive:
+        for name in names or archive.names():
+            start = time.perf_counter()
+            print("Decrypting file '{}' to '{}'".format(name, outputpath))
+            try:
+                archive.extract(name, outputpath)
+                keys.fileDone(time.perf_counter() - start)
+            except KeyError:
+                print("[Warning] File '{}' isn't in the archive".format(name))
+                failures.append((name, "isn't in the archive"))
+            except UnsafePath:
+                # checked before anything is decrypted, this says nothing about the data
+                print("[Warning] File '{}' has a path outside of the output directory and was skipped".format(name))
+                failures.append((name, "has a path outside of the output directory"))
+            except ValueError:
+                print("[Warning] File '{}' is corrupted and can't be decoded".format(name))
+                failures.append((name, "is corrupted and can't be decoded"))
+        timings = keys.takeTimings()
+
+    return outputpath, failures, timings
+
 
 if __name__ == "__main__":
     import sys
 
-    assert len(sys.argv) == 2 or len(sys.argv) == 3
+    args = sys.argv[1:]
+    jobs = parseJobs(args)
+    # '-f name' (repeatable) : only these files of an archive
+    names = []
+    while '-f' in args:
+        i = args.index('-f')
+        assert i + 1 < len(args), "'-f' must be followed by a path in the archive."
+        names.append(args[i + 1])
+        del args[i:i + 2]
+    assert len(args) == 1 or len(args) == 2, "Must provide 'path', optionally 'outputpath', '-j jobs' (0 for one per core) or '-f name' for files of an archive."
 
-    decryptProject(*sys.argv[1:])
+    if os.path.isfile(args[0]):
+        outputpath, failures, timings = decryptArchive(*args, names=names)
+    else:
+        outputpath, failures, timings = decryptProject(*args, jobs=jobs)
+    print(formatTimings(timings))
 
-    if ERRORS:
+    if failures:
         print("*Finished with errors*")
+        for filepath, error in failures:
+            print("    {} : {}".format(filepath, error))
     else:
         print("Done")
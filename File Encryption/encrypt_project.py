@@ -1,9 +1,14 @@
-from fileencrypt import encryptFile
+from archive import ArchiveWriter, archiveName
+from fileencrypt import encryptFile, randomString
+from keysession import KeySession, addTimings, formatTimings
+from manifest import Manifest, MANIFEST_NAME, fileState, newDigest, defaultKeyPath, orphanOutputs
+from parallel import runTasks, parseJobs
 import os
 import shutil
 
-ERRORS = False
 keypath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "public_key.bin")
+manifest_keypath = defaultKeyPath()
+keys = None
 
 # files to encrypt
 ext_whitelist = ['py', 'txt', 'rtf', 'plist', 'h', 'cpp', 'c', 'sh', 'spec']
@@ -13,16 +18,45 @@ ext_blacklist = ['pyc', 'jpg', 'jpeg', 'tiff', 'png', 'psd', 'icns', 'pages', 'w
 
 
 def copyFile(src, dest, ext=None):
+    # returns True when the file is copied
     if ext not in ext_blacklist:
         path, name = os.path.split(src)
         if os.path.isfile(src) and name[0] != '.':
             print("Copying file '{}' to '{}'".format(src, dest))
             shutil.copy(src, dest)
-
-
-def encryptProject(path, outputpath=None):
-    global ERRORS
-
+            return True
+    return False
+
+
+def openSession():
+    # worker initializer, the public key is loaded once per process (forked workers inherit it)
+    global keys
+    if keys is None:
+        keys = KeySession(keypath)
+
+
+def encryptTask(task):
+    # runs in a worker, returns None or the reason of the failure, the timings of the task and
+    # the manifest entry of the file
+    # old_hash : hash of the file when its output was written, the output is only replaced if it changed
+    filepath, newpath, rndname, old_hash = task
+    try:
+        # taken first, a change during the encryption will be seen by the next run
+        size, mtime_ns = fileState(filepath)
+        # hashed as it is encrypted, the file is read once
+        digest = newDigest()
+        ret = encryptFile(filepath, keypath, newpath, keys, rndname, digest, old_hash)
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e), keys.takeTimings(), None
+    if ret:
+        os.remove(ret)
+        return "can't be read", keys.takeTimings(), None
+    return None, keys.takeTimings(), [size, mtime_ns, digest.hexdigest(), rndname]
+
+
+def encryptProject(path, outputpath=None, jobs=1):
+    # returns the output path, the list of (filepath, reason) of the files that failed and the timings
+    global keys
     assert os.path.exists(path), "Path doesn't exist."
     assert os.path.isdir(path), "Path isn't a directory"
 
@@ -33,6 +67,19 @@ def encryptProject(path, outputpath=None):
     if not os.path.exists(outputpath):
         os.mkdir(outputpath)
 
+    # files whose size and mtime, or content, didn't change since the last run keep their output
+    manifest = Manifest(os.path.join(outputpath, MANIFEST_NAME), manifest_keypath)
+    try:
+        loaded = manifest.load()
+    except ValueError as e:
+        print("[Warning] Manifest can't be read ({}), every file will be encrypted again".format(e))
+        loaded = False
+    old_entries, manifest.entries = manifest.entries, {}
+    used_names = set(entry[3] for entry in old_entries.values())
+    seen = set()
+
+    # directories are created and plain files copied up front, encryption goes to the workers
+    tasks = []
     for root, folders, files in os.walk(path):
         if root == path or '.' not in os.path.relpath(root, path):
             newpath = os.path.join(outputpath, os.path.relpath(root, path))
@@ -41,20 +88,110 @@ def encryptProject(path, outputpath=None):
 
             for file in files:
                 filepath = os.path.join(root, file)
+                name = archiveName(path, filepath)
+                seen.add(name)
                 try:
                     ext = file.rsplit('.', 1)[1]
                     if ext in ext_whitelist:
-                        print("Encrypting file '{}' to '{}'".format(filepath, newpath))
-                        ret = encryptFile(filepath, keypath, newpath)
-                        if ret:
-                            ERRORS = True
-                            os.remove(ret)
-                    else:
-                        copyFile(filepath, newpath, ext)
+                        entry = old_entries.get(name)
+                        # a plain copy (no hash) is encrypted under a new name
+                        if entry and (entry[2] is None or not os.path.exists(os.path.join(newpath, entry[3]))):
+                            entry = None
+                        if entry and tuple(entry[:2]) == fileState(filepath):
+                            manifest.entries[name] = entry
+                        elif entry:
+                            tasks.append((filepath, newpath, entry[3], entry[2]))
+                        else:
+                            rndname = "{}.bin".format(randomString())
+                            while rndname in used_names:
+                                rndname = "{}.bin".format(randomString())
+                            used_names.add(rndname)
+                            tasks.append((filepath, newpath, rndname, None))
+                    elif copyFile(filepath, newpath, ext):
+                        # recorded so the copy is removed with its source
+                        manifest.entries[name] = list(fileState(filepath)) + [None, file]
                 except IndexError:
-                    copyFile(filepath, newpath)
+                    if copyFile(filepath, newpath):
+                        manifest.entries[name] = list(fileState(filepath)) + [None, file]
+
+    failures = []
+    openSession()
+    # taken before the workers fork, they would count the loading of the key again
+    timings = keys.takeTimings()
+    try:
+        for (filepath, newpath, rndname, old_hash), (error, task_timings, entry) in runTasks(encryptTask, tasks, jobs, openSession):
+            name = archiveName(path, filepath)
+            addTimings(timings, task_timings)
+            if error:
+                print("[Warning] File '{}' couldn't be encrypted ({})".format(filepath, error))
+                failures.append((filepath, error))
+                continue
+            if entry[2] != old_hash:
+                print("Encrypting file '{}' to '{}'".format(filepath, newpath))
+            manifest.entries[name] = entry
+    finally:
+        addTimings(timings, keys.takeTimings())
+        keys.close()
+        keys = None
+
+        for name, entry in old_entries.items():
+            output = os.path.join(outputpath, *name.split('/')[:-1] + [entry[3]])
+            current = manifest.entries.get(name)
+            if current is None and name in seen:
+                # not encrypted again (failed or interrupted), the previous output is still there
+                if os.path.exists(output):
+                    manifest.entries[name] = entry
+            elif (current is None or current[3] != entry[3]) and os.path.exists(output):
+                # the file was deleted since the last run, or went from copied to encrypted or back
+                print("Removing '{}', its source is gone or is stored differently".format(output))
+                os.remove(output)
+        manifest.save()
+
+        if not loaded:
+            # without a manifest, the outputs of the previous runs aren't known
+            orphans, others = orphanOutputs(outputpath, path, manifest.entries)
+            for output in orphans:
+                print("Removing '{}', left by a previous run".format(output))
+                os.remove(output)
+            if others:
+                print("[Warning] {} files in '{}' may be left by a run of an older version, they will "
+                      "be decrypted along with the new outputs:".format(len(others), outputpath))
+                for output in others:
+                    print("    {}".format(output))
+
+    return outputpath, failures, timings
+
+
+def archiveProject(path, outputpath=None):
+    # packs the project in a single archive (see archive.py), with a single RSA key wrap
+    # returns the archive path, the list of (filepath, reason) of the files that failed and the timings
+    assert os.path.exists(path), "Path doesn't exist."
+    assert os.path.isdir(path), "Path isn't a directory"
 
-    return outputpath
+    if not outputpath:
+        suffix = "_encrypted.bin"
+        outputpath = path[:-1] + suffix if path[-1] == '/' else path + suffix
+
+    failures = []
+    with KeySession(keypath) as keys:
+        with ArchiveWriter(outputpath, keys) as archive:
+            for root, folders, files in os.walk(path):
+                if root == path or '.' not in os.path.relpath(root, path):
+                    for file in files:
+                        filepath = os.path.join(root, file)
+                        # the files that would have been encrypted or copied, all of them encrypted
+                        ext = file.rsplit('.', 1)[1] if '.' in file else None
+                        if ext not in ext_whitelist and (ext in ext_blacklist or file[0] == '.'):
+                            continue
+                        print("Archiving file '{}'".format(filepath))
+                        try:
+                            archive.add(filepath, archiveName(path, filepath))
+                        except OSError as e:
+                            print("[Warning] File '{}' couldn't be archived ({})".format(filepath, e))
+                            failures.append((filepath, "{}: {}".format(type(e).__name__, e)))
+        timings = keys.takeTimings()
+
+    return outputpath, failures, timings
 
 
 def cleanDirectory(path):
@@ -66,10 +203,21 @@ def cleanDirectory(path):
 if __name__ == "__main__":
     import sys
 
-    assert len(sys.argv) == 2 or len(sys.argv) == 3
-    cleanDirectory(encryptProject(*sys.argv[1:]))
+    args = sys.argv[1:]
+    jobs = parseJobs(args)
+    archive = '-a' in args or '--archive' in args
+    args = [arg for arg in args if arg not in ('-a', '--archive')]
+    assert len(args) == 1 or len(args) == 2, "Must provide 'path', optionally 'outputpath', '-j jobs' (0 for one per core) or '-a' for a single archive."
+    if archive:
+        outputpath, failures, timings = archiveProject(*args)
+    else:
+        outputpath, failures, timings = encryptProject(*args, jobs=jobs)
+        cleanDirectory(outputpath)
+    print(formatTimings(timings))
 
-    if ERRORS:
+    if failures:
         print("*Finished with errors*")
+        for filepath, error in failures:
+            print("    {} : {}".format(filepath, error))
     else:
         print("Done")
@@ -1,24 +1,60 @@
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Cipher import AES
+from container import isContainer, ContainerReader
+from keysession import KeySession, wipe
 import os
+import time
 
 
-def decryptFile(filepath, private_key_path, passphrase, outputpath=None):
+def decryptFile(filepath, private_key_path, passphrase, outputpath=None, keys=None):
+    # keys : KeySession shared by the files of a run, the private key is only unlocked without it
+    if keys is None:
+        with KeySession(private_key_path=private_key_path, passphrase=passphrase) as keys:
+            return decryptFile(filepath, private_key_path, passphrase, outputpath, keys)
+
+    start = time.perf_counter()
+    path, rndname = os.path.split(filepath)
+    if outputpath: path = outputpath
+
     with open(filepath, 'rb') as crypt_f:
-        private_key = RSA.import_key(open(private_key_path).read(), passphrase=passphrase)
+        if not isContainer(crypt_f):
+            decryptLegacyFile(crypt_f, keys, path)
+            keys.fileDone(time.perf_counter() - start)
+            return
+
+        with ContainerReader(crypt_f, keys) as reader:
+            # the name comes from the file, it must not point outside of path
+            name = os.path.basename(reader.metadata.get('name', ''))
+            if name in ('', '.', '..'):
+                raise ValueError("Invalid file name")
+
+            # written next to its final name and renamed once every chunk is verified
+            part = os.path.join(path, ".{}.part".format(name))
+            try:
+                with open(part, 'wb') as f:
+                    for chunk in reader.chunks():
+                        f.write(chunk)
+                os.replace(part, os.path.join(path, name))
+            except BaseException:
+                if os.path.exists(part):
+                    os.remove(part)
+                raise
 
-        enc_session_key, nonce, tag, ciphertext = [crypt_f.read(x) for x in (private_key.size_in_bytes(), 16, 16, -1)]
-        cipher_rsa = PKCS1_OAEP.new(private_key)
-        session_key = cipher_rsa.decrypt(enc_session_key)
+    keys.fileDone(time.perf_counter() - start)
 
+
+def decryptLegacyFile(crypt_f, keys, path):
+    # files encrypted before the streaming container: the whole text in a single EAX message
+    enc_session_key, nonce, tag, ciphertext = [crypt_f.read(x) for x in (keys.keySize(), 16, 16, -1)]
+    session_key = keys.unwrapKey(enc_session_key)
+
+    try:
         cipher_aes = AES.new(session_key, AES.MODE_EAX, nonce)
         data, name = cipher_aes.decrypt_and_verify(ciphertext, tag).decode().rsplit('&filename=', 1)
+    finally:
+        wipe(session_key)
 
-        path, rndname = os.path.split(filepath)
-        if outputpath: path = outputpath
-
-        with open(os.path.join(path, name), 'w') as f:
-            f.write(data)
+    with open(os.path.join(path, os.path.basename(name)), 'w') as f:
+        f.write(data)
 
 if __name__ == "__main__":
     import sys
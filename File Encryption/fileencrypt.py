@@ -1,8 +1,8 @@
-from Crypto.PublicKey import RSA
-from Crypto.Random import get_random_bytes
-from Crypto.Cipher import AES, PKCS1_OAEP
+from container import encryptStream
+from keysession import KeySession
 import os
 import random
+import time
 
 session_history = []
 ascii_list = [i for i in range(65, 91)]
@@ -25,30 +25,50 @@ def randomString():
 
     return rndstr
 
-def encryptFile(filepath, public_key_path, outputpath=None):
-    with open(filepath, 'r') as in_file:
-        path, name = os.path.split(filepath)
 
-        if outputpath: path = outputpath
-        rndname = "{}.bin".format(randomString())
-        with open(os.path.join(path, rndname), 'wb') as out_file:
-            recipient_key = RSA.import_key(open(public_key_path).read())
-            session_key = get_random_bytes(16)
-
-            cipher_rsa = PKCS1_OAEP.new(recipient_key)
-            out_file.write(cipher_rsa.encrypt(session_key))
-
-            cipher_aes = AES.new(session_key, AES.MODE_EAX)
-            try:
-                data = in_file.read() + "&filename={}".format(name)
-            except UnicodeDecodeError:
-                print("[Warning] Encountered UnicodeDecodeError while parsing file {}".format(filepath))
-                return os.path.join(path, rndname)
-
-            ciphertext, tag = cipher_aes.encrypt_and_digest(data.encode())
-
-            [out_file.write(x) for x in (cipher_aes.nonce, tag, ciphertext)]
+class HashingReader:
+    # reads through in_file and hashes what is read, so a file is hashed by its encryption pass
+    def __init__(self, in_file, digest):
+        self.in_file = in_file
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self.in_file.read(size)
+        self.digest.update(data)
+        return data
+
+def encryptFile(filepath, public_key_path, outputpath=None, keys=None, rndname=None, digest=None, old_hash=None):
+    # keys : KeySession shared by the files of a run, public_key_path is only loaded without it
+    # rndname : name of the output, a random one by default
+    # digest : hashlib object updated with the content of the file as it is encrypted
+    # old_hash : hex digest of the version in the existing output, kept as it is when they match
+    if keys is None:
+        with KeySession(public_key_path) as keys:
+            return encryptFile(filepath, public_key_path, outputpath, keys, rndname, digest, old_hash)
+
+    start = time.perf_counter()
+    path, name = os.path.split(filepath)
+
+    if outputpath: path = outputpath
+    if not rndname: rndname = "{}.bin".format(randomString())
+
+    # streamed in binary chunks, see container.py for the format, and renamed once complete
+    part = os.path.join(path, ".{}.part".format(rndname))
+    with open(part, 'wb') as out_file:
+        try:
+            with open(filepath, 'rb') as in_file:
+                encryptStream(in_file if digest is None else HashingReader(in_file, digest), out_file, keys,
+                              {'name': name})
+        except OSError as e:
+            print("[Warning] Encountered {} while reading file {}".format(type(e).__name__, filepath))
+            return part
+    if old_hash is not None and digest.hexdigest() == old_hash:
+        # only the size or mtime changed
+        os.remove(part)
+    else:
+        os.replace(part, os.path.join(path, rndname))
 
+    keys.fileDone(time.perf_counter() - start)
     return 0
 
 
@@ -0,0 +1,97 @@
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_OAEP
+import time
+
+
+class KeySession:
+    # RSA keys loaded once for a whole run, with their OAEP ciphers ready to wrap and unwrap
+    # the AES session keys of the files. Unlocking the private key runs scrypt, which is slow
+    # on purpose, so it must not be done once per file.
+    def __init__(self, public_key_path=None, private_key_path=None, passphrase=None):
+        assert public_key_path or private_key_path, "Must provide a public or a private key."
+        # cumulative seconds, see takeTimings
+        self.timings = {'load': 0.0, 'wrap': 0.0, 'unwrap': 0.0, 'files': 0.0}
+        self.files = 0
+        self.public_key = self.private_key = None
+        self._encrypter = self._decrypter = None
+
+        start = time.perf_counter()
+        if private_key_path:
+            self.private_key = RSA.import_key(open(private_key_path).read(), passphrase=passphrase)
+            self._decrypter = PKCS1_OAEP.new(self.private_key)
+        if public_key_path:
+            self.public_key = RSA.import_key(open(public_key_path).read())
+        elif self.private_key is not None:
+            self.public_key = self.private_key.publickey()
+        self._encrypter = PKCS1_OAEP.new(self.public_key)
+        self.timings['load'] += time.perf_counter() - start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._encrypter is None
+
+    def keySize(self):
+        # size of a wrapped key, in bytes
+        return self.public_key.size_in_bytes()
+
+    def wrapKey(self, session_key):
+        if self.closed:
+            raise ValueError("Key session is closed")
+        start = time.perf_counter()
+        wrapped_key = self._encrypter.encrypt(bytes(session_key))
+        self.timings['wrap'] += time.perf_counter() - start
+        return wrapped_key
+
+    def unwrapKey(self, wrapped_key):
+        # returns a bytearray, so the caller can wipe it with wipe() once done
+        if self.closed:
+            raise ValueError("Key session is closed")
+        if self._decrypter is None:
+            raise ValueError("Key session has no private key")
+        start = time.perf_counter()
+        session_key = bytearray(self._decrypter.decrypt(wrapped_key))
+        self.timings['unwrap'] += time.perf_counter() - start
+        return session_key
+
+    def fileDone(self, seconds):
+        self.files += 1
+        self.timings['files'] += seconds
+
+    def takeTimings(self):
+        # returns the timings since the last call and starts over, to sum those of several workers
+        timings, self.timings = self.timings, dict.fromkeys(self.timings, 0.0)
+        timings['count'], self.files = self.files, 0
+        return timings
+
+    def close(self):
+        # Python integers can't be overwritten in place: the best that can be done for the RSA
+        # keys is to drop every reference to them. The AES session keys are wiped by their users.
+        self.public_key = self.private_key = None
+        self._encrypter = self._decrypter = None
+
+
+def wipe(buffer):
+    # overwrites a bytearray holding key material
+    buffer[:] = bytes(len(buffer))
+
+
+def addTimings(total, timings):
+    for key, value in timings.items():
+        total[key] = total.get(key, 0) + value
+    return total
+
+
+def formatTimings(timings):
+    count = timings.get('count', 0)
+    text = "Keys loaded in {:.2f}s, {} files in {:.2f}s".format(timings['load'], count, timings['files'])
+    if count:
+        rsa = timings['wrap'] + timings['unwrap']
+        text += " ({:.1f} ms per file, {:.1f} ms of it for RSA)".format(timings['files'] / count * 1000,
+                                                                        rsa / count * 1000)
+    return text
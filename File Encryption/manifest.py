@@ -0,0 +1,139 @@
+"""
+Manifest of a project encrypted by encrypt_project, kept in the output directory
+(MANIFEST_NAME), so a later run only encrypts again the files that changed.
+
+    header : MAGIC, format version, HKDF salt, chunk size
+    data   : JSON {relative path: [size, mtime_ns, sha256, output name]}, in chunks
+             sealed like in container.py. Files copied as they are have no sha256,
+             their output name is their own name.
+
+encrypt_project only has the public key, which can't open anything, so the
+manifest is sealed with a local key (defaultKeyPath(), in the user's config
+directory, created on first use). Every save derives a new key from it with HKDF
+and a new salt. Without the local key the manifest can't be read: every file is
+encrypted again and the outputs of the previous runs are found with
+orphanOutputs().
+"""
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Random import get_random_bytes
+from container import CHUNK_SIZE, KEY_SIZE, Sealer, sealChunks, openChunks, readFull, isContainer
+from keysession import wipe
+import hashlib
+import io
+import json
+import os
+import re
+import struct
+
+MANIFEST_NAME = "_manifest.fenc"
+MAGIC = b"FMAN"
+VERSION = 1
+SALT_SIZE = 16
+
+# magic, version, salt, chunk size
+HEADER = struct.Struct(">4sB16sI")
+PREFIX = bytes(7)
+# names given to the outputs by fileencrypt.randomString
+OUTPUT_NAME = re.compile(r"^[A-Za-z0-9]{16}\.bin$")
+
+
+def defaultKeyPath():
+    # outside of the project and of the outputs, which are shared or backed up
+    config = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(config, "fileencrypt", "manifest_key.bin")
+
+
+def localKey(key_path):
+    # reads the local manifest key, created when missing
+    if os.path.exists(key_path):
+        with open(key_path, 'rb') as f:
+            return bytearray(f.read())
+    key = get_random_bytes(KEY_SIZE)
+    os.makedirs(os.path.dirname(key_path), mode=0o700, exist_ok=True)
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return bytearray(key)
+
+
+def fileState(filepath):
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def newDigest():
+    # hash of the content of the files kept in the entries
+    return hashlib.sha256()
+
+
+def orphanOutputs(outputpath, path, entries):
+    # files left in outputpath by runs whose manifest can't be read: referenced by no entry,
+    # with no source file of that name (a plain copy of a file that still exists)
+    # returns the containers and plain copies, which are safe to remove, and the files named
+    # like an output that aren't containers (older format)
+    known = set(os.path.join(outputpath, *name.split('/')[:-1] + [entry[3]]) for name, entry in entries.items())
+    known.add(os.path.join(outputpath, MANIFEST_NAME))
+    orphans, others = [], []
+    for root, folders, files in os.walk(outputpath):
+        for file in files:
+            filepath = os.path.join(root, file)
+            if filepath in known or os.path.exists(os.path.join(path, os.path.relpath(filepath, outputpath))):
+                continue
+            if not OUTPUT_NAME.match(file):
+                orphans.append(filepath)
+                continue
+            with open(filepath, 'rb') as f:
+                (orphans if isContainer(f) else others).append(filepath)
+    return orphans, others
+
+
+def _sealer(local_key, salt, header):
+    key = bytearray(HKDF(local_key, KEY_SIZE, salt, SHA256, context=MAGIC))
+    return Sealer(key, PREFIX, header)
+
+
+class Manifest:
+    def __init__(self, path, key_path):
+        self.path = path
+        self.key_path = key_path
+        self.entries = {}
+
+    def load(self):
+        # returns False when there is no manifest, raises ValueError when it can't be read
+        if not os.path.exists(self.path):
+            return False
+        if not os.path.exists(self.key_path):
+            raise ValueError("Missing manifest key '{}'".format(self.key_path))
+        local_key = localKey(self.key_path)
+        with open(self.path, 'rb') as f:
+            header = readFull(f, HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError("Truncated manifest")
+            magic, version, salt, chunk_size = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("Not a manifest, or an unsupported version")
+            sealer = _sealer(local_key, salt, header)
+            try:
+                data = b"".join(openChunks(sealer, f, chunk_size))
+            finally:
+                sealer.close()
+                wipe(local_key)
+        self.entries = json.loads(data.decode())
+        return True
+
+    def save(self):
+        # written to a temporary file renamed over the old one
+        local_key = localKey(self.key_path)
+        salt = get_random_bytes(SALT_SIZE)
+        header = HEADER.pack(MAGIC, VERSION, salt, CHUNK_SIZE)
+        sealer = _sealer(local_key, salt, header)
+        part = self.path + ".part"
+        try:
+            with open(part, 'wb') as f:
+                f.write(header)
+                sealChunks(sealer, io.BytesIO(json.dumps(self.entries).encode()), f, CHUNK_SIZE)
+            os.replace(part, self.path)
+        finally:
+            sealer.close()
+            wipe(local_key)
@@ -0,0 +1,38 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+
+def jobCount(jobs):
+    # 0 means one job per core the process may run on
+    if jobs > 0:
+        return jobs
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def runTasks(function, tasks, jobs=1, initializer=None, initargs=()):
+    # yields (task, result) in the order of the tasks, whatever the order they finish in
+    jobs = min(jobCount(jobs), len(tasks))
+    if jobs <= 1:
+        if initializer: initializer(*initargs)
+        for task in tasks:
+            yield task, function(task)
+        return
+
+    # processes rather than threads: the work is CPU bound and would be serialized by the GIL
+    with ProcessPoolExecutor(jobs, initializer=initializer, initargs=initargs) as pool:
+        for task, result in zip(tasks, pool.map(function, tasks)):
+            yield task, result
+
+
+def parseJobs(args):
+    # removes '-j N' or '--jobs N' from args, returns N (1 when absent)
+    for flag in ('-j', '--jobs'):
+        if flag in args:
+            i = args.index(flag)
+            assert i + 1 < len(args) and args[i + 1].isdigit(), "'{}' must be followed by a number of jobs.".format(flag)
+            jobs = int(args[i + 1])
+            del args[i:i + 2]
+            return jobs
+    return 1
@@ -0,0 +1,200 @@
+"""
+aiosync.py
+last modified : 18 october 2026
+
+Asyncio engine for mcopy, meant for high-latency network mounts (SMB, NFS) where
+every listing, stat or open is a round-trip. Those operations are sent to a thread
+pool with bounded concurrency so their latencies overlap instead of adding up, and
+in run() the copies start as soon as the comparison of their directory is done
+instead of waiting for the whole tree to be scanned.
+"""
+import os, time, asyncio
+from concurrent.futures import ThreadPoolExecutor
+from mcopy import SyncJob, CopyPlan
+
+DEFAULT_CONCURRENCY = 16
+
+def dirMtimes(src_root, trgt_root, trgt_exists):
+    src_mtime_ns = os.stat(src_root).st_mtime_ns
+    trgt_mtime_ns = os.stat(trgt_root).st_mtime_ns if trgt_exists else None
+    return src_mtime_ns, trgt_mtime_ns
+
+def statEntry(entry):
+    #DirEntry keeps the result, planDir won't stat it again
+    try:
+        entry.stat()
+    except OSError:
+        pass
+
+class AsyncSyncJob(SyncJob):
+    """
+    SyncJob dont les operations sur le systeme de fichiers passent par asyncio.
+    'concurrency' borne le nombre d'operations en cours en meme temps.
+    run() enchaine analyse et copie en pipeline, sauf avec both_ways, dedup ou dry_run
+    qui ont besoin du plan complet avant de copier. plan() et execute() donnent les
+    memes resultats que ceux de SyncJob.
+    """
+    def __init__(self, source, target, concurrency=DEFAULT_CONCURRENCY, **config):
+        SyncJob.__init__(self, source, target, **config)
+        self.concurrency = max(1, concurrency)
+        self._executor = None
+        self._sem = None
+
+    def _runLoop(self, coro_func, *args):
+        async def main():
+            self._sem = asyncio.Semaphore(self.concurrency)
+            return await coro_func(*args)
+
+        self._executor = ThreadPoolExecutor(self.concurrency)
+        try:
+            return asyncio.run(main())
+        finally:
+            self._executor.shutdown()
+            self._executor = None
+            self._sem = None
+
+    async def _io(self, func, *args):
+        async with self._sem:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def run(self):
+        """
+        Analyse et copie en pipeline. Retourne un SyncStats.
+        """
+        if self.both_ways or self.dedup or self.dry_run:
+            return SyncJob.run(self)
+
+        self._prepare()
+        plan = CopyPlan(self.source, self.target)
+        self.plans = [plan]
+        try:
+            with self._timer('pipeline'):
+                self._runLoop(self._pipeline, plan)
+        except BaseException:
+            self._interrupted()
+            raise
+        #copied files were not in the listing taken before copying them
+        for action in plan.files:
+            plan.listing.setdefault(os.path.dirname(action.target), set()).add(action.name)
+        self._afterPlan()
+        if self.mirror and (plan.extra_dirs or plan.extra_files):
+            self.message("--- cleaning target directory ---")
+            self.stats.dirs_deleted, self.stats.files_deleted = self.cleanTargetDir(plan)
+        self.stats.num_bytes = plan.num_bytes
+        self._finish()
+        return self.stats
+
+    def planCopy(self, source, target, src_log, snap=None):
+        plan = CopyPlan(source, target)
+        self._runLoop(self._scan, plan, src_log, snap, None)
+        if self.dedup:
+            self.dedupPlan(plan)
+        return plan
+
+    def recursiveCopy(self, plan, src_log, trgt_log):
+        self._runLoop(self._apply, plan, src_log, trgt_log)
+        return (self.stats.dirs_created, self.stats.files_copied)
+
+    async def _pipeline(self, plan):
+        queue = asyncio.Queue()
+        workers = [asyncio.ensure_future(self._copyWorker(queue, self.src_log, self.trgt_log))
+                   for i in range(self.concurrency)]
+        try:
+            await self._scan(plan, self.src_log, self.snap, queue)
+        finally:
+            for worker in workers:
+                queue.put_nowait(None)
+            await asyncio.gather(*workers)
+
+    async def _scan(self, plan, src_log, snap, queue):
+        trgt_exists = await self._io(os.path.isdir, plan.target)
+        await self._scanDir(plan, ("", plan.source, plan.target, trgt_exists), src_log, snap, queue)
+
+    async def _scanDir(self, plan, pair, src_log, snap, queue):
+        rel_dir, src_root, trgt_root, trgt_exists = pair
+        src_mtime_ns = None
+        if snap is not None:
+            plan.visited.append(rel_dir)
+            src_mtime_ns, trgt_mtime_ns = await self._io(dirMtimes, src_root, trgt_root, trgt_exists)
+            subdirs = self.skipDir(plan, snap, rel_dir, src_root, trgt_root, src_mtime_ns, trgt_mtime_ns)
+            if subdirs is not None:
+                await self._scanSubdirs(plan, subdirs, src_log, snap, queue)
+                return
+
+        if trgt_exists:
+            src_entries, trgt_entries = await asyncio.gather(self._io(self.scanDir, src_root),
+                                                             self._io(self.scanDir, trgt_root))
+        else:
+            src_entries, trgt_entries = await self._io(self.scanDir, src_root), []
+        names = set(entry.name for entry in src_entries if self.needsStat(entry, rel_dir))
+        await asyncio.gather(*[self._io(statEntry, entry) for entry in src_entries+trgt_entries
+                               if entry.name in names])
+
+        first = len(plan.files)
+        subdirs = self.planDir(plan, rel_dir, src_root, trgt_root, src_entries, trgt_entries,
+                               src_log, src_mtime_ns)
+        if queue is not None:
+            self._queue(queue, plan.files[first:])
+        await self._scanSubdirs(plan, subdirs, src_log, snap, queue)
+
+    async def _scanSubdirs(self, plan, subdirs, src_log, snap, queue):
+        tasks = []
+        for subdir in subdirs:
+            if queue is not None and not subdir[3]:
+                #in the pipeline, a directory must exist before its files are queued
+                await self._mkdir(subdir[2])
+            tasks.append(self._scanDir(plan, subdir, src_log, snap, queue))
+        await asyncio.gather(*tasks)
+
+    def _queue(self, queue, actions):
+        if not actions:
+            return
+        num_bytes = sum(action.size for action in actions)
+        if self._total == 0:
+            self._start(len(actions), num_bytes)
+            self.message("--- copying files from source ---")
+        else:
+            self._total += len(actions)
+            self._total_bytes += num_bytes
+        for action in actions:
+            queue.put_nowait(action)
+
+    async def _mkdir(self, path):
+        await self._io(os.mkdir, path)
+        self.message("created target path : "+path)
+        self.stats.dirs_created += 1
+
+    async def _copyWorker(self, queue, src_log, trgt_log):
+        while True:
+            action = await queue.get()
+            if action is None:
+                return
+            copied = await self._io(self.doCopyFile, action, src_log)
+            self._copied(action, copied, trgt_log)
+
+    def _copied(self, action, copied, trgt_log):
+        with self.lock:
+            if copied:
+                self.stats.files_copied += 1
+                trgt_log[action.target] = time.time()
+            self._advance(action)
+
+    async def _apply(self, plan, src_log, trgt_log):
+        #parents come before their children, directories of the same depth are created together
+        by_depth = {}
+        for path in plan.dirs:
+            by_depth.setdefault(path.count(os.sep), []).append(path)
+        for depth in sorted(by_depth):
+            await asyncio.gather(*[self._mkdir(path) for path in by_depth[depth]])
+
+        queue = asyncio.Queue()
+        for action in plan.files:
+            queue.put_nowait(action)
+        for i in range(self.concurrency):
+            queue.put_nowait(None)
+        await asyncio.gather(*[self._copyWorker(queue, src_log, trgt_log) for i in range(self.concurrency)])
+
+        #duplicates may point to files copied just above
+        for action in plan.links:
+            copied = await self._io(self.doLinkFile, action, src_log)
+            self._copied(action, copied, trgt_log)
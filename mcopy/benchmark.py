@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+benchmark.py
+last modified : 18 october 2026
+
+Benchmark for mcopy on synthetic trees generated locally. Every scenario runs in
+its own process (so the peak RSS is its own) and is synchronised twice: a first
+run that copies everything, then a run where everything is up to date. Planning,
+copying, cleanTargetDir, cleanLogs and the history I/O are timed separately.
+
+syntax  : benchmark.py [--scale 1.0] [--dir /tmp] [--keep] [-o results.json] [scenario ...]
+example : benchmark.py --scale 0.1 tiny deep
+
+scenarios : tiny  : many 1-4 KB files
+            huge  : a few files of several hundred MB
+            deep  : deep nesting, few files per directory
+            mixed : mixed extensions and sizes, copied with an exclusive extension filter
+            log   : tiny files with a large pre-populated _mcopy.log, half of it stale
+All scenarios are mirrored (-d) with extra files and directories in the target,
+deleted permanently rather than trashed.
+"""
+import os, sys, time, json, shutil, tempfile, platform, resource, subprocess
+from mcopy import SyncJob
+
+BLOCK = os.urandom(1024*1024)
+
+def writeFile(path, size):
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(BLOCK[:min(size, len(BLOCK))])
+            size -= len(BLOCK)
+
+def makeExtras(target, dirs, files_per_dir):
+    for i in range(dirs):
+        path = os.path.join(target, "extra%03d" % i)
+        os.makedirs(path)
+        for j in range(files_per_dir):
+            writeFile(os.path.join(path, "old%d.bin" % j), 1024)
+        writeFile(os.path.join(target, "extra%03d.bin" % i), 1024)
+
+def makeTiny(root, scale):
+    source = os.path.join(root, "src")
+    count = max(int(20000*scale), 1)
+    for i in range(count):
+        path = os.path.join(source, "d%03d" % (i % 200))
+        if i < 200:
+            os.makedirs(path)
+        writeFile(os.path.join(path, "f%06d.txt" % i), 1024*(1+i % 4))
+    return {}
+
+def makeHuge(root, scale):
+    source = os.path.join(root, "src")
+    os.makedirs(source)
+    for i in range(4):
+        writeFile(os.path.join(source, "huge%d.bin" % i), max(int(256*1024*1024*scale), 1))
+    return {}
+
+def makeDeep(root, scale):
+    source = os.path.join(root, "src")
+    for chain in range(max(int(20*scale), 1)):
+        path = os.path.join(source, "chain%02d" % chain)
+        for depth in range(64):
+            path = os.path.join(path, "level%02d" % depth)
+            os.makedirs(path)
+            for i in range(4):
+                writeFile(os.path.join(path, "f%d.dat" % i), 4096)
+    return {}
+
+def makeMixed(root, scale):
+    source = os.path.join(root, "src")
+    exts = ["wav", "aif", "mp3", "txt", "jpg", "py", "tmp", "log", ""]
+    count = max(int(10000*scale), 1)
+    for i in range(count):
+        path = os.path.join(source, "d%02d" % (i % 50))
+        if i < 50:
+            os.makedirs(path)
+        ext = exts[i % len(exts)]
+        name = "file%05d" % i+("."+ext if ext else "")
+        writeFile(os.path.join(path, name), (i % 7)**4*512+100)
+    return {'ext_mode': 'e', 'ext': ["tmp", "log"]}
+
+def makeLog(root, scale):
+    config = makeTiny(root, scale)
+    #history of a target that already received every file once, plus as many entries for gone files
+    target = os.path.join(root, "dst")
+    source = os.path.join(root, "src")
+    os.makedirs(target)
+    job = SyncJob(source, target)
+    now = time.time()
+    for dir_path, dirs, files in os.walk(source):
+        rel = os.path.relpath(dir_path, source)
+        for name in files:
+            job.trgt_log[os.path.normpath(os.path.join(target, rel, name))] = now-3600
+            job.trgt_log[os.path.normpath(os.path.join(target, rel, "gone_"+name))] = now-7200
+    job.writeLogsToDisk()
+    return config
+
+scenarios = {'tiny': makeTiny, 'huge': makeHuge, 'deep': makeDeep, 'mixed': makeMixed, 'log': makeLog}
+
+def treeStats(path):
+    files, num_bytes = 0, 0
+    for dir_path, dirs, names in os.walk(path):
+        for name in names:
+            files += 1
+            num_bytes += os.lstat(os.path.join(dir_path, name)).st_size
+    return files, num_bytes
+
+def timePhases(job):
+    """
+    Execute un SyncJob etape par etape et retourne la duree de chacune, en secondes.
+    """
+    times = {}
+    clock = time.perf_counter()
+    def lap(name):
+        nonlocal clock
+        now = time.perf_counter()
+        times[name] = round(now-clock, 6)
+        clock = now
+
+    job._prepare()
+    lap('load_logs')
+    plan = job.planCopy(job.source, job.target, job.src_log, job.snap)
+    job.plans = [plan]
+    lap('plan')
+    job.cleanLogs(plan.listing)
+    lap('cleanLogs')
+    job.recursiveCopy(plan, job.src_log, job.trgt_log)
+    lap('copy')
+    job.cleanTargetDir(plan)
+    lap('cleanTargetDir')
+    job.writeLogsToDisk()
+    lap('write_logs')
+    times['total'] = round(sum(times.values()), 6)
+    return times, len(plan), plan.num_bytes, len(plan.extra_dirs)+len(plan.extra_files)
+
+def runScenario(name, root, scale):
+    """
+    Genere l'arborescence d'un scenario, la synchronise deux fois et retourne les resultats.
+    """
+    config = scenarios[name](root, scale)
+    source = os.path.join(root, "src")
+    target = os.path.join(root, "dst")
+    files, num_bytes = treeStats(source)
+    os.makedirs(target, exist_ok=True)
+    makeExtras(target, 20, 10)
+
+    result = {'scenario': name, 'files': files, 'bytes': num_bytes, 'runs': []}
+    for run in ('initial', 'up_to_date'):
+        job = SyncJob(source, target, mirror=True, trash=False, **config)
+        times, copied, copied_bytes, deleted = timePhases(job)
+        result['runs'].append({
+            'run': run, 'times': times, 'files_copied': copied, 'bytes_copied': copied_bytes,
+            'entries_deleted': deleted,
+            #scanned files per second over the whole run, copied data over the copy phase
+            'files_per_s': round(files/times['total'], 1) if times['total'] > 0 else None,
+            'mb_per_s': round(copied_bytes/times['copy']/1e6, 1) if times['copy'] > 0 and copied_bytes else None,
+        })
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+def gitVersion():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if '-h' in argv or '--help' in argv:
+        print(__doc__)
+        return 0
+    options = {'--scale': '1.0', '--dir': None, '-o': None, '--run': None}
+    for flag in options:
+        if flag in argv:
+            index = argv.index(flag)
+            argv.pop(index)
+            options[flag] = argv.pop(index)
+    keep = '--keep' in argv
+    if keep:
+        argv.remove('--keep')
+    scale = float(options['--scale'])
+
+    if options['--run'] is not None:
+        #child process, one scenario in an existing directory
+        print(json.dumps(runScenario(argv[0], options['--run'], scale)))
+        return 0
+
+    names = argv or sorted(scenarios)
+    for name in names:
+        if name not in scenarios:
+            print("unknown scenario : "+name)
+            return 1
+
+    results = {'version': gitVersion(), 'python': platform.python_version(), 'platform': platform.platform(),
+               'scale': scale, 'time': time.time(), 'scenarios': []}
+    for name in names:
+        root = tempfile.mkdtemp(prefix="mcopy-bench-"+name+"-", dir=options['--dir'])
+        try:
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run', root,
+                                              '--scale', str(scale), name])
+            result = json.loads(output.decode().splitlines()[-1])
+        finally:
+            if not keep:
+                shutil.rmtree(root)
+        results['scenarios'].append(result)
+        initial = result['runs'][0]
+        sys.stderr.write("%-6s %8d files  %8.1f MB  copy %7.3fs  %s MB/s  peak RSS %d KB\n"
+                         % (name, result['files'], result['bytes']/1e6, initial['times']['copy'],
+                            initial['mb_per_s'], result['peak_rss_kb']))
+
+    text = json.dumps(results, indent=2)
+    if options['-o'] is not None:
+        with open(options['-o'], 'w') as f:
+            f.write(text+'\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""
+checksum.py
+last modified : 18 october 2026
+
+Content hashing for mcopy's --checksum and --dedup modes. Files are hashed with
+BLAKE2b in 1 MB chunks and the digests are cached on disk (_mcopy.sums, in the
+target directory) under the file's device and inode, along with its size and
+mtime_ns. A file is only hashed again once one of those changes.
+"""
+import sqlite3, time, hashlib
+
+DIGEST_SIZE = 16
+CHUNK_SIZE = 1024*1024
+CACHE_EXPIRY = 30*24*3600 #entries not used for this long are dropped
+
+def fileDigest(path):
+    """
+    Calcule l'empreinte BLAKE2b d'un fichier, par blocs.
+    """
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.digest()
+
+class HashCache:
+    def __init__(self, path):
+        #a fan-out job is planned in a worker thread and executed in the main one, never both at once
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS sums (dev INTEGER, inode INTEGER, size INTEGER,
+                                                             mtime_ns INTEGER, digest BLOB, used INTEGER,
+                                                             PRIMARY KEY (dev, inode)) WITHOUT ROWID""")
+        self._now = int(time.time())
+        self.hashed = 0     #files actually read
+        self.cached = 0     #digests found in the cache
+
+    def digest(self, path, st):
+        """
+        Retourne l'empreinte d'un fichier dont on connait deja le stat,
+        en la prenant dans le cache si le fichier n'a pas change.
+        """
+        key = (st.st_dev, st.st_ino)
+        row = self._db.execute("SELECT size, mtime_ns, digest FROM sums WHERE dev = ? AND inode = ?", key).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            self._db.execute("UPDATE sums SET used = ? WHERE dev = ? AND inode = ?", (self._now,)+key)
+            self.cached += 1
+            return row[2]
+        digest = fileDigest(path)
+        self._db.execute("INSERT OR REPLACE INTO sums VALUES (?, ?, ?, ?, ?, ?)",
+                         key+(st.st_size, st.st_mtime_ns, digest, self._now))
+        self.hashed += 1
+        return digest
+
+    def close(self):
+        self._db.execute("DELETE FROM sums WHERE used < ?", (self._now-CACHE_EXPIRY,))
+        self._db.commit()
+        self._db.close()
@@ -1,6 +1,6 @@
 """
 console.py
-last modified : 4 april 2015
+last modified : 18 october 2026
 
 Some utility functions used with the terminal.
 """
@@ -56,17 +56,22 @@ class ProgressBar:
         self._max = max
         self._range = float(max-min)
         self._width = width-2
-        self._progress_bar_str = "[]"
+        self._progress_bar_str = None
         self.update(self._min)
         
     def __str__(self):
+        #only built when displayed, update() is called far more often than the bar is drawn
+        if self._progress_bar_str is None:
+            self._progress_bar_str = self._render()
         return self._progress_bar_str
         
     def update(self, value):
         self._value = value
         if value < self._min: self._value = self._min
         if value > self._max: self._value = self._max
+        self._progress_bar_str = None
         
+    def _render(self):
         done = int(self._value/self._range*self._width)
         togo = self._width - done
         
@@ -76,7 +81,7 @@ class ProgressBar:
         percentStart = int(self._width/2) - len(percent)
         percentEnd = percentStart+len(percent)
         
-        self._progress_bar_str = temp[:percentStart] + percent + temp[percentEnd:]
+        return temp[:percentStart] + percent + temp[percentEnd:]
         
     def setMin(self, min):
         self._min = min
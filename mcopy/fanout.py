@@ -0,0 +1,297 @@
+"""
+fanout.py
+last modified : 18 october 2026
+
+Fan-out synchronisation for mcopy (several targets on the command line): one
+source replicated to N targets in a single run.
+
+Every target has its own SyncJob (history, snapshot, journal), but the source is
+scanned once: the jobs plan in parallel and share the source listings through a
+SourceCache, DirEntry objects included, so every source file is stat'ed once. A
+file needed by several targets is read once and written to all of them
+(transfer.fanOutCopy). Files needed by a single target, block delta updates and
+duplicates go through that target's job as usual.
+
+Errors are isolated: a target that fails (disk full, drive unplugged) is
+abandoned with its error and the others go on. Progress events give the totals
+and, under 'targets', the progress of every target.
+"""
+import os, time, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import transfer
+from mcopy import SyncJob, delta_min_size, oldVersionName
+
+class SourceCache:
+    """
+    Listings des dossiers de la source, partages par les jobs des cibles.
+    Un listing est oublie des que tous les jobs l'ont lu.
+    """
+    def __init__(self, source, users):
+        self.source = source
+        self.users = users
+        self.lock = threading.Lock()
+        self._prefix = os.path.join(source, "")
+        self._listings = {}     #path -> [entries, reads]
+
+    def covers(self, path):
+        return path == self.source or path.startswith(self._prefix)
+
+    def get(self, path, scan):
+        with self.lock:
+            listing = self._listings.get(path)
+            if listing is None:
+                listing = self._listings[path] = [scan(path), 0]
+            listing[1] += 1
+            if listing[1] >= self.users:
+                del self._listings[path]
+        return listing[0]
+
+class TargetJob(SyncJob):
+    """
+    SyncJob d'une des cibles d'un FanOutJob : la source est listee par le SourceCache
+    et son historique est partage avec les autres cibles.
+    """
+    def __init__(self, owner, target, **config):
+        SyncJob.__init__(self, owner.source, target, **config)
+        self.owner = owner
+
+    def scanDir(self, path):
+        if self.owner.cache.covers(path):
+            return self.owner.cache.get(path, lambda path: SyncJob.scanDir(self, path))
+        return SyncJob.scanDir(self, path)
+
+    def readLog(self, root):
+        if root == self.source:
+            return self.owner.sourceLog(self)
+        return SyncJob.readLog(self, root)
+
+    def cleanLogs(self, listing=None, logs=None):
+        #the source history is shared, FanOutJob.plan cleans it once all the jobs are planned
+        SyncJob.cleanLogs(self, listing, logs or (self.trgt_log,))
+
+class FanOutJob:
+    """
+    Synchronise une source vers plusieurs cibles (voir plus haut). Prend les memes
+    parametres que SyncJob, sauf both_ways, avec la liste 'targets' au lieu de 'target'.
+    run() retourne les SyncStats des cibles ; 'errors' donne, pour chaque cible
+    abandonnee, l'erreur qui l'a arretee.
+    """
+    def __init__(self, source, targets, jobs=1, callback=None, **config):
+        if config.get('both_ways'):
+            raise ValueError("several targets are not available with both_ways")
+        self.source = source
+        self.targets = list(targets)
+        self.jobs = max(1, jobs)
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.errors = OrderedDict()    #target -> error text
+        self.cache = SourceCache(source, len(self.targets))
+        self.target_jobs = [TargetJob(self, target, jobs=jobs, callback=self._relay(target), **config)
+                            for target in self.targets]
+        first = self.target_jobs[0]
+        self.dry_run = first.dry_run
+        self.mirror = first.mirror
+        self.profiler = first.profiler
+        self.throttle = first.throttle
+        self._source_log = None
+
+    def emit(self, event, **info):
+        if self.callback is not None:
+            self.callback(event, info)
+
+    def message(self, text, colour=None, level=0):
+        self.emit('message', text=text, colour=colour, level=level)
+
+    def _relay(self, target):
+        #the messages of a target are prefixed with it, its progress is summed up by _copied
+        def relay(event, info):
+            if event == 'message':
+                self.message(target+" : "+info['text'], info['colour'], info['level'])
+        return relay
+
+    def _timer(self, name):
+        return self.target_jobs[0]._timer(name)
+
+    def sourceLog(self, job):
+        """
+        Historique de la source, lu une seule fois pour tous les jobs.
+        """
+        with self.lock:
+            if self._source_log is None:
+                self._source_log = SyncJob.readLog(job, self.source)
+            return self._source_log
+
+    def active(self):
+        return [job for job in self.target_jobs if job.target not in self.errors]
+
+    def abandon(self, job, error):
+        """
+        Abandonne une cible apres une erreur, en gardant l'historique de ce qui y a ete copie.
+        """
+        with self.lock:
+            if job.target in self.errors:
+                return
+            self.errors[job.target] = "%s: %s" % (type(error).__name__, error)
+        self.message(job.target+" : target abandoned, "+self.errors[job.target], "red", 2)
+        try:
+            if job.plans:
+                job._interrupted()
+            elif job.snap is not None:
+                job.snap.close()
+                job.snap = None
+        except Exception as e:
+            #the target is abandoned anyway, but its history may not have been saved
+            self.message(job.target+" : could not save the state of the target, %s: %s" % (type(e).__name__, e),
+                         "red", 2)
+
+    def run(self):
+        """
+        Analyse puis synchronise toutes les cibles. Retourne la liste de leurs SyncStats.
+        """
+        self.plan()
+        return self.execute()
+
+    def plan(self):
+        if not os.path.exists(self.source):
+            raise IOError("source path does not exist.")
+        #the jobs walk the source in the same order, a listing is read by all of them about together
+        with ThreadPoolExecutor(len(self.target_jobs)) as pool:
+            futures = dict((pool.submit(job.plan), job) for job in self.target_jobs)
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    self.abandon(futures[future], future.exception())
+        planned = [job for job in self.active() if job.plans]
+        if planned and self._source_log is not None:
+            listing = {}
+            for job in planned:
+                for plan in job.plans:
+                    listing.update(plan.listing)
+            with self._timer('log'):
+                SyncJob.cleanLogs(planned[0], listing, (self._source_log,))
+        return [job.plans for job in self.target_jobs]
+
+    def execute(self):
+        """
+        Copie vers toutes les cibles encore actives. Retourne la liste de leurs SyncStats.
+        """
+        if self.dry_run:
+            for job in self.active():
+                job.report()
+            return [job.stats for job in self.target_jobs]
+
+        #source file -> [(job, action)], in the order of the plans
+        groups = OrderedDict()
+        for job in self.active():
+            plan = job.plans[0]
+            for action in plan.files:
+                if action.kind == 'update' and job.overwrite and job.delta and action.size >= delta_min_size:
+                    #the old version is different on every target
+                    groups[(action.source, job.target)] = [(job, action)]
+                else:
+                    groups.setdefault(action.source, []).append((job, action))
+            job._start(len(plan), plan.num_bytes)
+        self.emit('start', total=sum(job._total for job in self.active()),
+                  total_bytes=sum(job._total_bytes for job in self.active()))
+
+        for job in self.active():
+            try:
+                for target_path in job.plans[0].dirs:
+                    job.message("created target path : "+target_path)
+                    os.mkdir(target_path)
+                    job.stats.dirs_created += 1
+            except Exception as e:
+                self.abandon(job, e)
+
+        try:
+            with self._timer('copy'):
+                if self.jobs > 1:
+                    with ThreadPoolExecutor(self.jobs) as pool:
+                        futures = [pool.submit(self.copyGroup, entries) for entries in groups.values()]
+                        try:
+                            for future in as_completed(futures):
+                                future.result()
+                        except BaseException:
+                            #only the copies already running are waited for
+                            for future in futures:
+                                future.cancel()
+                            raise
+                else:
+                    for entries in groups.values():
+                        self.copyGroup(entries)
+        except BaseException:
+            for job in self.active():
+                try:
+                    job._interrupted()
+                except Exception as e:
+                    self.message(job.target+" : could not save the state of the target, %s: %s"
+                                 % (type(e).__name__, e), "red", 2)
+            raise
+
+        for job in self.active():
+            try:
+                plan = job.plans[0]
+                for action in plan.links:
+                    if job.doLinkFile(action, job.src_log):
+                        self._copied(job, action)
+                if job.mirror and (plan.extra_dirs or plan.extra_files):
+                    job.message("--- cleaning target directory ---")
+                    job.stats.dirs_deleted, job.stats.files_deleted = job.cleanTargetDir(plan)
+                job.stats.num_bytes = plan.num_bytes
+                job._finish()
+            except Exception as e:
+                self.abandon(job, e)
+        return [job.stats for job in self.target_jobs]
+
+    def copyGroup(self, entries):
+        """
+        Copie un fichier de la source vers les cibles qui en ont besoin, en ne le lisant qu'une fois.
+        """
+        entries = [(job, action) for job, action in entries if job.target not in self.errors]
+        if len(entries) == 1:
+            job, action = entries[0]
+            try:
+                job.doCopyFile(action, job.src_log)
+            except Exception as e:
+                self.abandon(job, e)
+                return
+            self._copied(job, action)
+            return
+        if not entries:
+            return
+
+        job, action = entries[0]
+        self.message("copying file to %d targets : %s" % (len(entries), action.name), "cyan")
+        if action.logged:
+            job.src_log.pop(action.source, None)
+        targets = [(action.target, oldVersionName(action.target) if action.kind == 'update' and not job.overwrite
+                    else None) for job, action in entries]
+        start = time.perf_counter()
+        results = transfer.fanOutCopy(action.source, targets, self.throttle)
+        elapsed = time.perf_counter()-start
+        for index, ((job, action), result) in enumerate(zip(entries, results)):
+            if isinstance(result, Exception):
+                self.abandon(job, result)
+                continue
+            job.recordCopy('fanout', result, elapsed)
+            if self.profiler is not None:
+                #the source was read once, for the first target
+                self.profiler.record('copy', action.target, elapsed, bytes_read=result if index == 0 else 0,
+                                     bytes_written=result)
+            self._copied(job, action)
+
+    def _copied(self, job, action):
+        with job.lock:
+            job.stats.files_copied += 1
+            job.trgt_log[action.target] = time.time()
+            job._advance(action)
+        with self.lock:
+            targets = [{'target': job.target, 'files': job._progress, 'total': job._total,
+                        'bytes': job._bytes, 'total_bytes': job._total_bytes,
+                        'error': self.errors.get(job.target)} for job in self.target_jobs]
+        #abandoned targets are left out of the totals
+        active = [target for target in targets if target['error'] is None]
+        self.emit('progress', files=sum(target['files'] for target in active),
+                  total=sum(target['total'] for target in active),
+                  bytes=sum(target['bytes'] for target in active),
+                  total_bytes=sum(target['total_bytes'] for target in active), targets=targets)
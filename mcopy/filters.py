@@ -0,0 +1,169 @@
+"""
+filters.py
+last modified : 18 october 2026
+
+Include/exclude filter of mcopy. The rules are compiled once per run: extensions
+and literal names go in sets, glob patterns are merged into one regular
+expression per kind, so an entry is checked with a few set lookups and at most
+two regex matches whatever the number of rules.
+
+Patterns without '/' are matched against the entry name, patterns with '/'
+against its path relative to the synchronised directory. A pattern ending with
+'/' only matches directories. Excluded directories are pruned: they are neither
+walked, copied nor deleted. Include patterns only select files.
+
+Size and age predicates only apply to files and are checked once they are stat'ed.
+"""
+import os, re, time, fnmatch
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7*86400}
+
+def parseSize(text):
+    """
+    Convertit une taille comme 500K, 2M ou 1G en octets.
+    """
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    return int(float(text[:len(text)-len(unit)])*SIZE_UNITS[unit])
+
+def parseAge(text):
+    """
+    Convertit une duree comme 90s, 30m, 12h, 7d ou 2w en secondes (en secondes par defaut).
+    """
+    text = text.strip().lower()
+    if text[-1:] in AGE_UNITS:
+        return float(text[:-1])*AGE_UNITS[text[-1]]
+    return float(text)
+
+def _isGlob(pattern):
+    return any(c in pattern for c in '*?[')
+
+def _combine(patterns):
+    if not patterns:
+        return None
+    return re.compile("|".join("(?:%s)" % fnmatch.translate(pattern) for pattern in patterns))
+
+class Patterns:
+    """
+    Liste de motifs compilee : noms et chemins litteraux dans des ensembles,
+    motifs glob dans une seule expression reguliere par type.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        #[any entry, directories only]
+        names, paths = ([set(), set()], [set(), set()])
+        name_globs, path_globs = ([[], []], [[], []])
+        for pattern in self.patterns:
+            dir_only = int(pattern.endswith('/'))
+            pattern = pattern.strip('/')
+            if not pattern:
+                continue
+            if '/' in pattern:
+                if _isGlob(pattern):
+                    path_globs[dir_only].append(pattern)
+                else:
+                    paths[dir_only].add(pattern)
+            elif _isGlob(pattern):
+                name_globs[dir_only].append(pattern)
+            else:
+                names[dir_only].add(pattern)
+        self._names = names
+        self._paths = paths
+        self._name_regex = [_combine(globs) for globs in name_globs]
+        self._path_regex = [_combine(globs) for globs in path_globs]
+        self.uses_path = any(paths) or any(path_globs)
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def match(self, name, rel_dir, is_dir):
+        for kind in ((0, 1) if is_dir else (0,)):
+            if name in self._names[kind]:
+                return True
+            regex = self._name_regex[kind]
+            if regex is not None and regex.match(name):
+                return True
+        if self.uses_path:
+            rel_path = os.path.join(rel_dir, name)
+            if os.sep != '/':
+                rel_path = rel_path.replace(os.sep, '/')
+            for kind in ((0, 1) if is_dir else (0,)):
+                if rel_path in self._paths[kind]:
+                    return True
+                regex = self._path_regex[kind]
+                if regex is not None and regex.match(rel_path):
+                    return True
+        return False
+
+class FileFilter:
+    """
+    Filtre des entrees d'une synchronisation.
+    include, exclude : motifs glob (voir plus haut)
+    ext_mode, ext    : filtre d'extensions des options -i et -e
+    min_size, max_size : bornes de la taille des fichiers, en octets
+    newer_than, older_than : bornes de l'age des fichiers (modification), en secondes
+    """
+    def __init__(self, include=(), exclude=(), ext_mode=None, ext=(), min_size=None, max_size=None,
+                 newer_than=None, older_than=None, now=None):
+        self.include = Patterns(include)
+        self.exclude = Patterns(exclude)
+        self.ext_mode = ext_mode
+        self.ext = frozenset(ext)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.newer_than = newer_than
+        self.older_than = older_than
+        now = time.time() if now is None else now
+        self._min_mtime = now-newer_than if newer_than is not None else None
+        self._max_mtime = now-older_than if older_than is not None else None
+        self.checks_names = bool(self.include or self.exclude or ext_mode is not None)
+        self.checks_stat = any(value is not None for value in (min_size, max_size, newer_than, older_than))
+        self.checks_age = newer_than is not None or older_than is not None
+
+    def matchDir(self, name, rel_dir):
+        """
+        Verifie si un dossier doit etre parcouru.
+        """
+        return not self.exclude or not self.exclude.match(name, rel_dir, True)
+
+    def matchFile(self, name, rel_dir):
+        """
+        Verifie si un fichier passe le filtre d'apres son nom et son chemin.
+        """
+        if not self.checks_names:
+            return True
+        if self.ext_mode is not None:
+            base, dot, file_ext = name.rpartition(".")
+            if (file_ext if dot else "") in self.ext:
+                if self.ext_mode == 'e':
+                    return False
+            elif self.ext_mode == 'i':
+                return False
+        if self.include and not self.include.match(name, rel_dir, False):
+            return False
+        return not self.exclude or not self.exclude.match(name, rel_dir, False)
+
+    def matchStat(self, st):
+        """
+        Verifie si un fichier passe les criteres de taille et d'age.
+        """
+        if not self.checks_stat:
+            return True
+        if self.min_size is not None and st.st_size < self.min_size:
+            return False
+        if self.max_size is not None and st.st_size > self.max_size:
+            return False
+        if self._min_mtime is not None and st.st_mtime < self._min_mtime:
+            return False
+        if self._max_mtime is not None and st.st_mtime > self._max_mtime:
+            return False
+        return True
+
+    def fingerprint(self):
+        """
+        Description des regles, pour savoir si un snapshot a ete fait avec le meme filtre.
+        """
+        return "|".join([str(self.ext_mode), ",".join(sorted(self.ext)), ",".join(self.include.patterns),
+                         ",".join(self.exclude.patterns), str(self.min_size), str(self.max_size),
+                         str(self.newer_than), str(self.older_than)])
@@ -0,0 +1,400 @@
+"""
+history.py
+last modified : 18 october 2026
+
+History of the files copied by mcopy (_mcopy.log), kept at the root of each
+synchronised directory: for every file, the moment it was last copied there.
+
+The file starts with a header (MAGIC, FORMAT_VERSION) followed by segments. A
+segment holds directory blocks sorted by path. Each block gives its directory,
+relative to the root and prefix-compressed against the previous block, then its
+entries: the names separated by NUL bytes, then their copy times as 64-bit
+integer nanoseconds, so a block is decoded with a split and an array copy. Paths
+are relative, so the history still applies when the drive is mounted elsewhere.
+
+Opening a history maps the file in memory and only reads the directory names
+and the position of their blocks; the entries of a directory are decoded when
+it is looked up, and only the last CACHE_DIRS directories are kept decoded.
+Changes are kept aside and saved as a new segment appended to the file, deleted
+entries as tombstones. Once the appended segments outgrow the first one, the
+whole history is rewritten as a single segment. Every segment carries a CRC: a
+segment cut short by an interruption is ignored and overwritten by the next save.
+
+Histories written by older versions (pickled dictionary or list of pairs with
+absolute paths) are read and converted at the next save.
+"""
+import os, sys, mmap, pickle, struct, threading, zlib
+from array import array
+from collections import OrderedDict
+
+MAGIC = b"MCOPYLOG"
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sI')
+SEGMENT_HEADER = struct.Struct('<IIQI') #payload length, payload crc32, entries after this segment, blocks
+CACHE_DIRS = 64
+COMPACT_RATIO = 1.0 #appended segments larger than the first one times this trigger a rewrite
+
+_missing = object()
+
+def _putVarint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _getVarint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def _putString(out, value, previous):
+    #length of the prefix shared with the previous string, then the rest
+    shared = 0
+    limit = min(len(value), len(previous))
+    while shared < limit and value[shared] == previous[shared]:
+        shared += 1
+    _putVarint(out, shared)
+    _putVarint(out, len(value)-shared)
+    out += value[shared:]
+
+def _getString(buf, pos, previous):
+    shared, pos = _getVarint(buf, pos)
+    length, pos = _getVarint(buf, pos)
+    return previous[:shared]+bytes(buf[pos:pos+length]), pos+length
+
+def _times(values):
+    times = array('q', values)
+    if sys.byteorder == 'big':
+        times.byteswap()
+    return times.tobytes()
+
+def encodeSegment(dirs):
+    """
+    Encode une liste triee de (dossier, [(nom, temps en ns ou None pour une suppression), ...])
+    en segment. Retourne le contenu du segment et le nombre de blocs.
+    """
+    payload = bytearray()
+    previous_dir = b""
+    blocks = 0
+    for rel_dir, entries in dirs:
+        names = os.fsencode("\0".join(name for name, ns in entries))
+        block = bytearray()
+        _putVarint(block, len(entries))
+        _putVarint(block, len(names))
+        block += names
+        #a deletion is written as time 0
+        block += _times([ns or 0 for name, ns in entries])
+        rel_dir = os.fsencode(rel_dir)
+        _putString(payload, rel_dir, previous_dir)
+        previous_dir = rel_dir
+        _putVarint(payload, len(block))
+        payload += block
+        blocks += 1
+    return payload, blocks
+
+def decodeBlock(buf, pos, entries):
+    """
+    Applique a 'entries' ({nom: temps en ns}) le bloc commencant a 'pos'.
+    """
+    count, pos = _getVarint(buf, pos)
+    length, pos = _getVarint(buf, pos)
+    if count == 0:
+        return
+    names = os.fsdecode(buf[pos:pos+length]).split("\0")
+    pos += length
+    times = array('q')
+    times.frombytes(buf[pos:pos+8*count])
+    if sys.byteorder == 'big':
+        times.byteswap()
+    if 0 in times:
+        for name, ns in zip(names, times):
+            if ns == 0:
+                entries.pop(name, None)
+            else:
+                entries[name] = ns
+    else:
+        entries.update(zip(names, times))
+
+class History:
+    """
+    Historique d'un dossier, utilisable comme un dictionnaire {chemin absolu: temps de copie}.
+    Les changements sont ecrits par save().
+    path : fichier d'historique
+    root : dossier dont les chemins sont relatifs
+    load : False pour ignorer le fichier existant, qui sera remplace
+    """
+    def __init__(self, path, root, load=True):
+        self.path = path
+        self.root = root
+        self.lock = threading.RLock()
+        self._prefix = os.path.join(root, "")
+        self._changes = {}      #(dir, name) -> ns, None when deleted
+        self._cache = OrderedDict() #dir -> {name: ns}, the last decoded directories
+        self._last = (None, None)
+        self._index = {}        #dir -> [block offset in the map, ...] in file order
+        self._map = None
+        self._count = 0
+        self._base_size = 0     #payload of the first segment
+        self._end = 0           #end of the last valid segment, where the next one is appended
+        self._rewrite = not load
+        if load:
+            self._open()
+
+    def _open(self):
+        self._close()
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            head = f.read(HEADER.size)
+            if len(head) < HEADER.size or head[:len(MAGIC)] != MAGIC:
+                f.seek(0)
+                self._loadLegacy(f)
+                return
+            if HEADER.unpack(head)[1] != FORMAT_VERSION:
+                #unknown format, replaced at the next save
+                self._rewrite = True
+                return
+            size = os.fstat(f.fileno()).st_size
+            self._end = HEADER.size
+            if size > HEADER.size:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        segments = []
+        pos = HEADER.size
+        while pos+SEGMENT_HEADER.size <= size:
+            length, crc, total, blocks = SEGMENT_HEADER.unpack_from(self._map, pos)
+            start = pos+SEGMENT_HEADER.size
+            if start+length > size:
+                break
+            segments.append((start, start+length, crc, total, blocks))
+            pos = start+length
+        #only the last segment can have been cut short
+        if segments and zlib.crc32(self._map[segments[-1][0]:segments[-1][1]]) != segments[-1][2]:
+            segments.pop()
+        if not segments:
+            self._rewrite = True
+            return
+        for start, end, crc, total, blocks in segments:
+            pos = start
+            rel_dir = b""
+            for i in range(blocks):
+                rel_dir, pos = _getString(self._map, pos, rel_dir)
+                length, pos = _getVarint(self._map, pos)
+                self._index.setdefault(os.fsdecode(rel_dir), []).append(pos)
+                pos += length
+        self._base_size = segments[0][1]-segments[0][0]
+        self._count = segments[-1][3]
+        self._end = segments[-1][1]
+
+    def _loadLegacy(self, f):
+        #pickled {path: time} or [[path, time], ...], absolute paths and float seconds
+        try:
+            log = pickle.load(f)
+        except Exception:
+            log = {}
+        self._rewrite = True
+        for path, copy_time in (log.items() if isinstance(log, dict) else log):
+            key = self._key(path)
+            ns = round(copy_time*1e9)
+            if ns > (self._changes.get(key) or -1):
+                if key not in self._changes:
+                    self._count += 1
+                self._changes[key] = ns
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._index = {}
+        self._cache.clear()
+        self._last = (None, None)
+        self._count = 0
+        self._base_size = 0
+        self._end = 0
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _key(self, path):
+        if path.startswith(self._prefix):
+            rel_dir, sep, name = path[len(self._prefix):].rpartition(os.sep)
+            return rel_dir, name
+        return os.path.split(os.path.relpath(path, self.root))
+
+    def _decode(self, rel_dir):
+        entries = {}
+        for pos in self._index.get(rel_dir, ()):
+            decodeBlock(self._map, pos, entries)
+        return entries
+
+    def _dir(self, rel_dir):
+        if self._last[0] == rel_dir:
+            #lookups come directory by directory
+            return self._last[1]
+        entries = self._cache.get(rel_dir)
+        if entries is None:
+            entries = self._cache[rel_dir] = self._decode(rel_dir)
+            if len(self._cache) > CACHE_DIRS:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(rel_dir)
+        self._last = (rel_dir, entries)
+        return entries
+
+    def _get(self, key):
+        ns = self._changes.get(key, _missing)
+        if ns is _missing:
+            if key[0] not in self._index:
+                return None
+            ns = self._dir(key[0]).get(key[1])
+        return ns
+
+    def get(self, path, default=None):
+        with self.lock:
+            ns = self._get(self._key(path))
+        return default if ns is None else ns/1e9
+
+    def __contains__(self, path):
+        with self.lock:
+            return self._get(self._key(path)) is not None
+
+    def __getitem__(self, path):
+        copy_time = self.get(path)
+        if copy_time is None:
+            raise KeyError(path)
+        return copy_time
+
+    def __setitem__(self, path, copy_time):
+        key = self._key(path)
+        with self.lock:
+            if self._get(key) is None:
+                self._count += 1
+            self._changes[key] = round(copy_time*1e9)
+
+    def __delitem__(self, path):
+        if self.pop(path, _missing) is _missing:
+            raise KeyError(path)
+
+    def pop(self, path, default=None):
+        key = self._key(path)
+        with self.lock:
+            ns = self._get(key)
+            if ns is None:
+                return default
+            self._changes[key] = None
+            self._count -= 1
+        return ns/1e9
+
+    def update(self, mapping):
+        for path, copy_time in mapping.items():
+            self[path] = copy_time
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for rel_dir, entries in self._merged():
+            for name, ns in entries:
+                yield self._prefix+os.path.join(rel_dir, name)
+
+    def items(self):
+        for rel_dir, entries in self._merged():
+            for name, ns in entries:
+                yield self._prefix+os.path.join(rel_dir, name), ns/1e9
+
+    def _changedDirs(self):
+        changed = {}
+        for (rel_dir, name), ns in self._changes.items():
+            changed.setdefault(rel_dir, {})[name] = ns
+        return changed
+
+    def _merged(self):
+        #every directory with its live entries, sorted, without filling the cache
+        with self.lock:
+            changed = self._changedDirs()
+            rel_dirs = sorted(set(self._index) | set(changed))
+        for rel_dir in rel_dirs:
+            with self.lock:
+                entries = self._decode(rel_dir)
+                for name, ns in changed.get(rel_dir, {}).items():
+                    if ns is None:
+                        entries.pop(name, None)
+                    else:
+                        entries[name] = ns
+            if entries:
+                yield rel_dir, sorted(entries.items())
+
+    def save(self):
+        """
+        Ecrit les changements sur le disque : ajoutes a la fin du fichier, ou tout
+        l'historique reecrit quand les ajouts deviennent trop gros. Un historique vide
+        est supprime. Retourne le nombre d'octets ecrits.
+        """
+        with self.lock:
+            if not self._changes and not self._rewrite:
+                return 0
+            if self._count == 0:
+                self._close()
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                self._changes = {}
+                self._rewrite = False
+                return 0
+            if not self._rewrite and self._map is not None:
+                changed = self._changedDirs()
+                payload, blocks = encodeSegment([(rel_dir, sorted(changed[rel_dir].items()))
+                                                 for rel_dir in sorted(changed)])
+                appended = self._end-HEADER.size-SEGMENT_HEADER.size-self._base_size+len(payload)
+                if appended <= self._base_size*COMPACT_RATIO:
+                    return self._append(payload, blocks)
+            return self._rewriteAll()
+
+    def _segment(self, payload, blocks):
+        return SEGMENT_HEADER.pack(len(payload), zlib.crc32(payload), self._count, blocks)+payload
+
+    def _append(self, payload, blocks):
+        data = self._segment(payload, blocks)
+        with open(self.path, 'r+b') as f:
+            f.seek(self._end)
+            f.write(data)
+            #drops what an interrupted save may have left after the last valid segment
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+        self._changes = {}
+        self._open()
+        return len(data)
+
+    def _rewriteAll(self):
+        payload, blocks = encodeSegment(list(self._merged()))
+        data = HEADER.pack(MAGIC, FORMAT_VERSION)+self._segment(payload, blocks)
+        tmp = self.path+".tmp"
+        #written aside then renamed, an interruption never leaves a truncated history
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._close()
+        os.replace(tmp, self.path)
+        self._changes = {}
+        self._rewrite = False
+        self._open()
+        return len(data)
+
+def writeLog(path, root, mapping):
+    """
+    Remplace l'historique 'path' par le contenu de 'mapping' ({chemin absolu: temps}).
+    Retourne le nombre d'octets ecrits.
+    """
+    log = History(path, root, load=False)
+    log.update(mapping)
+    written = log.save()
+    log.close()
+    return written
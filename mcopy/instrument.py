@@ -0,0 +1,131 @@
+"""
+instrument.py
+last modified : 18 october 2026
+
+Instrumentation of a SyncJob run (mcopy --profile). Every operation is recorded
+in its phase with its latency:
+
+    scan    : directory listings
+    compare : comparison of a directory pair, with the stat calls it needed
+    copy    : one file copied, updated or linked, with the bytes read and written
+    trash   : one batch sent to the trash, or one entry deleted
+    log     : reading, cleaning and writing the history files
+
+For every phase the report gives the operation count, the time spent in them
+(summed over threads), the stat calls, the bytes, a latency histogram in powers
+of two and the slowest operations. 'wall' gives the elapsed time of the steps of
+the run, and 'bound' tells whether the run was mostly spent on metadata (listing,
+stat, small files) or on moving data.
+"""
+import time, json, heapq, threading
+from contextlib import contextmanager
+
+PHASES = ('scan', 'compare', 'copy', 'trash', 'log')
+SLOWEST = 10
+HISTOGRAM_BUCKETS = 26 #bucket k holds latencies under 2**k microseconds, the last one everything above
+SMALL_FILE_SIZE = 1024*1024 #copies of smaller files are counted as metadata work
+
+def bucketLabel(k):
+    if k == HISTOGRAM_BUCKETS-1:
+        return ">=%s" % formatLatency(2**(k-1)/1e6)
+    return "<%s" % formatLatency(2**k/1e6)
+
+def formatLatency(seconds):
+    if seconds < 1e-3:
+        return "%dus" % round(seconds*1e6)
+    if seconds < 1:
+        return "%gms" % round(seconds*1e3, 1)
+    return "%gs" % round(seconds, 1)
+
+class PhaseStats:
+    """
+    Compteurs d'une phase.
+    """
+    def __init__(self, slowest=SLOWEST):
+        self.count = 0
+        self.seconds = 0.0
+        self.stat_calls = 0
+        self.listings = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.histogram = [0]*HISTOGRAM_BUCKETS
+        self.slowest = []       #min-heap of (seconds, path)
+        self._keep = slowest
+
+    def add(self, path, seconds, stat_calls, listings, bytes_read, bytes_written):
+        self.count += 1
+        self.seconds += seconds
+        self.stat_calls += stat_calls
+        self.listings += listings
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+        self.histogram[min(int(seconds*1e6).bit_length(), HISTOGRAM_BUCKETS-1)] += 1
+        if path is not None:
+            if len(self.slowest) < self._keep:
+                heapq.heappush(self.slowest, (seconds, path))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, path))
+
+    def report(self):
+        return {
+            'count': self.count,
+            'seconds': round(self.seconds, 6),
+            'stat_calls': self.stat_calls,
+            'listings': self.listings,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'histogram': dict((bucketLabel(k), n) for k, n in enumerate(self.histogram) if n),
+            'slowest': [{'path': path, 'seconds': round(seconds, 6)}
+                        for seconds, path in sorted(self.slowest, reverse=True)],
+        }
+
+class Profiler:
+    """
+    Mesures d'une execution, partagees par les threads de copie.
+    """
+    def __init__(self, slowest=SLOWEST):
+        self.lock = threading.Lock()
+        self.phases = dict((name, PhaseStats(slowest)) for name in PHASES)
+        self.wall = {}
+        self.small_copy_seconds = 0.0
+
+    def record(self, phase, path, seconds, stat_calls=0, listings=0, bytes_read=0, bytes_written=0):
+        """
+        Enregistre une operation de la phase donnee et sa duree en secondes.
+        """
+        with self.lock:
+            self.phases[phase].add(path, seconds, stat_calls, listings, bytes_read, bytes_written)
+            if phase == 'copy' and bytes_read < SMALL_FILE_SIZE:
+                self.small_copy_seconds += seconds
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Ajoute la duree du bloc au temps ecoule de l'etape 'name'.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter()-start
+            with self.lock:
+                self.wall[name] = self.wall.get(name, 0.0)+elapsed
+
+    def report(self):
+        with self.lock:
+            phases = dict((name, stats.report()) for name, stats in self.phases.items())
+            metadata = sum(self.phases[name].seconds for name in ('scan', 'compare', 'trash', 'log'))
+            metadata += self.small_copy_seconds
+            data = self.phases['copy'].seconds-self.small_copy_seconds
+            return {
+                'wall': dict((name, round(seconds, 6)) for name, seconds in self.wall.items()),
+                'phases': phases,
+                'metadata_seconds': round(metadata, 6),
+                'data_seconds': round(data, 6),
+                'bound': 'metadata' if metadata >= data else 'bandwidth',
+            }
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+            f.write('\n')
@@ -0,0 +1,106 @@
+"""
+journal.py
+last modified : 18 october 2026
+
+Journal of the large copies in progress, kept by mcopy in the target directory
+(_mcopy.journal). Every entry gives the source of a transfer, its size and
+mtime_ns when the copy started, and the offset up to which the partial file (see
+transfer.copyFile) is known to be on the disk. The journal is written at most
+every FLUSH_INTERVAL seconds, always to a temporary file renamed over the old one.
+
+When a run is interrupted, the next run finds the partial file in the journal and,
+if the source didn't change and the data before the offset checks out, resumes the
+copy there instead of starting over.
+"""
+import os, json, time, threading, transfer
+
+JOURNAL_VERSION = 1
+FLUSH_INTERVAL = 2.0
+
+class Journal:
+    def __init__(self, path, interval=FLUSH_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self._entries = {}      #target -> [source, size, mtime_ns, offset]
+        self._dirty = False
+        self._last_flush = time.time()
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == JOURNAL_VERSION:
+                self._entries = data['transfers']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def __len__(self):
+        return len(self._entries)
+
+    def resumeOffset(self, source, target, size):
+        """
+        Retourne la position a laquelle la copie de source vers target peut reprendre, 0 sinon.
+        """
+        entry = self._entries.get(target)
+        if entry is None or entry[0] != source or entry[1] != size:
+            return 0
+        try:
+            if os.stat(source).st_mtime_ns != entry[2]:
+                return 0
+        except OSError:
+            return 0
+        return transfer.verifiedOffset(source, transfer.partName(target), entry[3])
+
+    def begin(self, source, target, size, mtime_ns, offset=0):
+        with self.lock:
+            self._entries[target] = [source, size, mtime_ns, offset]
+            self._dirty = True
+        self.flush(force=True)
+
+    def update(self, target, offset):
+        with self.lock:
+            entry = self._entries.get(target)
+            if entry is not None:
+                entry[3] = offset
+                self._dirty = True
+        self.flush()
+
+    def done(self, target):
+        with self.lock:
+            if self._entries.pop(target, None) is not None:
+                self._dirty = True
+
+    def prune(self, targets):
+        """
+        Oublie les copies qui ne seront pas reprises (absentes de 'targets')
+        et supprime leurs fichiers partiels.
+        """
+        with self.lock:
+            for target in [target for target in self._entries if target not in targets]:
+                del self._entries[target]
+                self._dirty = True
+                try:
+                    os.remove(transfer.partName(target))
+                except OSError:
+                    pass
+
+    def flush(self, force=False):
+        """
+        Ecrit le journal s'il a change et que FLUSH_INTERVAL est ecoule (ou si 'force').
+        """
+        with self.lock:
+            now = time.time()
+            if not self._dirty or (not force and now-self._last_flush < self.interval):
+                return
+            self._dirty = False
+            self._last_flush = now
+            if not self._entries:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            tmp = self.path+".tmp"
+            with open(tmp, 'w') as f:
+                json.dump({'version': JOURNAL_VERSION, 'transfers': self._entries}, f)
+            os.replace(tmp, self.path)
+
+    def close(self):
+        self.flush(force=True)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # encoding: utf-8
-import os, os.path, time, shutil, sys, console, pickle
+import os, os.path, time, shutil, sys, console, threading, contextlib, transfer, snapshot, checksum, filters, journal, history
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from send2trash import send2trash
 
 __doc__ ="""
@@ -11,11 +13,25 @@ Modifications: transitioned the code to Python 3.5, added getMsgTimeStamp for cl
     
 Copies the content of the source directory to the target, recursively. If files have the same name,
 the last modified version is copied in the target directory.
+Every file is written under a temporary name and renamed once complete, so an interrupted run
+never leaves a truncated file. Large copies are tracked in a journal kept in the target and
+the next run resumes them where they stopped.
 
-syntax  : mcopy.py [options] [extensions] [source] [target]
+syntax  : mcopy.py [options] [extensions] [source] [target] [more targets ...]
 example : mcopy.py -k -e wav,aif,mp3 /Users/xxxx/Desktop/music /Users/xxxx/Desktop/playlist
 
+The module can also be imported, see SyncJob:
+    job = SyncJob(source, target, mirror=True, jobs=8, callback=on_event)
+    job.plan()
+    stats = job.execute()
+
+With several targets, the source is scanned once and every file to copy is read once and
+written to all the targets that need it (see fanout.py). A target that fails is abandoned,
+the others go on. Not available with -c, -a or --watch.
+
 options : -c : copies files and directories in both ways (form 'source' to 'target', and vice versa)
+               Both trees are compared in a single pass. A file changed on both sides since the last
+               run is a conflict : the newer version is copied and the other one kept with "-old".
           -k : If files have the same name, the earlier version is kept, but the suffix "-old"
                is added to the end of the file name.
           -d : copies files from 'source' to 'target', then deletes anything in 'target' that is not in
@@ -23,6 +39,46 @@ options : -c : copies files and directories in both ways (form 'source' to 'targ
           -i : inclusive mode. Only copies files with the given extensions.
           -e : exclusive mode. Copies all files except the ones with the extentions listed.
                If using this option, extensions must follow directly after. Separate extensions using commas.
+          --include, --exclude : must be followed by glob patterns separated by commas
+               (ex: --exclude "*.tmp,node_modules/,build/cache"). Patterns without '/' match names,
+               patterns with '/' match paths relative to the source, a trailing '/' only matches
+               directories. Excluded directories are not scanned. Excluded entries are never deleted.
+          --min-size, --max-size : only files of this size or more / less (ex: 100K, 2M, 1G).
+          --newer, --older : only files modified less / more than this long ago (ex: 30m, 12h, 7d).
+          -j : number of files copied in parallel, must be followed by a number (ex: -j 8).
+               Large files are copied in their own lane so they don't hold back the small ones.
+          -a : asyncio engine, for network mounts (SMB, NFS) where every stat and open is a round-trip.
+               Listings, stats and copies run concurrently and copies start while the tree is still
+               being scanned. With -a, -j sets the number of concurrent operations (default 16).
+          -s : incremental mode. Directories that didn't change on either side since the last run
+               (according to the snapshot kept in the target) are not scanned again.
+               Files modified in place without touching their directory are only noticed
+               by a run without -s. Not available with -c.
+          --checksum : files whose timestamps say they changed are compared by content first,
+               and are not copied again when identical. Digests are cached in the target.
+          --dedup : a new file whose content is already in the target is cloned from it
+               (or hard linked when the filesystem can't clone) instead of being copied.
+          -b : block delta mode. When a large file is overwritten, only the blocks that changed
+               are written and the new version replaces the old one atomically.
+          --dry-run : only reports what would be copied, and with -d deleted, without changing anything.
+          --no-trash : with -d, deletes permanently instead of moving to the trash.
+          -q : quiet, only warnings, errors and the final summary are printed.
+          --json : prints the messages, the progress (once per second) and the summary as JSON,
+               one object per line.
+          --profile : must be followed by a file name. Times every listing, comparison, copy, deletion
+               and history access and writes the report there as JSON (see instrument.py).
+          --cprofile : must be followed by a file name. Runs mcopy under cProfile and writes the
+               statistics there (for pstats). Only the main thread is profiled.
+          --bwlimit : must be followed by a rate in bytes per second (ex: 20M). Caps the data copied,
+               all copy threads together.
+          --files-limit : must be followed by a number. Caps the files copied per second.
+          --throttle-file : must be followed by a file name. Control file re-read while copying, with
+               lines 'bwlimit = 20M' and 'files = 100' (0 or none : no limit), see throttle.py.
+               While mcopy runs, SIGUSR1 halves the limits and SIGUSR2 doubles them.
+          --low-priority : lowers the CPU and disk priority of mcopy (nice, ionice idle class on Linux),
+               the copies only use the disk when nothing else needs it.
+          --watch : after the first run, keeps watching the source (inotify) and copies changes
+               as they happen, until interrupted with Ctrl-C. Not available with -c.
 """
 
 def getMsgTimeStamp(level=0):
@@ -34,365 +90,1282 @@ def getMsgTimeStamp(level=0):
         tag = "ERROR"
     return "[%s][%s] " % (time.strftime("%H:%M:%S"), tag)
 
-if len(sys.argv) < 3:
-    print(__doc__)
-    sys.exit()
 
-# --------------------------
-# Variables Globales
-# --------------------------
 log_name = '_mcopy.log'
-start_time = time.time()
-width, height = console.getTerminalSize()
-opt = None
-mode = None
-ext = []
-overwrite = True
-dir2 = sys.argv.pop(-1)
-dir1 = sys.argv.pop(-1)
-
-if not os.path.exists(dir1):
-    raise IOError("source path does not exist.")
-    
-if not os.path.exists(dir2):
-    print(console.colour(getMsgTimeStamp(0)+"created root target path : "+dir2,"orange"))
-    os.mkdir(dir2)
+snap_name = '_mcopy.snap'
+sums_name = '_mcopy.sums'
+journal_name = '_mcopy.journal'
+checkpoint_interval = 30 #seconds between two writes of the history while copying
+delta_min_size = 8*1024*1024 #smaller files are simply copied over
+large_file_size = 64*1024*1024 #files this size or bigger are copied in the large files lane
+trash_batch_size = 256 #paths sent to the trash in one call
 
-trgt_log = [] #lists all the files copied from source to target
-src_log = [] #lists all the files copied from target to source (case -c)
+class CopyPlan:
+    """
+    Resultat de l'analyse d'une arborescence : liste des actions a executer
+    et total des octets a copier. Les stats sont prises une seule fois, lors
+    de l'analyse, et ne sont plus consultees pendant la copie.
+    """
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.dirs = []          #target directories to create, parents first
+        self.files = []         #CopyAction list
+        self.links = []         #CopyAction list of duplicates, made once the files are copied
+        self.extra_dirs = []    #top-most target directories absent from source
+        self.extra_files = []   #target files absent from source
+        self.num_bytes = 0
+        self.listing = {}       #directory -> names it contained when planning, for both sides
+        self.scanned = []       #directories actually listed, for the snapshot
+        self.visited = []       #every relative directory reached, listed or not
+        self.skipped_dirs = 0
+        self.identical = 0      #files not copied because their content is already in the target
+        self.candidates = []    #target files that can be linked to, (path, stat)
+        self.stats = {}         #source path -> stat of the new files, for dedup
+        self.conflicts = []     #relative paths changed on both sides since their last synchronisation
 
-if os.path.exists(os.path.join(dir1,log_name)):
-    with open(os.path.join(dir1,log_name), 'rb') as f:
-        src_log = pickle.load(f)
+    def __len__(self):
+        return len(self.files)+len(self.links)
 
-if os.path.exists(os.path.join(dir2,log_name)):
-    with open(os.path.join(dir2,log_name), 'rb') as f:
-        trgt_log = pickle.load(f)
+#origin is the target file a duplicate is linked to
+CopyAction = namedtuple('CopyAction', ['kind', 'source', 'target', 'name', 'size', 'logged', 'origin'],
+                        defaults=[None])
 
-#sets the overwrite flag
-if '-k' in sys.argv:
-    sys.argv.pop(sys.argv.index('-k'))
-    overwrite = False
-    
-#sets the extensions
-if '-e' in sys.argv:
-    index = sys.argv.index('-e')
-    sys.argv.pop(index)
-    ext = sys.argv.pop(index).split(',')
-    mode = 'e'
-elif '-i' in sys.argv:
-    index = sys.argv.index('-i')
-    sys.argv.pop(index)
-    ext = sys.argv.pop(index).split(',')
-    mode = 'i'
-
-#if two elements are present at this stage, we have an option!
-if len(sys.argv) == 2:
-    opt = sys.argv[1]
-
-def printMessage(message, colour=None):
-    """
-    Affiche un message au terminal en s'assurant qu'il occupe toute la largeur
-    pour effacer le barre de prograssion en dessous.
-    Ensuite, affche la barre de progression.
-    """
-    global pbar, width
-    
-    if len(message) < width:
-        spaces = width-len(message)
-        message += " "*spaces+'\n'
-    else:
-        message += '\n'
-    
-    if colour != None:
-        message = console.colour(message, colour)
-    
-    sys.stdout.write('\r'+message)
-    sys.stdout.write(console.colour(str(pbar), "green"))
-    sys.stdout.flush()
-    
-def evalFile_mtime(file, target_file, log):
+class SyncStats:
+    """
+    Statistiques retournees par SyncJob.execute.
+    """
+    def __init__(self):
+        self.files_to_copy = 0
+        self.dirs_created = 0
+        self.files_copied = 0
+        self.dirs_deleted = None    #only when mirroring
+        self.files_deleted = None
+        self.num_bytes = 0
+        self.skipped_dirs = None    #only in incremental mode
+        self.identical = 0
+        self.hashed = None          #only when comparing content, (files hashed, digests from cache)
+        self.copy_stats = {}        #backend name -> [files, bytes, seconds, slowest MB/s]
+        self.delta_stats = [0, 0, 0] #files, file bytes, bytes sent
+        self.link_stats = {}        #method -> files
+        self.conflicts = None       #only with both_ways, relative paths changed on both sides
+        self.throttled = None       #only with a throttle, seconds spent waiting for it
+        self.runtime = 0.0
+
+def isIgnored(file_name):
+    """
+    Fichiers qui ne sont jamais copies : fichiers de travail de mcopy et fichiers systeme.
+    """
+    return isMeta(file_name) or "DS_Store" in file_name
+
+def isMeta(file_name):
+    """
+    Fichiers de travail de mcopy : historique, snapshot, empreintes et journal gardes a la
+    racine des dossiers, copies en cours n'importe ou. Ils ne sont ni copies ni supprimes.
+    """
+    return (file_name.startswith(log_name) or file_name.startswith(snap_name)
+            or file_name.startswith(sums_name) or file_name.startswith(journal_name)
+            or file_name.endswith(transfer.PART_SUFFIX) or file_name.endswith(".mcopy-delta"))
+
+def listDir(path):
+    """
+    Retourne les entrees d'un dossier (os.scandir) triees par nom.
+    """
+    with os.scandir(path) as it:
+        return sorted(it, key=lambda entry: entry.name)
+
+def oldVersionName(target_file):
+    """
+    Nom sous lequel l'ancienne version d'un fichier est gardee (option -k et conflits).
+    """
+    name, dot, old_ext = target_file.rpartition(".")
+    return name+"-old."+old_ext if dot else target_file+"-old"
+
+def trashPaths(paths):
+    """
+    Met des chemins a la corbeille : en un seul appel avec Send2Trash 1.8 ou plus recent,
+    un par un avec les versions plus anciennes qui n'acceptent pas de liste.
+    """
+    try:
+        send2trash(paths)
+    except TypeError:
+        for path in paths:
+            send2trash(path)
+
+def treeSize(path):
+    """
+    Retourne le nombre de fichiers et le total des octets d'une arborescence.
+    """
+    files, num_bytes = 0, 0
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    files += 1
+                    num_bytes += entry.stat(follow_symlinks=False).st_size
+    return files, num_bytes
+
+def evalFile_mtime(src_stat, trgt_stat, log_time):
     """
     Evalue si un fichier doit etre copie ou non en se basant sur
     le moment de la derniere modification.
+    Retourne 'new', 'update' ou None.
     """
-    if len(log) > 0:
-        i = inLog(file, log)
-        if i != -1:
-            if os.path.getmtime(file) > log[i][1]:
-                return 1
-            if not os.path.exists(target_file):
-                return 1
-            return 0
-    if os.path.exists(target_file):
-        if os.path.getmtime(file) > os.path.getmtime(target_file):
-            return 1
-    else:
-        return 1
-    return 0
-    
-def evalFile_ctime(file, target_file, log):
+    if log_time is not None:
+        if src_stat.st_mtime > log_time:
+            return 'update' if trgt_stat is not None else 'new'
+        if trgt_stat is None:
+            return 'new'
+        return None
+    if trgt_stat is None:
+        return 'new'
+    if src_stat.st_mtime > trgt_stat.st_mtime:
+        return 'update'
+    return None
+
+def evalPair(left_stat, right_stat, sync_time):
+    """
+    Compare un fichier present des deux cotes (option -c). 'sync_time' est le moment de
+    leur derniere synchronisation d'apres les historiques, None si inconnu.
+    Retourne 'left' (a copier vers la droite), 'right', 'conflict' (modifie des deux
+    cotes depuis la derniere synchronisation) ou None.
+    """
+    if sync_time is None:
+        if left_stat.st_mtime > right_stat.st_mtime:
+            return 'left'
+        if right_stat.st_mtime > left_stat.st_mtime:
+            return 'right'
+        return None
+    left_changed = left_stat.st_mtime > sync_time
+    right_changed = right_stat.st_mtime > sync_time
+    if left_changed and right_changed:
+        return 'conflict'
+    if left_changed:
+        return 'left'
+    if right_changed:
+        return 'right'
+    return None
+
+def evalFile_ctime(src_stat, trgt_stat, log_time):
     """
     Evalue si un fichier doit etre copie ou non en se basant sur
     le moment de sa creation.
+    Retourne 'new', 'update' ou None.
     """
-    if len(log) > 0:
-        i = inLog(file, log)
-        if i != -1:
-            if os.path.getmtime(file) > log[i][1]:
-                return 1
-            if not os.path.exists(target_file):
-                return 1
-            return 0
-    if os.path.exists(target_file):
-        if os.path.getctime(file) > os.path.getctime(target_file):
-            return 1
-    else:
-        return 1
-    return 0
+    if log_time is not None:
+        if src_stat.st_mtime > log_time:
+            return 'update' if trgt_stat is not None else 'new'
+        if trgt_stat is None:
+            return 'new'
+        return None
+    if trgt_stat is None:
+        return 'new'
+    if src_stat.st_ctime > trgt_stat.st_ctime:
+        return 'update'
+    return None
 
-def getNumFilesToCopy(source, target, src_log):
+class SyncJob:
     """
-    Retourne le nombre de fichier a copier.
+    Une synchronisation de 'source' vers 'target', avec sa configuration et son etat.
+    plan() analyse les deux arborescences, execute() applique le plan et retourne
+    un SyncStats. Plusieurs SyncJob peuvent tourner en meme temps dans un processus.
+
+    both_ways   : copie aussi de target vers source (option -c)
+    mirror      : supprime de target ce qui n'est pas dans source (option -d)
+    ext_mode    : None, 'i' (seulement les extensions 'ext') ou 'e' (toutes sauf 'ext')
+    include, exclude, min_size, max_size, newer_than, older_than : voir filters.FileFilter
+    overwrite   : False pour garder l'ancienne version avec le suffixe -old (option -k)
+    trash       : False pour supprimer definitivement au lieu de mettre a la corbeille (--no-trash)
+    dry_run     : execute() annonce ce qui serait fait sans rien modifier (--dry-run)
+    profiler    : instrument.Profiler qui mesure chaque operation (--profile), ou None
+    callback    : fonction appelee avec (evenement, infos) :
+                  'message'  : {'text', 'colour', 'level'}
+                  'start'    : {'total', 'total_bytes'} avant la premiere copie
+                  'progress' : {'files', 'total', 'bytes', 'total_bytes'} apres chaque fichier
     """
-    global ext
-    count = 0
-    for root, dirs, files in os.walk(source):
-        rel_source = os.path.relpath(root,source)
-        if rel_source == ".":rel_source=""
-        
-        if len(files)>0:
-            if files[0].find("DS_Store") != -1: del files[0]
+    def __init__(self, source, target, both_ways=False, mirror=False, ext_mode=None, ext=(),
+                 include=(), exclude=(), min_size=None, max_size=None, newer_than=None, older_than=None,
+                 overwrite=True, jobs=1, delta=False, incremental=False, verify=False,
+                 dedup=False, trash=True, dry_run=False, profiler=None, throttle=None, callback=None):
+        self.source = source
+        self.target = target
+        self.both_ways = both_ways
+        self.mirror = mirror
+        self.ext_mode = ext_mode
+        self.ext = list(ext)
+        self.filter = filters.FileFilter(include, exclude, ext_mode, ext, min_size, max_size,
+                                         newer_than, older_than)
+        self.overwrite = overwrite
+        self.jobs = max(1, jobs)
+        self.delta = delta
+        self.incremental = incremental
+        self.verify = verify
+        self.dedup = dedup
+        self.trash = trash
+        self.dry_run = dry_run
+        self.profiler = profiler
+        self.throttle = throttle    #throttle.Throttle limiting the copies
+        self.callback = callback
+
+        self.lock = threading.RLock() #guards the logs, the statistics and the progress when copying in parallel
+        self.stats = SyncStats()
+        self.plans = []
+        self.src_log = {}       #files copied from target to source (case both_ways), {path: time}, a history.History once read
+        self.trgt_log = {}      #files copied from source to target, {path: time}, a history.History once read
+        self.hashes = None      #checksum.HashCache, when comparing content
+        self.snap = None
+        self.journal = None     #journal.Journal of the large copies in progress
+        self._last_checkpoint = time.time()
+        self._progress = 0
+        self._total = 0
+        self._bytes = 0
+        self._total_bytes = 0
+        self._start_time = time.time()
+
+    def emit(self, event, **info):
+        if self.callback is not None:
+            self.callback(event, info)
+
+    def message(self, text, colour=None, level=0):
+        self.emit('message', text=text, colour=colour, level=level)
+
+    def _timer(self, name):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.timer(name)
+
+    def _start(self, total, total_bytes):
+        self._progress = 0
+        self._bytes = 0
+        self._total = total
+        self._total_bytes = total_bytes
+        self.emit('start', total=total, total_bytes=total_bytes)
+
+    def _advance(self, action):
+        self._progress += 1
+        self._bytes += action.size
+        self.emit('progress', files=self._progress, total=self._total,
+                  bytes=self._bytes, total_bytes=self._total_bytes)
+        self._checkpoint()
+
+    def _checkpoint(self):
+        #the history is saved along the way, an interrupted run doesn't copy everything again
+        if self.journal is None or time.time()-self._last_checkpoint < checkpoint_interval:
+            return
+        with self.lock:
+            self._last_checkpoint = time.time()
+            self.writeLogsToDisk()
+            self.journal.flush(force=True)
+
+    def run(self):
+        """
+        Analyse puis synchronise. Retourne un SyncStats.
+        """
+        self.plan()
+        return self.execute()
+
+    def plan(self):
+        """
+        Analyse les arborescences et retourne la liste des CopyPlan a executer.
+        """
+        self._prepare()
+        with self._timer('plan'):
+            if self.both_ways:
+                self.plans = list(self.planBothWays())
+            else:
+                self.plans = [self.planCopy(self.source, self.target, self.src_log, self.snap)]
+        self._afterPlan()
+        return self.plans
+
+    def _prepare(self):
+        self._start_time = time.time()
+        self._progress = self._total = 0
+        self._bytes = self._total_bytes = 0
+        if not os.path.exists(self.source):
+            raise IOError("source path does not exist.")
+        if not os.path.exists(self.target):
+            if self.dry_run:
+                self.message("would create root target path : "+self.target, "orange")
+                self.incremental = self.verify = self.dedup = False
+            else:
+                self.message("created root target path : "+self.target, "orange")
+                os.mkdir(self.target)
+
+        with self._timer('log'):
+            self.trgt_log = self.readLog(self.target)
+            self.src_log = self.readLog(self.source)
+
+        if self.incremental and self.filter.checks_age:
+            #the age window moves with the time, an unchanged directory can hold files that entered it
+            self.message("incremental mode is not available with --newer or --older, scanning everything",
+                         "orange", 1)
+        elif self.incremental and not self.both_ways:
+            fingerprint = "|".join([os.path.abspath(self.source), str(self.mirror), self.filter.fingerprint()])
+            self.snap = snapshot.Snapshot(os.path.join(self.target, snap_name), fingerprint)
+        elif self.incremental:
+            self.message("incremental mode is not available with -c, scanning everything", "orange", 1)
+
+        if self.verify or self.dedup:
+            self.hashes = checksum.HashCache(os.path.join(self.target, sums_name))
+        if not self.dry_run:
+            self.journal = journal.Journal(os.path.join(self.target, journal_name))
+            self._last_checkpoint = time.time()
+
+    def _afterPlan(self):
+        listing = {}
+        for plan in self.plans:
+            listing.update(plan.listing)
+        with self._timer('log'):
+            self.cleanLogs(listing)
+        if self.journal is not None:
+            #partial copies of files that are not copied any more
+            self.journal.prune(set(action.target for plan in self.plans for action in plan.files))
+        if self.hashes is not None:
+            #digests are only needed while planning
+            self.hashes.close()
+        stats = self.stats
+        stats.files_to_copy = sum(len(plan) for plan in self.plans)
+        if self.snap is not None:
+            stats.skipped_dirs = self.plans[0].skipped_dirs
+        if self.hashes is not None:
+            stats.hashed = (self.hashes.hashed+self.hashes.cached, self.hashes.cached)
+        stats.identical = sum(plan.identical for plan in self.plans)
+        if self.both_ways:
+            stats.conflicts = [path for plan in self.plans for path in plan.conflicts]
+
+    def execute(self):
+        """
+        Applique les plans calcules par plan(). Retourne un SyncStats.
+        """
+        stats = self.stats
+        plan_SRC = self.plans[0]
+        plan_TRGT = self.plans[1] if len(self.plans) > 1 else None
+
+        if self.dry_run:
+            return self.report()
+        if stats.files_to_copy == 0 and not (self.mirror and (plan_SRC.extra_dirs or plan_SRC.extra_files)):
+            self._finish()
+            return stats
+
+        self._start(stats.files_to_copy, sum(plan.num_bytes for plan in self.plans))
+        try:
+            self._copyPlans(plan_SRC, plan_TRGT)
+        except BaseException:
+            self._interrupted()
+            raise
+
+        stats.num_bytes = sum(plan.num_bytes for plan in self.plans)
+        self._finish()
+        return stats
+
+    def _copyPlans(self, plan_SRC, plan_TRGT):
+        stats = self.stats
+        if self.both_ways:
+            #copying files from both sides
+            self.message("--- copying files from dir1 -> dir2 ---")
+            with self._timer('copy'):
+                self.recursiveCopy(plan_SRC, self.src_log, self.trgt_log)
+            if len(plan_TRGT) > 0:
+                self.message("--- copying files from dir2 -> dir1 ---")
+                with self._timer('copy'):
+                    self.recursiveCopy(plan_TRGT, self.trgt_log, self.src_log)
+        else:
+            self.message("--- copying files from source ---")
+            with self._timer('copy'):
+                self.recursiveCopy(plan_SRC, self.src_log, self.trgt_log)
+            if self.mirror:
+                #cleaning target once everything is copied
+                self.message("--- cleaning target directory ---")
+                stats.dirs_deleted, stats.files_deleted = self.cleanTargetDir(plan_SRC)
+
+    def planDirs(self, rel_dirs):
+        """
+        Analyse seulement les dossiers donnes (relatifs a la source), sans descendre dans
+        leurs sous-dossiers deja presents dans la cible. Les nouveaux sous-dossiers sont
+        analyses en entier. Retourne un CopyPlan, a appliquer avec applyPlan.
+        """
+        if not (self.verify or self.dedup):
+            return self._planDirs(rel_dirs)
+        #the cache is closed after every planning (see _afterPlan), it is reopened for this batch
+        self.hashes = checksum.HashCache(os.path.join(self.target, sums_name))
+        try:
+            return self._planDirs(rel_dirs)
+        finally:
+            self.hashes.close()
+
+    def _planDirs(self, rel_dirs):
+        plan = CopyPlan(self.source, self.target)
+        covered = []    #new subtrees already planned in full
+        created = set() #missing parents already added to plan.dirs
+        for rel_dir in sorted(set(rel_dirs), key=lambda path: (path.count(os.sep), path)):
+            if any(rel_dir == path or rel_dir.startswith(path+os.sep) for path in covered):
+                continue
+            src_root = os.path.join(self.source, rel_dir) if rel_dir else self.source
+            trgt_root = os.path.join(self.target, rel_dir) if rel_dir else self.target
+            if not os.path.isdir(src_root):
+                #removed, its parent takes care of it
+                continue
+            missing = []
+            path = trgt_root
+            while not os.path.isdir(path) and path not in created:
+                missing.append(path)
+                path = os.path.dirname(path)
+            plan.dirs.extend(reversed(missing))
+            created.update(missing)
+            if missing:
+                #nothing below exists in the target, the whole subtree is planned
+                covered.append(rel_dir)
+
+            stack = [(rel_dir, src_root, trgt_root, os.path.isdir(trgt_root))]
+            while stack:
+                rel, src_dir, trgt_dir, trgt_exists = stack.pop()
+                subdirs = self.planDir(plan, rel, src_dir, trgt_dir, self.scanDir(src_dir),
+                                       self.scanDir(trgt_dir) if trgt_exists else [], self.src_log)
+                for subdir in subdirs:
+                    if not subdir[3]:
+                        stack.append(subdir)
+                        covered.append(subdir[0])
+        if self.dedup:
+            self.dedupPlan(plan)
+        return plan
+
+    def applyPlan(self, plan):
+        """
+        Applique un plan de source vers cible (copies puis, en mode miroir, nettoyage)
+        sans reecrire l'historique sur le disque. Retourne le SyncStats cumule.
+        """
+        if len(plan) > 0:
+            self._start(len(plan), plan.num_bytes)
+        self.recursiveCopy(plan, self.src_log, self.trgt_log)
+        if self.mirror and (plan.extra_dirs or plan.extra_files):
+            dirs_deleted, files_deleted = self.cleanTargetDir(plan)
+            self.stats.dirs_deleted = (self.stats.dirs_deleted or 0)+dirs_deleted
+            self.stats.files_deleted = (self.stats.files_deleted or 0)+files_deleted
+        self.stats.num_bytes += plan.num_bytes
+        return self.stats
+
+    def report(self):
+        """
+        Mode simulation : annonce les dossiers crees, les copies et, en mode miroir,
+        les suppressions prevues par les plans, sans rien modifier. Retourne un SyncStats.
+        """
+        for plan in self.plans:
+            for path in plan.dirs:
+                self.message("would create directory : "+path)
+            for action in plan.files+plan.links:
+                self.message("would copy : "+action.source+" -> "+action.target, "cyan")
+        plan = self.plans[0]
+        if self.mirror:
+            for path in plan.extra_dirs:
+                files, num_bytes = treeSize(path)
+                self.message("would delete directory : %s (%d files, %.1f MB)" % (path, files, num_bytes/1e6), "red")
+            for path in plan.extra_files:
+                self.message("would delete file : "+path, "red")
+        self.stats.num_bytes = sum(plan.num_bytes for plan in self.plans)
+        self._finish()
+        return self.stats
+
+    def _finish(self):
+        if self.snap is not None:
+            if not self.dry_run:
+                self.snap.record(self.plans[0].scanned, self.plans[0].visited)
+            self.snap.close()
+            self.snap = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if not self.dry_run:
+            with self._timer('log'):
+                self.writeLogsToDisk()
+        if self.throttle is not None:
+            self.stats.throttled = self.throttle.waited
+        self.stats.runtime = time.time()-self._start_time
+
+    def _interrupted(self):
+        #copy stopped by an error or Ctrl-C : what was copied is saved so the next run goes on from there
+        try:
+            if self.snap is not None:
+                snap, self.snap = self.snap, None
+                snap.close()
+            if self.journal is not None:
+                journal, self.journal = self.journal, None
+                journal.close()
+        finally:
+            self.writeLogsToDisk()
+
+    def planCopy(self, source, target, src_log, snap=None):
+        """
+        Parcourt la source une seule fois avec os.scandir et liste en parallele
+        chaque dossier cible correspondant. Retourne un CopyPlan.
+        Si un snapshot est fourni, les paires de dossiers inchangees depuis la
+        derniere execution ne sont pas listees.
+        """
+        plan = CopyPlan(source, target)
+        stack = [("", source, target, os.path.isdir(target))]
+        while stack:
+            rel_dir, src_root, trgt_root, trgt_exists = stack.pop()
+            src_mtime_ns = None
+            if snap is not None:
+                plan.visited.append(rel_dir)
+                src_mtime_ns = os.stat(src_root).st_mtime_ns
+                trgt_mtime_ns = os.stat(trgt_root).st_mtime_ns if trgt_exists else None
+                subdirs = self.skipDir(plan, snap, rel_dir, src_root, trgt_root,
+                                       src_mtime_ns, trgt_mtime_ns)
+                if subdirs is not None:
+                    stack.extend(reversed(subdirs))
+                    continue
+
+            trgt_entries = self.scanDir(trgt_root) if trgt_exists else []
+            src_entries = self.scanDir(src_root)
+            subdirs = self.planDir(plan, rel_dir, src_root, trgt_root, src_entries, trgt_entries,
+                                   src_log, src_mtime_ns)
+            #reversed so that directories are visited in alphabetical order
+            stack.extend(reversed(subdirs))
+
+        if self.dedup:
+            self.dedupPlan(plan)
+        return plan
+
+    def scanDir(self, path):
+        """
+        Liste un dossier avec listDir, en mesurant l'operation s'il y a un profileur.
+        """
+        if self.profiler is None:
+            return listDir(path)
+        start = time.perf_counter()
+        entries = listDir(path)
+        self.profiler.record('scan', path, time.perf_counter()-start, listings=1)
+        return entries
+
+    def skipDir(self, plan, snap, rel_dir, src_root, trgt_root, src_mtime_ns, trgt_mtime_ns):
+        """
+        Si la paire de dossiers n'a pas change depuis le snapshot, enregistre son contenu
+        connu dans le plan et retourne ses sous-dossiers. Sinon retourne None.
+        """
+        if trgt_mtime_ns is None or not snap.isUnchanged(rel_dir, src_mtime_ns, trgt_mtime_ns):
+            return None
+        src_names, trgt_names, subdirs = snap.entries(rel_dir)
+        plan.listing[src_root] = src_names
+        plan.listing[trgt_root] = trgt_names
+        plan.skipped_dirs += 1
+        return [(os.path.join(rel_dir, name), os.path.join(src_root, name),
+                 os.path.join(trgt_root, name), name in trgt_names) for name in subdirs
+                if self.filter.matchDir(name, rel_dir)]
+
+    def needsStat(self, entry, rel_dir):
+        """
+        Verifie si une entree de la source sera comparee a la cible (et donc stat'ee).
+        """
+        return (not entry.is_dir() and not isIgnored(entry.name)
+                and self.filter.matchFile(entry.name, rel_dir))
+
+    def planDir(self, plan, rel_dir, src_root, trgt_root, src_entries, trgt_entries, src_log,
+                src_mtime_ns=None):
+        """
+        Compare le contenu d'une paire de dossiers (entrees de os.scandir triees par nom)
+        et ajoute au plan les actions necessaires. Retourne les sous-dossiers a parcourir,
+        (dossier relatif, dossier source, dossier cible, existe dans la cible).
+        """
+        start = time.perf_counter()
+        stat_calls = 0
+        hashes = self.hashes if self.verify else None
+        file_filter = self.filter
+        trgt_entries = dict((entry.name, entry) for entry in trgt_entries)
+        subdirs = []
+        for entry in src_entries:
+            target_path = os.path.join(trgt_root, entry.name)
+            trgt_entry = trgt_entries.get(entry.name)
+            if entry.is_dir():
+                if not file_filter.matchDir(entry.name, rel_dir):
+                    #excluded subtrees are never walked
+                    continue
+                if trgt_entry is None:
+                    plan.dirs.append(target_path)
+                if not entry.is_symlink():
+                    subdirs.append((os.path.join(rel_dir, entry.name), entry.path, target_path,
+                                    trgt_entry is not None))
+                continue
+            if isIgnored(entry.name) or not file_filter.matchFile(entry.name, rel_dir):
+                continue
+
+            src_stat = entry.stat()
+            stat_calls += 1
+            if not file_filter.matchStat(src_stat):
+                continue
+            trgt_stat = trgt_entry.stat() if trgt_entry is not None else None
+            stat_calls += trgt_stat is not None
+            log_time = src_log.get(entry.path)
+            kind = evalFile_mtime(src_stat, trgt_stat, log_time)
+            if kind == 'update' and hashes is not None and src_stat.st_size == trgt_stat.st_size:
+                if hashes.digest(entry.path, src_stat) == hashes.digest(target_path, trgt_stat):
+                    plan.identical += 1
+                    kind = None
+            if kind is not None:
+                plan.files.append(CopyAction(kind, entry.path, target_path, entry.name,
+                                             src_stat.st_size, log_time is not None))
+                plan.num_bytes += src_stat.st_size
+                if self.dedup and kind == 'new':
+                    plan.stats[entry.path] = src_stat
+            elif self.dedup and trgt_stat is not None:
+                plan.candidates.append((target_path, trgt_stat))
+
+        src_names = set(entry.name for entry in src_entries)
+        plan.listing[src_root] = src_names
+        plan.listing[trgt_root] = set(trgt_entries)
+        if src_mtime_ns is not None:
+            plan.scanned.append((rel_dir, src_mtime_ns, [snapshot.entryRow(entry) for entry in src_entries],
+                                 trgt_root))
+        for name, trgt_entry in sorted(trgt_entries.items()):
+            if name in src_names or isMeta(name):
+                continue
+            #excluded entries are left alone, in the target as well
+            if trgt_entry.is_dir():
+                if file_filter.matchDir(name, rel_dir):
+                    plan.extra_dirs.append(trgt_entry.path)
+            elif file_filter.matchFile(name, rel_dir):
+                plan.extra_files.append(trgt_entry.path)
+                if self.dedup and trgt_entry.is_file():
+                    plan.candidates.append((trgt_entry.path, trgt_entry.stat()))
+        if self.profiler is not None:
+            self.profiler.record('compare', src_root, time.perf_counter()-start, stat_calls=stat_calls)
+        return subdirs
+
+    def planBothWays(self):
+        """
+        Analyse les deux arborescences en une seule passe (option -c) : chaque paire de
+        dossiers est listee une fois et les deux listes triees sont fusionnees.
+        Retourne les plans (source -> cible, cible -> source), qui ne se recoupent pas.
+        """
+        left = CopyPlan(self.source, self.target)
+        right = CopyPlan(self.target, self.source)
+        stack = [("", self.source, self.target, True, os.path.isdir(self.target))]
+        while stack:
+            rel_dir, left_root, right_root, left_exists, right_exists = stack.pop()
+            left_entries = self.scanDir(left_root) if left_exists else []
+            right_entries = self.scanDir(right_root) if right_exists else []
+            subdirs = self.planPair(left, right, rel_dir, left_root, right_root,
+                                    left_entries, right_entries)
+            #reversed so that directories are visited in alphabetical order
+            stack.extend(reversed(subdirs))
+
+        if self.dedup:
+            self.dedupPlan(left)
+            self.dedupPlan(right)
+        return left, right
+
+    def planPair(self, left, right, rel_dir, left_root, right_root, left_entries, right_entries):
+        """
+        Fusionne les entrees triees d'une paire de dossiers (merge-join) et ajoute a chaque
+        plan les copies partant de son cote. L'historique donne le moment de la derniere
+        synchronisation d'un fichier : s'il a change des deux cotes depuis, c'est un conflit,
+        la version la plus recente est copiee et l'autre gardee avec le suffixe -old.
+        Retourne les sous-dossiers a parcourir,
+        (dossier relatif, dossier gauche, dossier droit, existe a gauche, existe a droite).
+        """
+        start = time.perf_counter()
+        stat_calls = 0
+        hashes = self.hashes if self.verify else None
+        left.listing[left_root] = set(entry.name for entry in left_entries)
+        left.listing[right_root] = set(entry.name for entry in right_entries)
+        subdirs = []
+        i = j = 0
+        while i < len(left_entries) or j < len(right_entries):
+            l = left_entries[i] if i < len(left_entries) else None
+            r = right_entries[j] if j < len(right_entries) else None
+            if r is None or (l is not None and l.name < r.name):
+                r = None
+                i += 1
+            elif l is None or r.name < l.name:
+                l = None
+                j += 1
+            else:
+                i += 1
+                j += 1
+            name = (l or r).name
+            if isMeta(name):
+                continue
+            rel_path = os.path.join(rel_dir, name)
+            left_path = os.path.join(left_root, name)
+            right_path = os.path.join(right_root, name)
+            left_dir = l is not None and l.is_dir()
+            right_dir = r is not None and r.is_dir()
+
+            if left_dir or right_dir:
+                accepted = self.filter.matchDir(name, rel_dir)
+            else:
+                accepted = self.filter.matchFile(name, rel_dir)
+            if not accepted:
+                continue
+            if l is not None and r is not None and left_dir != right_dir:
+                self.message("conflict, file and directory with the same name : "+rel_path, "orange", 1)
+                left.conflicts.append(rel_path)
+                continue
+            if left_dir or right_dir:
+                if l is None:
+                    right.dirs.append(left_path)
+                elif r is None:
+                    left.dirs.append(right_path)
+                if not any(entry is not None and entry.is_symlink() for entry in (l, r)):
+                    subdirs.append((rel_path, left_path, right_path, l is not None, r is not None))
+                continue
+            if isIgnored(name):
+                continue
+
+            left_stat = l.stat() if l is not None else None
+            right_stat = r.stat() if r is not None else None
+            stat_calls += (l is not None)+(r is not None)
+            if not all(self.filter.matchStat(st) for st in (left_stat, right_stat) if st is not None):
+                continue
+            if r is None:
+                self.addAction(left, 'new', l, left_stat, right_path, self.src_log)
+                continue
+            if l is None:
+                self.addAction(right, 'new', r, right_stat, left_path, self.trgt_log)
+                continue
+
+            sync_times = [t for t in (self.src_log.get(left_path), self.trgt_log.get(right_path))
+                          if t is not None]
+            side = evalPair(left_stat, right_stat, max(sync_times) if sync_times else None)
+            if side is not None and hashes is not None and left_stat.st_size == right_stat.st_size:
+                if hashes.digest(left_path, left_stat) == hashes.digest(right_path, right_stat):
+                    left.identical += 1
+                    side = None
+            if side == 'conflict':
+                self.message("conflict, changed on both sides : "+rel_path, "orange", 1)
+                left.conflicts.append(rel_path)
+                side = 'left' if left_stat.st_mtime >= right_stat.st_mtime else 'right'
+                kind = 'conflict'
+            else:
+                kind = 'update'
+            if side == 'left':
+                self.addAction(left, kind, l, left_stat, right_path, self.src_log)
+            elif side == 'right':
+                self.addAction(right, kind, r, right_stat, left_path, self.trgt_log)
+            elif self.dedup:
+                left.candidates.append((right_path, right_stat))
+                right.candidates.append((left_path, left_stat))
+        if self.profiler is not None:
+            self.profiler.record('compare', left_root, time.perf_counter()-start, stat_calls=stat_calls)
+        return subdirs
+
+    def addAction(self, plan, kind, entry, src_stat, target_path, src_log):
+        """
+        Ajoute au plan la copie d'une entree de os.scandir deja stat'ee.
+        """
+        plan.files.append(CopyAction(kind, entry.path, target_path, entry.name,
+                                     src_stat.st_size, entry.path in src_log))
+        plan.num_bytes += src_stat.st_size
+        if self.dedup and kind == 'new':
+            plan.stats[entry.path] = src_stat
+
+    def dedupPlan(self, plan):
+        """
+        Remplace la copie des nouveaux fichiers dont le contenu se trouve deja dans la cible
+        (ou dans un autre fichier copie par ce plan) par un lien vers ce fichier.
+        Seuls les fichiers de meme taille sont compares.
+        """
+        by_size = {}
+        for path, st in plan.candidates:
+            if st.st_size > 0:
+                by_size.setdefault(st.st_size, []).append((path, st, path))
+
+        files = []
+        for action in plan.files:
+            if action.kind != 'new' or action.size == 0:
+                files.append(action)
+                continue
+            src_stat = plan.stats[action.source]
+            origin = None
+            candidates = by_size.setdefault(action.size, [])
+            if candidates:
+                digest = self.hashes.digest(action.source, src_stat)
+                for path, st, target_path in candidates:
+                    if self.hashes.digest(path, st) == digest:
+                        origin = target_path
+                        break
+            if origin is None:
+                #the first copy of a content becomes the origin of the next duplicates
+                candidates.append((action.source, src_stat, action.target))
+                files.append(action)
+            else:
+                plan.links.append(action._replace(kind='link', origin=origin))
+                plan.num_bytes -= action.size
+        plan.files = files
+        plan.candidates = []
+        plan.stats = {}
+
+    def copyFile(self, source_file, target_file, size=0, backup=None):
+        """
+        Copie un fichier avec le backend le plus rapide disponible (voir transfer.py)
+        et comptabilise le debit obtenu pour le resume de fin.
+        Les gros fichiers sont suivis dans le journal, et une copie interrompue reprend
+        la ou elle s'etait arretee. 'backup' recoit l'ancienne version du fichier.
+        """
+        start = time.time()
+        offset, progress = 0, None
+        if self.journal is not None and size > transfer.SEGMENT_SIZE:
+            offset = self.journal.resumeOffset(source_file, target_file, size)
+            if offset > 0:
+                self.message("resuming interrupted copy at %.1f MB : %s" % (offset/1e6, os.path.basename(target_file)),
+                             "orange")
+            self.journal.begin(source_file, target_file, size, os.stat(source_file).st_mtime_ns, offset)
+            progress = lambda position: self.journal.update(target_file, position)
+        backend, num_bytes = transfer.copyFile(source_file, target_file, offset, progress, backup, self.throttle)
+        if progress is not None:
+            self.journal.done(target_file)
+        self.recordCopy(backend, num_bytes, time.time()-start)
+        return num_bytes
+
+    def recordCopy(self, backend, num_bytes, elapsed):
+        """
+        Comptabilise une copie faite avec 'backend' pour le resume de fin.
+        """
+        with self.lock:
+            stats = self.stats.copy_stats.setdefault(backend, [0, 0, 0.0, None])
+            stats[0] += 1
+            stats[1] += num_bytes
+            stats[2] += elapsed
+            #throughput of tiny files is mostly syscall overhead, only rate files of 1 MB or more
+            if num_bytes >= 1000000 and elapsed > 0:
+                rate = num_bytes/elapsed/1e6
+                if stats[3] is None or rate < stats[3]:
+                    stats[3] = rate
+
+    def deltaCopyFile(self, source_file, target_file):
+        """
+        Met a jour un fichier existant en ne transferant que les blocs modifies.
+        """
+        sent, size = transfer.deltaCopy(source_file, target_file, throttle=self.throttle)
+        with self.lock:
+            delta_stats = self.stats.delta_stats
+            delta_stats[0] += 1
+            delta_stats[1] += size
+            delta_stats[2] += sent
+        return size
+
+    def doCopyFile(self, action, src_log):
+        """
+        Execute une action de copie planifiee par planCopy.
+        """
+        source_file, target_file, file_name = action.source, action.target, action.name
+        start = time.perf_counter()
+
+        if action.logged:
+            with self.lock:
+                src_log.pop(source_file, None)
+
+        if action.kind == 'new':
+            self.message("copying file : "+file_name, "cyan")
+            written = self.copyFile(source_file,target_file,action.size)
+        elif action.kind == 'conflict':
+            self.message("conflict, copying newer version (other one kept) : "+file_name, "orange", 1)
+            written = self.copyFile(source_file,target_file,action.size,oldVersionName(target_file))
+        elif self.overwrite and self.delta and action.size >= delta_min_size:
+            self.message("updating changed blocks : "+file_name, "red")
+            written = self.deltaCopyFile(source_file,target_file)
+        elif self.overwrite:
+            self.message("overwriting file : "+file_name, "red")
+            written = self.copyFile(source_file,target_file,action.size)
+        else:
+            self.message("copying new file (old version kept) : "+file_name, "cyan")
+            written = self.copyFile(source_file,target_file,action.size,oldVersionName(target_file))
+        if self.profiler is not None:
+            self.profiler.record('copy', target_file, time.perf_counter()-start,
+                                 bytes_read=action.size, bytes_written=written)
+        return 1
+
+    def doLinkFile(self, action, src_log):
+        """
+        Cree un doublon dans la cible a partir d'un fichier de meme contenu.
+        """
+        if action.logged:
+            with self.lock:
+                src_log.pop(action.source, None)
+        self.message("linking duplicate : "+action.name+" -> "+os.path.basename(action.origin), "cyan")
+        start = time.perf_counter()
+        method = transfer.linkFile(action.origin, action.target, self.throttle)
+        if self.profiler is not None:
+            self.profiler.record('copy', action.target, time.perf_counter()-start)
+        with self.lock:
+            self.stats.link_stats[method] = self.stats.link_stats.get(method, 0)+1
+        return 1
+
+    def recursiveCopy(self, plan, src_log, trgt_log):
+        """
+        Recree l'arborescence de la source dans le dossier cible et copie les fichiers,
+        en suivant le plan calcule par planCopy.
+        """
+        stats = self.stats
+        for target_path in plan.dirs:
+            self.message("created target path : "+target_path)
+            os.mkdir(target_path)
+            stats.dirs_created += 1
+
+        if self.jobs > 1:
+            self.parallelCopy(plan.files, src_log, trgt_log)
+        else:
+            for action in plan.files:
+                if self.doCopyFile(action, src_log):
+                    stats.files_copied += 1
+                    trgt_log[action.target] = time.time()
+                self._advance(action)
+
+        #duplicates may point to files copied just above
+        for action in plan.links:
+            if self.doLinkFile(action, src_log):
+                stats.files_copied += 1
+                trgt_log[action.target] = time.time()
+            self._advance(action)
+
+        return (stats.dirs_created, stats.files_copied)
+
+    def parallelCopy(self, actions, src_log, trgt_log):
+        """
+        Copie les fichiers du plan avec 'jobs' threads. Les gros fichiers ont leur propre
+        groupe de threads pour ne pas bloquer les petits fichiers derriere eux.
+        """
+        def copy(action):
+            copied = self.doCopyFile(action, src_log)
+            with self.lock:
+                if copied:
+                    self.stats.files_copied += 1
+                    trgt_log[action.target] = time.time()
+                self._advance(action)
+
+        large = [action for action in actions if action.size >= large_file_size]
+        small = [action for action in actions if action.size < large_file_size]
+        large_jobs = max(1, self.jobs//4)
+        with ThreadPoolExecutor(large_jobs) as large_pool, \
+             ThreadPoolExecutor(max(1, self.jobs-large_jobs)) as small_pool:
+            futures = [large_pool.submit(copy, action) for action in large]
+            futures += [small_pool.submit(copy, action) for action in small]
             try:
-                del files[files.index(log_name)]
-            except:
-                pass
-        
-        for file in files:
-            target_path = os.path.join(target,rel_source,file)
-            source_path = os.path.join(root,file)
-            src_name, src_ext = source_path.rsplit(".", 1)
-            
-            if mode == 'e':
-                if not src_ext in ext:
-                    count += evalFile_mtime(source_path, target_path, src_log)
-            elif mode == 'i':
-                if src_ext in ext:
-                    count += evalFile_mtime(source_path, target_path, src_log)
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                #Ctrl-C or a failed copy : only the copies already running are waited for
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def cleanTargetDir(self, plan):
+        """
+        Enleve du dossier cible ce qui n'est pas dans le dossier source, d'apres l'analyse :
+        seulement les dossiers en trop les plus hauts (leur contenu part avec eux) et les
+        fichiers en trop. Mis a la corbeille par lots, ou supprimes si trash est False.
+        Retourne le nombre de dossiers et de fichiers enleves.
+        """
+        verb = "moving %s to trash : " if self.trash else "deleting %s : "
+        for path in plan.extra_dirs:
+            self.message(verb % "directory"+os.path.basename(path))
+        for path in plan.extra_files:
+            self.message(verb % "file"+os.path.basename(path))
+
+        with self._timer('trash'):
+            if self.trash:
+                paths = plan.extra_dirs+plan.extra_files
+                for i in range(0, len(paths), trash_batch_size):
+                    start = time.perf_counter()
+                    trashPaths(paths[i:i+trash_batch_size])
+                    if self.profiler is not None:
+                        self.profiler.record('trash', paths[i], time.perf_counter()-start)
             else:
-                count += evalFile_mtime(source_path, target_path, src_log)
-    return count
-    
-def doCopyFile(source_file, target_file, file_name, src_log):
+                for paths, remove in ((plan.extra_dirs, shutil.rmtree), (plan.extra_files, os.remove)):
+                    for path in paths:
+                        start = time.perf_counter()
+                        remove(path)
+                        if self.profiler is not None:
+                            self.profiler.record('trash', path, time.perf_counter()-start)
+        return (len(plan.extra_dirs), len(plan.extra_files))
+
+    def writeLogsToDisk(self):
+        """
+        Ecrit les fichiers d'historique sur le disque.
+        """
+        for root, log in ((self.source, self.src_log), (self.target, self.trgt_log)):
+            path = os.path.join(root,log_name)
+            start = time.perf_counter()
+            if isinstance(log, history.History):
+                written = log.save()
+            else:
+                #filled by hand before the history was read
+                written = history.writeLog(path, root, log)
+            if self.profiler is not None:
+                self.profiler.record('log', path, time.perf_counter()-start, bytes_written=written)
+
+    def readLog(self, root):
+        """
+        Ouvre l'historique garde a la racine de 'root' (voir history.py).
+        """
+        path = os.path.join(root, log_name)
+        if self.profiler is None:
+            return history.History(path, root)
+        start = time.perf_counter()
+        log = history.History(path, root)
+        size = os.path.getsize(path) if log else 0
+        self.profiler.record('log', path, time.perf_counter()-start, stat_calls=1, bytes_read=size)
+        return log
+
+    def cleanLogs(self, listing=None, logs=None):
+        """
+        Enleve tout fichier de l'historique qui n'est plus dans l'arborescence concourante.
+        Supprimer l'historique du disque si vide.
+        'listing' donne le contenu des dossiers deja lus lors de l'analyse ({dossier: noms}),
+        seuls les fichiers des autres dossiers sont verifies sur le disque.
+        'logs' : historiques a nettoyer, ceux de la source et de la cible par defaut.
+        """
+        listing = listing or {}
+        start = time.perf_counter()
+        stat_calls = 0
+        for log in logs or (self.src_log, self.trgt_log):
+            stale = []
+            for file in log:
+                path, name = os.path.split(file)
+                names = listing.get(path)
+                if names is None:
+                    stat_calls += 1
+                    if not os.path.exists(file):
+                        stale.append(file)
+                elif name not in names:
+                    stale.append(file)
+            for file in stale:
+                #sys.stdout.write(console.colour("deleting log entry : "+file+'\n', "orange"))
+                log.pop(file, None)
+        if self.profiler is not None:
+            self.profiler.record('log', None, time.perf_counter()-start, stat_calls=stat_calls)
+
+# --------------------------
+# Command line
+# --------------------------
+def splitList(text):
+    return [item for item in text.split(',') if item]
+
+def parseArgs(argv):
     """
-    Verifie si le fichier passe en parametre doit etre copie et, le cas echeant, procede a la copie.
+    Traduit les arguments de la ligne de commande en parametres de SyncJob.
     """
-    global mode, ext, overwrite
-    src_name, src_ext = source_file.rsplit(".", 1)
-    
-    if mode == 'e':
-        if src_ext in ext:
-            return 0
-    if mode == 'i':
-        if not src_ext in ext:
-            return 0
-    
-    i = inLog(source_file, src_log)
-    if i != -1:
-        if os.path.getmtime(source_file) > src_log[i][1]:
-            del src_log[i]
-            if overwrite:
-                printMessage(getMsgTimeStamp(0)+"overwriting file : "+file_name, "red")
-                shutil.copy(source_file,target_file)
-            else:
-                printMessage(getMsgTimeStamp(0)+"copying new file (old version kept) : "+file_name, "cyan")
-                name,ext = target_file.rsplit(".", 1)
-                old = name+"-old."+ext
-                shutil.move(target_file,old)
-                shutil.copy(source_file,target_file)
-            return 1
-        if os.path.exists(target_file):
-            return 0
-    
-    if os.path.exists(target_file):
-        if os.path.getmtime(source_file) > os.path.getmtime(target_file):
-            if overwrite:
-                printMessage(getMsgTimeStamp(0)+"overwriting file : "+file_name, "red")
-                shutil.copy(source_file,target_file)
-            else:
-                printMessage(getMsgTimeStamp(0)+"copying new file (old version kept) : "+file_name, "cyan")
-                name,ext = target_file.rsplit(".", 1)
-                old = name+"-old."+ext
-                shutil.move(target_file,old)
-                shutil.copy(source_file,target_file)
-            return 1
+    argv = list(argv)
+    config = {}
+
+    #sets the flags
+    for flag, key, value in (('-k', 'overwrite', False), ('-s', 'incremental', True),
+                             ('--checksum', 'verify', True), ('--dedup', 'dedup', True),
+                             ('-b', 'delta', True), ('-a', 'engine', 'async'),
+                             ('--watch', 'watch', True), ('--dry-run', 'dry_run', True),
+                             ('--no-trash', 'trash', False), ('-q', 'output', 'quiet'),
+                             ('--json', 'output', 'json'), ('--low-priority', 'low_priority', True)):
+        if flag in argv:
+            argv.pop(argv.index(flag))
+            config[key] = value
+
+    #sets the options followed by a value
+    for flag, key, convert in (('-j', 'jobs', int), ('--profile', 'profile', str),
+                               ('--cprofile', 'cprofile', str), ('--include', 'include', splitList),
+                               ('--exclude', 'exclude', splitList), ('--min-size', 'min_size', filters.parseSize),
+                               ('--max-size', 'max_size', filters.parseSize),
+                               ('--newer', 'newer_than', filters.parseAge),
+                               ('--older', 'older_than', filters.parseAge),
+                               ('--bwlimit', 'bwlimit', filters.parseSize), ('--files-limit', 'files_limit', float),
+                               ('--throttle-file', 'throttle_file', str)):
+        if flag in argv:
+            index = argv.index(flag)
+            argv.pop(index)
+            config[key] = convert(argv.pop(index))
+
+    #sets the extensions
+    for flag in ('-e', '-i'):
+        if flag in argv:
+            index = argv.index(flag)
+            argv.pop(index)
+            config['ext'] = argv.pop(index).split(',')
+            config['ext_mode'] = flag[1]
+            break
+
+    #what remains : the mode (-c or -d), then the source and the targets
+    config['both_ways'] = '-c' in argv[1:]
+    config['mirror'] = '-d' in argv[1:]
+    paths = [arg for arg in argv[1:] if not arg.startswith('-')]
+    if len(paths) < 2:
+        raise ValueError("a source and a target are needed")
+    config['source'] = paths[0]
+    if len(paths) > 2:
+        config['targets'] = paths[1:]
     else:
-        printMessage(getMsgTimeStamp(0)+"copying file : "+file_name, "cyan")
-        shutil.copy(source_file,target_file)
-        return 1
-    return 0
+        config['target'] = paths[-1]
+    return config
 
-def recursiveCopy(source, target, src_log, trgt_log, dcount_offset=0, fcount_offset=0):
+def printSummary(stats):
     """
-    Traverse tous les dossiers et sous dossiers de la source et recre l'arborescence dans le dossier cible.
+    Affiche le resume de fin d'execution.
     """
-    global pbar
-    
-    dcount = dcount_offset
-    fcount = fcount_offset
-    for root, dirs, files in os.walk(source):
-        printMessage(getMsgTimeStamp(0)+"scanning "+root)
-        rel_source = os.path.relpath(root,source)
-        if rel_source == ".":rel_source=""
-        
-        for dir in dirs:
-            target_path = os.path.join(target,rel_source,dir)
-            if not os.path.exists(target_path):
-                printMessage(getMsgTimeStamp(0)+"created target path : "+target_path)
-                os.mkdir(target_path)
-                dcount += 1
-        
-        if len(files)>0:
-            if files[0].find("DS_Store") != -1: del files[0]
-            try:
-                del files[files.index(log_name)]
-            except:
-                pass
-        
-        for file in files:
-            target_path = os.path.join(target,rel_source,file)
-            source_path = os.path.join(root,file)
-            if doCopyFile(source_path, target_path, file, src_log):
-                fcount += 1
-                trgt_log.append([target_path,time.time()])
-            pbar.update(fcount)
-        
-    return (dcount,fcount)
-                
-def cleanTargetDir(source,target):
-    """
-    Enleve tout ce qui se trouve dans le dossier cible et
-    qui n'est pas dans le dossier source.
-    """
-    dcount = 0
-    fcount = 0
-    for root, dirs, files in os.walk(target):
-        rel_target = os.path.relpath(root,target)
-        if rel_target == ".":rel_target=""
-        for dir in dirs:
-            curpath = os.path.join(source,rel_target,dir)
-            if not os.path.exists(curpath):
-                print(getMsgTimeStamp(0)+"moving directory to trash : ", dir)
-                send2trash(os.path.join(root,dir))
-                dcount += 1
-        for file in files:
-            curpath = os.path.join(source,rel_target,file)
-            if not os.path.exists(curpath):
-                print(getMsgTimeStamp(0)+"moving file to trash : ", file)
-                send2trash(os.path.join(root,file))
-                fcount += 1
-    return (dir_count, files_count)
-  
-def inLog(file, log):
-    """
-    Verifie la presence d'un fichier dans l'historique et retourne son index.
-    Retourne -1 en cas d'échec.
-    """
-    for i, item in enumerate(log):
-        if file == item[0]:
-            return i
-    return -1
-
-def writeLogsToDisk():
-    """
-    Ecrit les fichiers d'historique sur le disque.
-    """
-    global src_log, trgt_log, dir1, dir2
-    
-    if len(src_log) > 0:
-        with open(os.path.join(dir1,log_name), 'wb') as f:
-            pickle.dump(src_log, f)
+    def info(line):
+        print(console.colour(getMsgTimeStamp(0)+line, "orange"))
+
+    print(console.colour(getMsgTimeStamp(0)+"*** DONE ***", "orange"))
+    info("it took %.3fs to copy all files" % stats.runtime)
+    info("Directories created : "+str(stats.dirs_created))
+    if stats.skipped_dirs is not None:
+        info("Directories unchanged (not scanned) : "+str(stats.skipped_dirs))
+    if stats.dirs_deleted is not None:
+        info("Directories deleted : "+str(stats.dirs_deleted))
+    info("Files copied : "+str(stats.files_copied))
+    info("Data copied : %.1f MB" % (stats.num_bytes/1e6))
+    if stats.runtime > 0:
+        info("Average : %.1f files/s, %.1f MB/s" % (stats.files_copied/stats.runtime,
+                                                    stats.num_bytes/stats.runtime/1e6))
+    if stats.files_deleted is not None:
+        info("Files deleted : "+str(stats.files_deleted))
+    for backend, (files, num_bytes, seconds, slowest) in sorted(stats.copy_stats.items()):
+        line = "Backend %s : %d files, %.1f MB" % (backend, files, num_bytes/1e6)
+        if seconds > 0:
+            line += ", %.1f MB/s" % (num_bytes/seconds/1e6)
+        if slowest is not None:
+            line += " (slowest file %.1f MB/s)" % slowest
+        info(line)
+    if stats.hashed is not None:
+        info("Files hashed : %d (%d digests from cache)" % stats.hashed)
+    if stats.conflicts:
+        info("Conflicts (changed on both sides, older version kept with -old) : "+str(len(stats.conflicts)))
+        for path in stats.conflicts:
+            info("    "+path)
+    if stats.throttled is not None:
+        info("Throttled : %.1fs spent waiting" % stats.throttled)
+    if stats.identical > 0:
+        info("Identical content (not copied) : "+str(stats.identical))
+    for method, files in sorted(stats.link_stats.items()):
+        info("Duplicates linked (%s) : %d" % (method, files))
+    delta_stats = stats.delta_stats
+    if delta_stats[0] > 0:
+        info("Delta : %d files, %.1f MB sent for %.1f MB (%.1f%%)"
+             % (delta_stats[0], delta_stats[2]/1e6, delta_stats[1]/1e6,
+                100.0*delta_stats[2]/max(delta_stats[1], 1)))
+    print("")
+
+def printReport(job):
+    """
+    Affiche le resume d'une simulation (--dry-run).
+    """
+    def info(line):
+        print(console.colour(getMsgTimeStamp(0)+line, "orange"))
+
+    stats = job.stats
+    print(console.colour("\n"+getMsgTimeStamp(0)+"*** DRY RUN, nothing was changed ***", "orange"))
+    info("Directories to create : "+str(sum(len(plan.dirs) for plan in job.plans)))
+    info("Files to copy : %d (%.1f MB)" % (stats.files_to_copy, stats.num_bytes/1e6))
+    if job.mirror:
+        plan = job.plans[0]
+        info("Directories to delete : "+str(len(plan.extra_dirs)))
+        info("Files to delete : "+str(len(plan.extra_files)))
+    if stats.conflicts:
+        info("Conflicts : "+str(len(stats.conflicts)))
+    print("")
+
+def printFanOut(job, output, display):
+    """
+    Affiche le resume de chaque cible d'une synchronisation vers plusieurs cibles.
+    """
+    for target_job in job.target_jobs:
+        error = job.errors.get(target_job.target)
+        if output == 'json':
+            display.write(dict(event='summary', target=target_job.target, error=error, **vars(target_job.stats)))
+            continue
+        print(console.colour("\n"+getMsgTimeStamp(0)+"=== target : "+target_job.target+" ===", "orange"))
+        if error is not None:
+            print(console.colour(getMsgTimeStamp(2)+"target abandoned : "+error, "red"))
+            if not target_job.plans:
+                continue
+        if job.dry_run:
+            printReport(target_job)
+        else:
+            printSummary(target_job.stats)
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+    if len(argv) < 3:
+        print(__doc__)
+        return 0
+
+    import progress
+    config = parseArgs(argv)
+    output = config.pop('output', None)
+    if output == 'json':
+        display = progress.JsonDisplay()
     else:
-        if os.path.exists(os.path.join(dir1,log_name)):
-            os.remove(os.path.join(dir1,log_name))
-            
-    if len(trgt_log) > 0:
-        with open(os.path.join(dir2,log_name), 'wb') as f:
-            pickle.dump(trgt_log, f)
+        width, height = console.getTerminalSize()
+        display = progress.TerminalDisplay(width, quiet=output == 'quiet')
+    watch_mode = config.pop('watch', False)
+    if watch_mode and (config.get('both_ways') or config.get('dry_run')):
+        print(console.colour(getMsgTimeStamp(2)+"--watch is not available with -c or --dry-run", "red"))
+        return 1
+    fan_out = 'targets' in config
+    if fan_out and (config.get('both_ways') or watch_mode or config.get('engine')):
+        print(console.colour(getMsgTimeStamp(2)+"several targets are not available with -c, -a or --watch", "red"))
+        return 1
+    profile_path = config.pop('profile', None)
+    cprofile_path = config.pop('cprofile', None)
+    if profile_path is not None:
+        import instrument
+        config['profiler'] = instrument.Profiler()
+    bwlimit = config.pop('bwlimit', None)
+    files_limit = config.pop('files_limit', None)
+    throttle_file = config.pop('throttle_file', None)
+    if bwlimit or files_limit or throttle_file:
+        import throttle
+        config['throttle'] = throttle.Throttle(bwlimit, files_limit, throttle_file)
+        config['throttle'].installSignals()
+    low_priority = config.pop('low_priority', False)
+    if config.pop('engine', None) == 'async':
+        import aiosync
+        config['concurrency'] = config.pop('jobs', aiosync.DEFAULT_CONCURRENCY)
+        job = aiosync.AsyncSyncJob(callback=display, **config)
+    elif fan_out:
+        import fanout
+        job = fanout.FanOutJob(callback=display, **config)
     else:
-        if os.path.exists(os.path.join(dir2,log_name)):
-            os.remove(os.path.join(dir2,log_name))
-            
-def cleanLogs():
-    """
-    Enleve tout fichier de l'historique qui n'est plus dans l'arborescence concourante.
-    Supprimer l'historique du disque si vide.
-    """
-    global src_log, trgt_log
-    to_del = []
-    if len(src_log) > 0:
-        for i, item in enumerate(src_log):
-            if not os.path.exists(item[0]):
-                to_del.append(i)
-                #sys.stdout.write(console.colour("deleting log entry : "+src_log[i][0]+'\n', "orange"))
-        while len(to_del)>0:
-            del src_log[to_del.pop()]
-                
-    if len(trgt_log) > 0:
-        for i, item in enumerate(trgt_log):
-            if not os.path.exists(item[0]):
-                to_del.append(i)
-                #sys.stdout.write(console.colour("deleting log entry : "+trgt_log[i][0]+'\n', "orange"))
-        while len(to_del) > 0:
-            del trgt_log[to_del.pop()]
-
-def main():
-    global pbar
-    
-    ftocp_SRC = getNumFilesToCopy(dir1, dir2, src_log)
-    ftocp_TRGT = 0
-    if opt == '-c':
-        ftocp_TRGT = getNumFilesToCopy(dir2, dir1, trgt_log)
-    num_files_to_copy = ftocp_SRC+ftocp_TRGT
-    
-    if num_files_to_copy == 0:
+        job = SyncJob(callback=display, **config)
+    if job.throttle is not None:
+        job.throttle.on_change = lambda text: job.message(text, "orange")
+        job.message("throttle : "+job.throttle.describe(), "orange")
+    if low_priority:
+        import throttle
+        if not throttle.lowPriority():
+            job.message("--low-priority : the disk priority can't be changed on this system, only the CPU one", "orange", 1)
+    if cprofile_path is not None:
+        import cProfile
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+    try:
+        if watch_mode:
+            import watch
+            try:
+                stats = watch.Watcher(job).run()
+            except KeyboardInterrupt:
+                stats = job.stats
+        else:
+            stats = job.run()
+    finally:
+        display.close()
+        if cprofile_path is not None:
+            cprofiler.disable()
+            cprofiler.dump_stats(cprofile_path)
+        if profile_path is not None:
+            job.profiler.dump(profile_path)
+
+    if fan_out:
+        printFanOut(job, output, display)
+    elif output == 'json':
+        display.write(dict(event='summary', **vars(stats)))
+    elif job.dry_run:
+        printReport(job)
+    elif display.pbar is None:
         print(console.colour("\n"+getMsgTimeStamp(0)+"--- no files to copy ---\n", "red"))
-        return 0
     else:
-        pbar = console.ProgressBar(0, num_files_to_copy, width)
-    
-    if opt == None:
-        #no options specified
-        printMessage(getMsgTimeStamp(0)+"--- copying files from source ---")
-        cdir, cfiles = recursiveCopy(dir1, dir2, src_log, trgt_log)
-    elif opt == "-c":
-        #copying files from both sides
-        printMessage(getMsgTimeStamp(0)+"--- copying files from dir1 -> dir2 ---")
-        cdir, cfiles = recursiveCopy(dir1, dir2, src_log, trgt_log)
-        if ftocp_TRGT > 0:
-            printMessage(getMsgTimeStamp(0)+"--- copying files from dir2 -> dir1 ---")
-            cdir, cfiles = recursiveCopy(dir2, dir1, trgt_log, src_log, cdir, cfiles)
-    elif opt == "-d":
-        #copying files from source and then cleaning target
-        printMessage(getMsgTimeStamp(0)+"--- copying files from source ---")
-        cdir, cfiles = recursiveCopy(dir1, dir2, src_log, trgt_log)
-        printMessage(getMsgTimeStamp(0)+"--- cleaning target directory ---")
-        ddir, dfiles = cleanTargetDir(dir1,dir2)
-
-    sys.stdout.write('\r'+console.colour(str(pbar), "green"))
-    print(console.colour("\n"+getMsgTimeStamp(0)+"*** DONE ***", "orange"))
-    runtime = time.time()-start_time
-    print(console.colour(getMsgTimeStamp(0)+"it took %.3fs to copy all files" % runtime, "orange"))
-    print(console.colour(getMsgTimeStamp(0)+"Directories created : "+str(cdir), "orange"))
-    if 'ddir' in locals():
-        print(console.colour(getMsgTimeStamp(0)+"Directories deleted : "+str(ddir), "orange"))
-    print(console.colour(getMsgTimeStamp(0)+"Files copied : "+str(cfiles), "orange"))
-    if 'dfiles' in locals():
-        print(console.colour(getMsgTimeStamp(0)+"Files deleted : "+str(dfiles), "orange"))
-    print("")
-        
-        
+        printSummary(stats)
+    return 0
+
+
 if __name__ == "__main__":
-    cleanLogs()
-    main()
-    writeLogsToDisk()
+    sys.exit(main())
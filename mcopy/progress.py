@@ -0,0 +1,231 @@
+"""
+progress.py
+last modified : 18 october 2026
+
+Progress reporting for the mcopy command line. SyncJob events only update
+counters; what is written to the terminal is rendered by a background timer at
+most REDRAW_RATE times per second, so a tree of tiny files doesn't spend its
+time redrawing the progress bar.
+
+    TerminalDisplay : messages and a progress bar with MB/s and ETA (quiet=True
+                      keeps only the warnings, errors and the summary)
+    JsonDisplay     : one JSON object per line, for log collectors
+"""
+import sys, time, json, threading
+from collections import deque
+import console
+from mcopy import getMsgTimeStamp
+
+REDRAW_RATE = 10        #terminal redraws per second
+JSON_INTERVAL = 1.0     #seconds between two progress records in JSON mode
+RATE_WINDOW = 5.0       #seconds of history used for the throughput
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%d:%02d:%02d" % (seconds//3600, seconds//60 % 60, seconds % 60)
+    return "%d:%02d" % (seconds//60, seconds % 60)
+
+class Progress:
+    """
+    Avancement d'une synchronisation : fichiers et octets faits sur le total,
+    debit sur une fenetre glissante et temps restant estime.
+    """
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.start(0, 0)
+
+    def start(self, total, total_bytes):
+        self.files = 0
+        self.bytes = 0
+        self.total = total
+        self.total_bytes = total_bytes
+        self.start_time = time.time()
+        self._samples = deque([(self.start_time, 0, 0)])
+
+    def update(self, info):
+        self.files = info['files']
+        self.bytes = info['bytes']
+        self.total = info['total']
+        self.total_bytes = info['total_bytes']
+
+    def sample(self, now=None):
+        """
+        Note l'avancement actuel pour le calcul du debit.
+        """
+        now = time.time() if now is None else now
+        self._samples.append((now, self.files, self.bytes))
+        while len(self._samples) > 2 and self._samples[1][0] < now-self.window:
+            self._samples.popleft()
+
+    def rates(self):
+        """
+        Retourne le debit recent en (fichiers/s, octets/s).
+        """
+        then, files, num_bytes = self._samples[0]
+        now, last_files, last_bytes = self._samples[-1]
+        elapsed = now-then
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return (last_files-files)/elapsed, (last_bytes-num_bytes)/elapsed
+
+    def eta(self):
+        """
+        Temps restant estime en secondes, None tant que le debit est inconnu.
+        """
+        file_rate, byte_rate = self.rates()
+        if self.total_bytes > 0 and byte_rate > 0:
+            return max(self.total_bytes-self.bytes, 0)/byte_rate
+        if file_rate > 0:
+            return max(self.total-self.files, 0)/file_rate
+        return None
+
+class TerminalDisplay:
+    """
+    Affiche les evenements d'un SyncJob au terminal. Les messages sont mis en attente
+    et ecrits avec la barre de progression par un thread, REDRAW_RATE fois par seconde
+    au plus. close() ecrit ce qui reste et arrete le thread.
+    """
+    def __init__(self, width, quiet=False, stream=None, rate=REDRAW_RATE):
+        self.width = width
+        self.quiet = quiet
+        self.stream = stream or sys.stdout
+        self.interval = 1.0/rate
+        self.progress = None
+        self.pbar = None
+        self.lock = threading.Lock()
+        self._messages = []
+        self._changed = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __call__(self, event, info):
+        with self.lock:
+            if event == 'message':
+                if not self.quiet or info['level'] > 0:
+                    text = getMsgTimeStamp(info['level'])+info['text']
+                    self._messages.append((text, info['colour']))
+            elif event == 'start':
+                self.progress = Progress()
+                self.progress.start(info['total'], info['total_bytes'])
+                self.pbar = console.ProgressBar(0, max(info['total'], 1), self.width)
+            elif event == 'progress':
+                self.progress.update(info)
+            self._changed = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Ecrit les messages en attente puis redessine la barre de progression.
+        """
+        with self.lock:
+            if not self._changed:
+                return
+            self._changed = False
+            messages, self._messages = self._messages, []
+            out = []
+            for text, colour in messages:
+                if self.pbar is not None and not self.quiet:
+                    #full width, to erase the progress bar under it
+                    text = '\r'+text.ljust(self.width)
+                out.append(console.colour(text+'\n', colour) if colour is not None else text+'\n')
+            if self.pbar is not None and not self.quiet:
+                out.append('\r'+console.colour(self._bar(), "green"))
+        if out:
+            self.stream.write("".join(out))
+            self.stream.flush()
+
+    def _bar(self):
+        progress = self.progress
+        progress.sample()
+        file_rate, byte_rate = progress.rates()
+        eta = progress.eta()
+        status = " %d/%d files  %.1f MB/s  ETA %s" % (progress.files, progress.total, byte_rate/1e6,
+                                                     formatDuration(eta) if eta is not None else "--:--")
+        if progress.total != self.pbar._max:
+            self.pbar.setMax(max(progress.total, 1))
+        self.pbar.setWidth(max(self.width-len(status), 12))
+        self.pbar.update(progress.files)
+        return str(self.pbar)+status
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stop.clear()
+        self.flush()
+        if self.pbar is not None and not self.quiet:
+            self.stream.write('\n')
+            self.stream.flush()
+
+class JsonDisplay:
+    """
+    Ecrit les evenements d'un SyncJob en JSON, un objet par ligne : les messages tels
+    quels, l'avancement au plus une fois par JSON_INTERVAL. close() ecrit l'avancement final.
+    L'avancement de chaque cible d'un FanOutJob est donne sous 'targets'.
+    """
+    def __init__(self, stream=None, interval=JSON_INTERVAL):
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.progress = None
+        self.targets = None
+        self.lock = threading.Lock()
+        self._changed = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self, record):
+        record.setdefault('time', time.time())
+        self.stream.write(json.dumps(record)+'\n')
+        self.stream.flush()
+
+    def __call__(self, event, info):
+        with self.lock:
+            if event == 'message':
+                self.write({'event': 'message', 'level': info['level'], 'text': info['text']})
+            elif event == 'start':
+                self.progress = Progress()
+                self.progress.start(info['total'], info['total_bytes'])
+                self.write({'event': 'start', 'total': info['total'], 'total_bytes': info['total_bytes']})
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+            elif event == 'progress':
+                self.progress.update(info)
+                self.targets = info.get('targets')
+                self._changed = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self._changed:
+                return
+            self._changed = False
+            progress = self.progress
+            progress.sample()
+            file_rate, byte_rate = progress.rates()
+            record = {'event': 'progress', 'files': progress.files, 'total': progress.total,
+                      'bytes': progress.bytes, 'total_bytes': progress.total_bytes,
+                      'files_per_s': round(file_rate, 1), 'bytes_per_s': round(byte_rate),
+                      'eta': progress.eta()}
+            if self.targets is not None:
+                record['targets'] = self.targets
+            self.write(record)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stop.clear()
+        self.flush()
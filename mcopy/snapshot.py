@@ -0,0 +1,108 @@
+"""
+snapshot.py
+last modified : 18 october 2026
+
+Metadata snapshot kept by mcopy in the target directory (_mcopy.snap) between runs.
+For every pair of synchronised directories it stores the modification time of the
+source and target directory, and the names of the entries both contained at the
+end of the run, with the subdirectories to walk. A directory's mtime changes whenever an entry is
+added, removed or renamed in it, so when neither side moved since the last run the
+pair can be skipped without listing it or stat'ing its files.
+
+Files modified in place (same name, directory untouched) are not noticed in
+incremental mode, a run without the snapshot picks them up.
+"""
+import os, sqlite3, time
+
+SNAPSHOT_VERSION = 2
+RACY_DELAY = 2*10**9 #directories modified this close to the scan may change again within the same mtime tick
+
+class Snapshot:
+    def __init__(self, path, fingerprint):
+        #a fan-out job is planned in a worker thread and executed in the main one, never both at once
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        meta = dict(self._db.execute("SELECT key, value FROM meta"))
+        if meta.get('version') != str(SNAPSHOT_VERSION) or meta.get('fingerprint') != fingerprint:
+            #written by another version (maybe with other columns) or for other options, start over
+            with self._db:
+                self._db.execute("DROP TABLE IF EXISTS dirs")
+                self._db.execute("DROP TABLE IF EXISTS entries")
+                self._db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                     [('version', str(SNAPSHOT_VERSION)), ('fingerprint', fingerprint)])
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, src_mtime_ns INTEGER,
+                                             trgt_mtime_ns INTEGER) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS entries (dir TEXT, side INTEGER, name TEXT, is_dir INTEGER,
+                                                PRIMARY KEY (dir, side, name)) WITHOUT ROWID;
+        """)
+        self._dirs = dict((path, (src, trgt)) for path, src, trgt in self._db.execute("SELECT * FROM dirs"))
+        self.start_ns = time.time_ns()
+
+    def __len__(self):
+        return len(self._dirs)
+
+    def isUnchanged(self, rel_dir, src_mtime_ns, trgt_mtime_ns):
+        """
+        Verifie si une paire de dossiers est identique a la derniere synchronisation.
+        """
+        state = self._dirs.get(rel_dir)
+        return state is not None and state == (src_mtime_ns, trgt_mtime_ns)
+
+    def entries(self, rel_dir):
+        """
+        Retourne les entrees enregistrees d'une paire de dossiers :
+        (noms source, noms cible, sous-dossiers source a parcourir).
+        """
+        src_names, trgt_names, subdirs = set(), set(), []
+        for side, name, is_dir in self._db.execute(
+                "SELECT side, name, is_dir FROM entries WHERE dir = ? ORDER BY name", (rel_dir,)):
+            if side == 0:
+                src_names.add(name)
+                if is_dir:
+                    subdirs.append(name)
+            else:
+                trgt_names.add(name)
+        return src_names, trgt_names, subdirs
+
+    def record(self, scanned, visited):
+        """
+        Enregistre l'etat des paires de dossiers parcourues et oublie celles qui n'existent plus.
+        'scanned' est une liste de (dossier relatif, mtime source, lignes source, dossier cible).
+        """
+        with self._db:
+            for rel_dir, src_mtime_ns, src_rows, trgt_root in scanned:
+                trgt_mtime_ns, trgt_rows = None, []
+                if os.path.isdir(trgt_root):
+                    trgt_mtime_ns = os.stat(trgt_root).st_mtime_ns
+                    with os.scandir(trgt_root) as it:
+                        trgt_rows = [entryRow(entry) for entry in it]
+                if self._isRacy(src_mtime_ns) or self._isRacy(trgt_mtime_ns):
+                    self._db.execute("DELETE FROM dirs WHERE path = ?", (rel_dir,))
+                else:
+                    self._db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                                     (rel_dir, src_mtime_ns, trgt_mtime_ns))
+                self._db.execute("DELETE FROM entries WHERE dir = ?", (rel_dir,))
+                self._db.executemany("INSERT INTO entries VALUES (?, 0, ?, ?)",
+                                     [(rel_dir,)+row for row in src_rows])
+                self._db.executemany("INSERT INTO entries VALUES (?, 1, ?, ?)",
+                                     [(rel_dir,)+row for row in trgt_rows])
+
+            visited = set(visited)
+            known = set(self._dirs)
+            known.update(path for (path,) in self._db.execute("SELECT DISTINCT dir FROM entries"))
+            gone = [(path,) for path in known if path not in visited]
+            self._db.executemany("DELETE FROM dirs WHERE path = ?", gone)
+            self._db.executemany("DELETE FROM entries WHERE dir = ?", gone)
+
+    def close(self):
+        self._db.close()
+
+    def _isRacy(self, mtime_ns):
+        return mtime_ns is None or mtime_ns > self.start_ns-RACY_DELAY
+
+def entryRow(entry):
+    """
+    Ligne (nom, dossier) d'une entree de os.scandir, sans stat : seuls les noms servent.
+    """
+    return (entry.name, int(entry.is_dir(follow_symlinks=False)))
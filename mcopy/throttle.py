@@ -0,0 +1,210 @@
+"""
+throttle.py
+last modified : 18 october 2026
+
+Rate limiting of mcopy's copies (--bwlimit, --files-limit), so a sync can run
+during the day at a capped share of the disks instead of saturating them.
+
+Bytes per second and files per second each go through a token bucket shared by
+all the copy threads. Tokens are paid after the data is moved: a copy thread
+that overdraws the bucket sleeps until the debt is repaid, so the average rate
+holds whatever the number of threads. The copy backend (transfer.py) moves data
+in chunks of about CHUNK_SECONDS of traffic, so a new limit applies quickly.
+
+The limits can be changed while mcopy runs:
+
+    control file : with --throttle-file, a file of 'key = value' lines, re-read
+                   when it changes (at most every CONTROL_INTERVAL seconds).
+                       bwlimit = 20M    #bytes per second, 0 or none for no limit
+                       files = 100      #files per second
+                   Removing the file brings back the limits of the command line.
+    signals      : SIGUSR1 halves the current limits, SIGUSR2 doubles them.
+
+lowPriority() lowers the CPU and I/O priority of the process, like nice and
+ionice -c3 (idle class, Linux only): the copies then only use the disk when
+nothing else needs it.
+"""
+import os, sys, time, signal, threading, ctypes, ctypes.util
+from filters import parseSize
+
+BURST_SECONDS = 0.5     #tokens that can be saved up while idle, in seconds of traffic
+CHUNK_SECONDS = 0.25    #traffic copied between two payments
+MIN_CHUNK = 64*1024
+CONTROL_INTERVAL = 1.0
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+#the C library has no wrapper for ioprio_set
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314,
+                       'ppc64le': 273, 's390x': 282, 'riscv64': 30}
+
+def formatRate(value, unit):
+    if value is None:
+        return "unlimited"
+    if unit == 'B':
+        return "%.1f MB/s" % (value/1e6)
+    return "%g files/s" % value
+
+class TokenBucket:
+    """
+    Seau a jetons : 'rate' jetons par seconde, au plus 'burst' mis de cote.
+    rate None ou 0 : pas de limite.
+    """
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.burst = 0
+        self.waited = 0.0       #seconds spent waiting by all the threads
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.setRate(rate, burst)
+
+    def setRate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate or None
+            if burst is None:
+                burst = rate*BURST_SECONDS if rate else 0
+            self.burst = burst
+            self._tokens = min(self._tokens, self.burst)
+            self._last = time.monotonic()
+
+    def consume(self, amount):
+        """
+        Paye 'amount' jetons et attend, si le seau est a decouvert, que la dette soit remboursee.
+        """
+        with self.lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens+(now-self._last)*self.rate)-amount
+            self._last = now
+            wait = -self._tokens/self.rate if self._tokens < 0 else 0.0
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+
+class Throttle:
+    """
+    Limites de debit d'une synchronisation, partagees par les threads de copie.
+    bytes_per_s, files_per_s : limites de depart, None pour aucune
+    control : fichier de controle relu quand il change (voir plus haut)
+    on_change : appele avec une description des limites quand elles changent
+    """
+    def __init__(self, bytes_per_s=None, files_per_s=None, control=None, on_change=None):
+        self.bytes = TokenBucket(bytes_per_s)
+        self.files = TokenBucket(files_per_s, burst=max(files_per_s*BURST_SECONDS, 1) if files_per_s else None)
+        self.control = control
+        self.on_change = on_change
+        self._defaults = (bytes_per_s, files_per_s)
+        self._control_mtime = None
+        self._next_check = 0.0
+        self._scale = 1.0       #pending factor set by the signal handlers
+        self.poll()
+
+    @property
+    def waited(self):
+        return self.bytes.waited+self.files.waited
+
+    def chunkSize(self, default):
+        """
+        Taille des blocs copies entre deux paiements.
+        """
+        rate = self.bytes.rate
+        if rate is None:
+            return default
+        return int(min(max(rate*CHUNK_SECONDS, MIN_CHUNK), default))
+
+    def fileStarted(self):
+        self.poll()
+        self.files.consume(1)
+
+    def consume(self, num_bytes):
+        self.poll()
+        self.bytes.consume(num_bytes)
+
+    def setLimits(self, bytes_per_s, files_per_s):
+        self.bytes.setRate(bytes_per_s)
+        self.files.setRate(files_per_s, burst=max(files_per_s*BURST_SECONDS, 1) if files_per_s else None)
+        if self.on_change is not None:
+            self.on_change("throttle : "+self.describe())
+
+    def describe(self):
+        return formatRate(self.bytes.rate, 'B')+", "+formatRate(self.files.rate, 'files')
+
+    def poll(self):
+        """
+        Applique les changements demandes par signal ou par le fichier de controle.
+        """
+        if self._scale != 1.0:
+            scale, self._scale = self._scale, 1.0
+            self.setLimits(self.bytes.rate and self.bytes.rate*scale, self.files.rate and self.files.rate*scale)
+        if self.control is None:
+            return
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now+CONTROL_INTERVAL
+        try:
+            mtime = os.stat(self.control).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+        if mtime is None:
+            self.setLimits(*self._defaults)
+        else:
+            self.setLimits(*self.readControl())
+
+    def readControl(self):
+        """
+        Lit le fichier de controle. Retourne les limites (octets/s, fichiers/s).
+        """
+        bytes_per_s, files_per_s = self._defaults
+        try:
+            with open(self.control) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return bytes_per_s, files_per_s
+        for line in lines:
+            key, equal, value = line.split('#')[0].partition('=')
+            key, value = key.strip().lower(), value.strip().lower()
+            if not equal or not key:
+                continue
+            try:
+                if key == 'bwlimit':
+                    bytes_per_s = None if value in ('', 'none') else parseSize(value)
+                elif key == 'files':
+                    files_per_s = None if value in ('', 'none') else float(value)
+            except ValueError:
+                pass
+        return bytes_per_s or None, files_per_s or None
+
+    def installSignals(self):
+        """
+        SIGUSR1 divise les limites par deux, SIGUSR2 les double. A appeler du thread principal.
+        """
+        def scale(factor):
+            def handler(signum, frame):
+                #applied by the copy threads at their next payment
+                self._scale *= factor
+            return handler
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, scale(0.5))
+            signal.signal(signal.SIGUSR2, scale(2.0))
+
+def lowPriority():
+    """
+    Baisse la priorite CPU (nice) et disque (classe idle) du processus. Les threads crees
+    ensuite en heritent. Retourne False si la priorite disque n'a pas pu etre changee.
+    """
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+    number = IOPRIO_SET_SYSCALLS.get(os.uname().machine) if sys.platform.startswith('linux') else None
+    if number is None:
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return libc.syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) == 0
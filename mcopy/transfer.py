@@ -0,0 +1,496 @@
+"""
+transfer.py
+last modified : 18 october 2026
+
+File copy backends used by mcopy. The fastest method supported by the
+platform and the filesystems involved is picked for every file:
+
+    reflink         : copy-on-write clone (FICLONE), no data is moved at all
+    copy_file_range : in-kernel copy, may be offloaded by the filesystem
+    sendfile        : in-kernel copy through the page cache
+    readinto        : large-buffer user space loop, works everywhere
+
+copyFile writes into a hidden partial file next to the target and renames it
+over the target once complete, so an interrupted copy never leaves a truncated
+file under the target's name. Files larger than SEGMENT_SIZE are copied segment
+by segment, each one flushed to the disk before its offset is reported, so an
+interrupted copy can be resumed from the last reported offset. With a throttle
+(see throttle.py), data is copied in smaller chunks paid one by one.
+
+fanOutCopy copies one file to several targets reading it only once: every block
+read is written to all the partial files. A target that fails is dropped without
+stopping the copy to the others.
+
+deltaCopy updates an existing file rsync-style: only the blocks of the source
+that can't be found in the old version are written, the rest is copied over
+from the old file, and the result replaces the target atomically.
+
+linkFile creates a duplicate of a file already in the target, as a clone when
+possible or as a hard link.
+"""
+import os, sys, stat, threading, errno, zlib, hashlib, mmap
+
+BUFFER_SIZE = 1024*1024
+DELTA_BLOCK_SIZE = 64*1024
+DELTA_ROLL_LIMIT = 4*DELTA_BLOCK_SIZE #bytes searched one by one after a miss before probing block by block
+DELTA_PROBE_BLOCKS = 4                #blocks probed before searching byte by byte again, doubled
+DELTA_MAX_PROBE = 256                 #after every search without a match, up to this
+SEGMENT_SIZE = 64*1024*1024 #larger copies are synced and reported every segment
+VERIFY_SIZE = 1024*1024 #bytes compared before resuming a partial copy
+PART_SUFFIX = ".mcopy-part"
+FICLONE = 0x40049409
+
+#errors meaning "this method is not available here", any other error is a real failure
+_fallback_errors = set([errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                        errno.ENOTTY, errno.EBADF, errno.EPERM, errno.ENOTSUP, errno.ENOTSOCK])
+_unsupported = set() #(backend, source device, target device)
+_local = threading.local()
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+def _getUmask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+_umask = _getUmask()
+
+def _buffer():
+    buf = getattr(_local, 'buffer', None)
+    if buf is None:
+        buf = _local.buffer = memoryview(bytearray(BUFFER_SIZE))
+    return buf
+
+def _reflink(src_fd, dst_fd, size, offset):
+    if fcntl is None or offset != 0:
+        raise OSError(errno.ENOSYS, "reflink not available")
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    return size
+
+def _copyFileRange(src_fd, dst_fd, size, offset):
+    while offset < size:
+        sent = os.copy_file_range(src_fd, dst_fd, size-offset, offset, offset)
+        if sent == 0:
+            break
+        offset += sent
+    return offset
+
+def _sendfile(src_fd, dst_fd, size, offset):
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while offset < size:
+        sent = os.sendfile(dst_fd, src_fd, offset, size-offset)
+        if sent == 0:
+            break
+        offset += sent
+    return offset
+
+def _readinto(src_fd, dst_fd, size, offset):
+    buf = _buffer()
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    with open(src_fd, 'rb', buffering=0, closefd=False) as src:
+        while offset < size:
+            n = src.readinto(buf[:min(len(buf), size-offset)])
+            if not n:
+                break
+            view = buf[:n]
+            while view:
+                written = os.write(dst_fd, view)
+                view = view[written:]
+            offset += n
+    return offset
+
+backends = [('reflink', _reflink)]
+if hasattr(os, 'copy_file_range'):
+    backends.append(('copy_file_range', _copyFileRange))
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    #elsewhere (macOS, BSD) sendfile only writes to sockets
+    backends.append(('sendfile', _sendfile))
+backends.append(('readinto', _readinto))
+
+def copyData(src_fd, dst_fd, size, devices=None, offset=0):
+    """
+    Copie le contenu de src_fd dans dst_fd a partir de 'offset' avec la premiere
+    methode supportee. Retourne le nom de la methode utilisee et la position finale.
+    """
+    for name, backend in backends:
+        key = (name, devices)
+        if key in _unsupported or (name == 'reflink' and offset != 0):
+            continue
+        try:
+            return name, backend(src_fd, dst_fd, size, offset)
+        except OSError as e:
+            if e.errno not in _fallback_errors or name == 'readinto':
+                raise
+            #every backend writes at explicit offsets, the next one simply starts over
+            if devices is not None:
+                _unsupported.add(key)
+    raise OSError(errno.ENOSYS, "no copy backend available")
+
+def _openPart(part, mode):
+    try:
+        fd = os.open(part, os.O_WRONLY|os.O_CREAT|os.O_EXCL, mode)
+    except FileExistsError:
+        #left over by an interrupted copy
+        os.remove(part)
+        fd = os.open(part, os.O_WRONLY|os.O_CREAT|os.O_EXCL, mode)
+    try:
+        #a new file already has the right mode unless the umask stripped some bits
+        if mode & _umask:
+            os.fchmod(fd, mode)
+    except BaseException:
+        _discard(fd, part)
+        raise
+    return fd
+
+def _discard(fd, part):
+    #the target may be gone altogether, cleaning up must not raise
+    try:
+        if fd is not None:
+            os.close(fd)
+        os.remove(part)
+    except OSError:
+        pass
+
+def partName(target):
+    """
+    Fichier partiel dans lequel copyFile ecrit avant de le renommer en target.
+    """
+    path, name = os.path.split(target)
+    return os.path.join(path, "."+name+PART_SUFFIX)
+
+def copyFile(source, target, offset=0, progress=None, backup=None, throttle=None):
+    """
+    Copie le fichier source vers target en conservant les permissions, comme shutil.copy.
+    La copie est ecrite dans un fichier partiel puis renommee en target ; si 'backup'
+    est donne, l'ancien target y est d'abord renomme.
+    Avec 'offset', la copie reprend le fichier partiel existant a cette position.
+    'progress' est appele avec la position atteinte apres chaque segment ecrit sur le disque.
+    'throttle' (throttle.Throttle) limite le debit de la copie.
+    Retourne le nom de la methode utilisee et le nombre d'octets copies.
+    """
+    if throttle is not None:
+        throttle.fileStarted()
+    part = partName(target)
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        src_stat = os.fstat(src_fd)
+        size = src_stat.st_size
+        mode = stat.S_IMODE(src_stat.st_mode)
+        if offset > 0:
+            dst_fd = os.open(part, os.O_WRONLY)
+            os.ftruncate(dst_fd, offset)
+        else:
+            dst_fd = _openPart(part, mode)
+        start = offset
+        try:
+            if offset > 0:
+                os.fchmod(dst_fd, mode)
+            devices = (src_stat.st_dev, os.fstat(dst_fd).st_dev)
+            synced = offset
+            while True:
+                chunk = SEGMENT_SIZE if throttle is None else throttle.chunkSize(SEGMENT_SIZE)
+                position, end = offset, min(offset+chunk, size)
+                backend, offset = copyData(src_fd, dst_fd, end, devices, offset)
+                if backend == 'reflink':
+                    #the whole file was cloned, no data moved
+                    offset = size
+                    break
+                if throttle is not None:
+                    throttle.consume(offset-position)
+                done = offset >= size or offset < end #offset < end : the source got shorter while being copied
+                if size > SEGMENT_SIZE and (done or offset-synced >= SEGMENT_SIZE):
+                    os.fdatasync(dst_fd)
+                    synced = offset
+                    if progress is not None:
+                        progress(offset)
+                if done:
+                    break
+        except BaseException:
+            os.close(dst_fd)
+            if offset == start or progress is None:
+                #nothing worth resuming
+                os.remove(part)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    if backup is not None:
+        os.rename(target, backup)
+    os.replace(part, target)
+    return backend, offset-start
+
+def fanOutCopy(source, targets, throttle=None):
+    """
+    Copie source vers plusieurs cibles en ne lisant le fichier qu'une fois. 'targets' est
+    une liste de (target, backup), backup comme pour copyFile. Retourne pour chaque cible
+    le nombre d'octets copies, ou l'exception qui a arrete la copie vers elle.
+    """
+    if throttle is not None:
+        throttle.fileStarted()
+    results = [None]*len(targets)
+    outputs = []        #[index, fd, part] of the targets still being written
+    def drop(output, error):
+        results[output[0]] = error
+        outputs.remove(output)
+        _discard(output[1], output[2])
+
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        mode = stat.S_IMODE(os.fstat(src_fd).st_mode)
+        for index, (target, backup) in enumerate(targets):
+            part = partName(target)
+            try:
+                outputs.append([index, _openPart(part, mode), part])
+            except OSError as e:
+                results[index] = e
+        buf = _buffer()
+        offset = 0
+        with open(src_fd, 'rb', buffering=0, closefd=False) as src:
+            while outputs:
+                n = src.readinto(buf)
+                if not n:
+                    break
+                for output in list(outputs):
+                    try:
+                        _writeAll(output[1], buf[:n], offset)
+                    except OSError as e:
+                        drop(output, e)
+                offset += n
+                if throttle is not None:
+                    throttle.consume(n*len(outputs))
+        for output in list(outputs):
+            index, fd, part = output
+            target, backup = targets[index]
+            outputs.remove(output)
+            try:
+                os.close(fd)
+                if backup is not None:
+                    os.rename(target, backup)
+                os.replace(part, target)
+                results[index] = offset
+            except OSError as e:
+                results[index] = e
+                _discard(None, part)
+    except BaseException:
+        for index, fd, part in outputs:
+            _discard(fd, part)
+        raise
+    finally:
+        os.close(src_fd)
+    return results
+
+def verifiedOffset(source, part, offset, check=VERIFY_SIZE):
+    """
+    Verifie qu'un fichier partiel correspond a la source jusqu'a 'offset' en comparant
+    le bloc qui precede. Retourne 'offset' si c'est le cas, sinon 0.
+    """
+    try:
+        if offset <= 0 or os.path.getsize(part) < offset:
+            return 0
+        length = min(check, offset)
+        with open(source, 'rb') as src, open(part, 'rb') as dst:
+            src.seek(offset-length)
+            dst.seek(offset-length)
+            if src.read(length) == dst.read(length):
+                return offset
+    except OSError:
+        pass
+    return 0
+
+def _strongSum(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def blockSignature(fd, block_size=DELTA_BLOCK_SIZE):
+    """
+    Decoupe le fichier en blocs et retourne un dictionnaire
+    {somme faible: [(somme forte, position), ...]}.
+    """
+    signature = {}
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    offset = 0
+    os.lseek(fd, 0, os.SEEK_SET)
+    with open(fd, 'rb', buffering=0, closefd=False) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            block = view[:n]
+            signature.setdefault(zlib.adler32(block), []).append((_strongSum(block), offset))
+            offset += n
+    return signature
+
+def _copyRange(src_fd, dst_fd, length, src_offset, dst_offset):
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while length > 0:
+                sent = os.copy_file_range(src_fd, dst_fd, length, src_offset, dst_offset)
+                if sent == 0:
+                    break
+                length -= sent
+                src_offset += sent
+                dst_offset += sent
+            return
+        except OSError as e:
+            if e.errno not in _fallback_errors:
+                raise
+    while length > 0:
+        data = os.pread(src_fd, min(length, BUFFER_SIZE), src_offset)
+        if not data:
+            break
+        os.pwrite(dst_fd, data, dst_offset)
+        length -= len(data)
+        src_offset += len(data)
+        dst_offset += len(data)
+
+def _writeAll(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+def deltaCopy(source, target, block_size=DELTA_BLOCK_SIZE, throttle=None):
+    """
+    Met a jour target a partir de source en ne transferant que les blocs modifies.
+    Le resultat est ecrit dans un fichier temporaire puis renomme sur target.
+    Retourne le nombre d'octets transferes depuis la source et la taille du fichier.
+    """
+    if throttle is not None:
+        throttle.fileStarted()
+    path, name = os.path.split(target)
+    tmp = os.path.join(path, "."+name+".mcopy-delta")
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        src_stat = os.fstat(src_fd)
+        size = src_stat.st_size
+        old_fd = os.open(target, os.O_RDONLY)
+        try:
+            signature = blockSignature(old_fd, block_size)
+            tmp_fd = os.open(tmp, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, stat.S_IMODE(src_stat.st_mode))
+            try:
+                sent = _deltaTransfer(src_fd, old_fd, tmp_fd, size, signature, block_size)
+                os.fchmod(tmp_fd, stat.S_IMODE(src_stat.st_mode))
+            except BaseException:
+                os.close(tmp_fd)
+                os.remove(tmp)
+                raise
+            os.close(tmp_fd)
+        finally:
+            os.close(old_fd)
+    finally:
+        os.close(src_fd)
+    os.replace(tmp, target)
+    if throttle is not None:
+        #the whole new version was written to the target device
+        throttle.consume(size)
+    return sent, size
+
+def _deltaTransfer(src_fd, old_fd, out_fd, size, signature, block_size):
+    if size == 0:
+        return 0
+    src = mmap.mmap(src_fd, size, access=mmap.ACCESS_READ)
+    try:
+        sent = 0
+        out = 0                 #write position in the output
+        literal = 0             #start of the pending literal data in the source
+        run = None              #pending run of matching blocks, [old offset, length]
+        p = 0
+        a = b = None            #rolling checksum of src[p:p+block_size]
+        missed = 0
+        probed = 0
+        probe_limit = DELTA_PROBE_BLOCKS
+        while p+block_size <= size:
+            if a is None:
+                weak = zlib.adler32(src[p:p+block_size])
+                a, b = weak & 0xffff, weak >> 16
+            match = None
+            candidates = signature.get((b << 16) | a)
+            if candidates:
+                strong = _strongSum(src[p:p+block_size])
+                for candidate, offset in candidates:
+                    if candidate == strong:
+                        match = offset
+                        break
+            if match is not None:
+                if literal < p:
+                    if run:
+                        _copyRange(old_fd, out_fd, run[1], run[0], out)
+                        out += run[1]
+                        run = None
+                    _writeAll(out_fd, src[literal:p], out)
+                    out += p-literal
+                    sent += p-literal
+                if run and run[0]+run[1] == match:
+                    run[1] += block_size
+                else:
+                    if run:
+                        _copyRange(old_fd, out_fd, run[1], run[0], out)
+                        out += run[1]
+                    run = [match, block_size]
+                p += block_size
+                literal = p
+                a = None
+                missed = probed = 0
+                probe_limit = DELTA_PROBE_BLOCKS
+            elif missed < DELTA_ROLL_LIMIT and p+block_size < size:
+                #roll the adler32 checksum one byte forward
+                old, new = src[p], src[p+block_size]
+                a = (a-old+new) % 65521
+                b = (b-block_size*old+a-1) % 65521
+                p += 1
+                missed += 1
+            else:
+                #no match nearby, probe some blocks, then search one block of offsets byte by byte
+                #again: it covers every alignment, the streams line up after an insertion of any size.
+                #the probing stretches get longer while nothing matches, so a file that changed
+                #entirely is not searched byte by byte
+                p += block_size
+                a = None
+                probed += 1
+                if probed >= probe_limit:
+                    probed = 0
+                    probe_limit = min(probe_limit*2, DELTA_MAX_PROBE)
+                    missed = DELTA_ROLL_LIMIT-block_size
+        if run:
+            _copyRange(old_fd, out_fd, run[1], run[0], out)
+            out += run[1]
+        if literal < size:
+            _writeAll(out_fd, src[literal:size], out)
+            sent += size-literal
+        return sent
+    finally:
+        src.close()
+
+def linkFile(origin, target, throttle=None):
+    """
+    Cree target avec le contenu de origin sans dupliquer les donnees : clone (reflink)
+    si le systeme de fichiers le permet, sinon lien physique. Retourne la methode utilisee.
+    """
+    if throttle is not None:
+        throttle.fileStarted()
+    if fcntl is not None:
+        src_fd = os.open(origin, os.O_RDONLY)
+        try:
+            mode = stat.S_IMODE(os.fstat(src_fd).st_mode)
+            dst_fd = os.open(target, os.O_WRONLY|os.O_CREAT|os.O_EXCL, mode)
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                os.fchmod(dst_fd, mode)
+            except BaseException as e:
+                #the empty target created above must not stay behind, whether we fall back or fail
+                os.close(dst_fd)
+                os.remove(target)
+                if not isinstance(e, OSError) or e.errno not in _fallback_errors:
+                    raise
+            else:
+                os.close(dst_fd)
+                return 'reflink'
+        finally:
+            os.close(src_fd)
+    os.link(origin, target)
+    return 'hardlink'
@@ -0,0 +1,225 @@
+"""
+watch.py
+last modified : 18 october 2026
+
+Continuous synchronisation for mcopy's --watch mode. After a first full run, the
+source tree is watched with inotify (Linux) and only the directories in which
+something changed are compared again, so a saved file reaches the target within
+a fraction of a second instead of waiting for the next full scan.
+
+Events are debounced per directory: a directory is synchronised once it has been
+quiet for DEBOUNCE_DELAY, or at the latest MAX_DELAY after its first event, so a
+burst of writes to the same files is copied once. If the kernel event queue
+overflows, events were lost and the whole tree is scanned again. Without inotify
+the tree is simply scanned every RESCAN_INTERVAL.
+"""
+import os, time, errno, struct, select, threading, ctypes, ctypes.util
+from mcopy import isIgnored
+
+DEBOUNCE_DELAY = 0.2
+MAX_DELAY = 2.0 #a file written continuously still gets copied this often
+RESCAN_INTERVAL = 30.0
+LOG_INTERVAL = 10.0 #the history is written to disk at most this often
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY|IN_ATTRIB|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE
+              |IN_DELETE_SELF|IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII') #wd, mask, cookie, name length
+
+class Inotify:
+    """
+    Acces minimal a inotify par ctypes : un descripteur non bloquant,
+    des surveillances par dossier et la lecture des evenements.
+    """
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK|os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def addWatch(self, path, mask=WATCH_MASK):
+        """
+        Surveille un dossier. Retourne le descripteur de surveillance,
+        le meme si le dossier etait deja surveille.
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self, timeout):
+        """
+        Attend au plus 'timeout' secondes et retourne les evenements recus,
+        une liste de (wd, mask, nom).
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 256*1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset+length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    """
+    Synchronise un SyncJob en continu. run() fait une premiere synchronisation
+    complete puis suit les changements de la source jusqu'a ce que 'stop' soit
+    leve (threading.Event) ou que le processus soit interrompu.
+    Seulement de la source vers la cible : pas avec both_ways.
+    """
+    def __init__(self, job, delay=DEBOUNCE_DELAY, max_delay=MAX_DELAY,
+                 rescan_interval=RESCAN_INTERVAL, log_interval=LOG_INTERVAL):
+        if job.both_ways:
+            raise ValueError("watch mode only synchronises from source to target")
+        if job.dry_run:
+            raise ValueError("watch mode can't be used with dry_run")
+        self.job = job
+        self.delay = delay
+        self.max_delay = max_delay
+        self.rescan_interval = rescan_interval
+        self.log_interval = log_interval
+        self.dirs = {}          #watch descriptor -> directory relative to the source
+        self.pending = {}       #relative directory -> [first event, last event]
+        self.batches = 0
+        self.rescans = 0
+
+    def run(self, stop=None):
+        stop = stop or threading.Event()
+        job = self.job
+        job.run()
+        try:
+            notifier = Inotify()
+        except OSError as e:
+            job.message("inotify not available (%s), scanning every %ds" % (e, self.rescan_interval),
+                        "orange", 1)
+            while not stop.wait(self.rescan_interval):
+                job.run()
+                self.rescans += 1
+            return job.stats
+
+        self.message("--- watching "+job.source+" ---")
+        try:
+            self.watchTree(notifier, "")
+            last_write = time.time()
+            dirty = False
+            while not stop.is_set():
+                now = time.time()
+                timeout = min([self._deadline(times) for times in self.pending.values()]+[now+1.0])-now
+                overflow = False
+                for wd, mask, name in notifier.read(timeout):
+                    if mask & IN_Q_OVERFLOW:
+                        overflow = True
+                    else:
+                        self.handleEvent(notifier, wd, mask, name)
+
+                if overflow:
+                    self.rescan(notifier)
+                    last_write = time.time()
+                    dirty = False
+                    continue
+
+                now = time.time()
+                ready = [rel_dir for rel_dir, times in self.pending.items() if self._deadline(times) <= now]
+                if ready:
+                    for rel_dir in ready:
+                        del self.pending[rel_dir]
+                    plan = job.planDirs(ready)
+                    if len(plan) or plan.dirs or (job.mirror and (plan.extra_dirs or plan.extra_files)):
+                        job.applyPlan(plan)
+                        self.batches += 1
+                        dirty = True
+
+                if dirty and now-last_write >= self.log_interval:
+                    job.writeLogsToDisk()
+                    last_write = now
+                    dirty = False
+        finally:
+            notifier.close()
+            job.writeLogsToDisk()
+        return job.stats
+
+    def message(self, text, colour=None, level=0):
+        self.job.message(text, colour, level)
+
+    def _deadline(self, times):
+        return min(times[1]+self.delay, times[0]+self.max_delay)
+
+    def watchTree(self, notifier, rel_dir):
+        """
+        Surveille un dossier de la source et tous ses sous-dossiers.
+        """
+        root = os.path.join(self.job.source, rel_dir) if rel_dir else self.job.source
+        stack = [(rel_dir, root)]
+        while stack:
+            rel, path = stack.pop()
+            try:
+                self.dirs[notifier.addWatch(path)] = rel
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False) and self.job.filter.matchDir(entry.name, rel):
+                            stack.append((os.path.join(rel, entry.name), entry.path))
+            except FileNotFoundError:
+                #removed in the meantime, its parent has an event for it
+                continue
+
+    def handleEvent(self, notifier, wd, mask, name):
+        """
+        Note le dossier touche par un evenement pour sa prochaine synchronisation.
+        """
+        if mask & IN_IGNORED:
+            self.dirs.pop(wd, None)
+            return
+        rel_dir = self.dirs.get(wd)
+        if rel_dir is None or mask & IN_DELETE_SELF:
+            #the parent directory has its own event for the removal
+            return
+        if isIgnored(name):
+            return
+        if mask & IN_ISDIR and mask & (IN_CREATE|IN_MOVED_TO):
+            #files created before the watch is set are found when the parent is planned
+            self.watchTree(notifier, os.path.join(rel_dir, name))
+        now = time.time()
+        times = self.pending.get(rel_dir)
+        if times is None:
+            self.pending[rel_dir] = [now, now]
+        else:
+            times[1] = now
+
+    def rescan(self, notifier):
+        """
+        Des evenements ont ete perdus : resynchronise toute l'arborescence.
+        """
+        self.message("event queue overflowed, scanning everything", "orange", 1)
+        self.job.writeLogsToDisk()
+        self.pending.clear()
+        self.watchTree(notifier, "")
+        self.job.run()
+        self.rescans += 1